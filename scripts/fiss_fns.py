@@ -2,8 +2,11 @@ import json
 import sys
 import logging
 import tenacity as tn
+from concurrent.futures import ThreadPoolExecutor
 from firecloud import api as fapi
 from firecloud import errors as ferrors
+from google.api_core import exceptions as gexceptions
+from google.cloud import storage as gcs
 from datetime import timedelta
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
@@ -63,6 +66,148 @@ def call_fiss(fapifunc, okcode, *args, specialcodes=None, **kwargs):
     return response.json()
 
 
+def batch_upsert_entities(namespace, workspace, entity_data):
+    ''' post entity updates to the batchUpsert endpoint, which FISS doesn't wrap; entity_data is a list of
+    {"name", "entityType", "operations"} dicts. returns the response (204 on success), like the fapi functions.
+    '''
+    uri = "workspaces/{0}/{1}/entities/batchUpsert".format(namespace, workspace)
+    # use FISS's own authorized session, root url and user agent
+    return fapi.__post(uri, json=entity_data)
+
+
+# limits for a single Rawls batchUpsert request
+BATCH_UPSERT_MAX_OPERATIONS = 1000
+BATCH_UPSERT_MAX_BYTES = 5 * 1024 * 1024
+
+
+def batch_entity_updates(entity_updates, max_operations=BATCH_UPSERT_MAX_OPERATIONS, max_bytes=BATCH_UPSERT_MAX_BYTES):
+    ''' group entity updates into batchUpsert request bodies
+
+    function inputs:
+        entity_updates : iterable of (entity_type, entity_name, attrs_list) tuples, where attrs_list
+                         holds attribute operations, e.g. from `fapi._attr_set`
+        max_operations : maximum number of attribute operations in a single request
+        max_bytes : maximum (approximate) size of a single request body
+
+    function returns:
+        generator of lists of {"entityType", "name", "operations"} dicts, one list per request
+    '''
+    batch = []
+    batch_operations = 0
+    batch_bytes = 2  # enclosing []
+    for entity_type, entity_name, attrs_list in entity_updates:
+        entity = {"entityType": entity_type, "name": entity_name, "operations": attrs_list}
+        entity_bytes = len(json.dumps(entity)) + 1
+        if batch and (batch_operations + len(attrs_list) > max_operations or batch_bytes + entity_bytes > max_bytes):
+            yield batch
+            batch = []
+            batch_operations = 0
+            batch_bytes = 2
+        batch.append(entity)
+        batch_operations += len(attrs_list)
+        batch_bytes += entity_bytes
+    if batch:
+        yield batch
+
+
+def upsert_entity_batches(workspace_project, workspace_name, entity_updates, max_workers=4,
+                          max_operations=BATCH_UPSERT_MAX_OPERATIONS, max_bytes=BATCH_UPSERT_MAX_BYTES):
+    ''' apply entity updates with batchUpsert requests, posting up to max_workers requests at a time
+
+    each request is retried by `call_fiss`; a batch that still fails is reported and does not stop the others
+
+    function inputs:
+        workspace_project, workspace_name : workspace to update
+        entity_updates : iterable of (entity_type, entity_name, attrs_list) tuples
+        max_workers : maximum number of batchUpsert requests in flight
+
+    function returns:
+        list of (batch, status_code, error) tuples in batch order, where status_code is None if the
+        request failed without a response
+    '''
+    batches = list(batch_entity_updates(entity_updates, max_operations, max_bytes))
+    if not batches:
+        return []
+
+    def post_batch(batch):
+        try:
+            response = call_fiss(batch_upsert_entities, 204, workspace_project, workspace_name, batch, specialcodes=[200])
+            return batch, response.status_code, None
+        except tn.RetryError as e:
+            error = e.last_attempt.exception()
+        except Exception as e:
+            error = e
+        status_code = error.code if isinstance(error, ferrors.FireCloudServerError) else None
+        return batch, status_code, str(error)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+        for i, (batch, status_code, error) in enumerate(executor.map(post_batch, batches)):
+            n_operations = sum(len(entity['operations']) for entity in batch)
+            if error is None:
+                logger.info('batchUpsert %s/%s: updated %s entities (%s operations)', i + 1, len(batches), len(batch), n_operations)
+            else:
+                logger.error('batchUpsert %s/%s: FAILED for %s entities (%s operations) - %s', i + 1, len(batches), len(batch), n_operations, error)
+            results.append((batch, status_code, error))
+    return results
+
+
+NOTEBOOK_CONTENT_TYPE = 'application/x-ipynb+json'
+
+
+def rewrite_notebooks(bucket_name, replace_this, with_this, max_workers=8, prefix='notebooks/', storage_client=None):
+    ''' replace every instance of replace_this with with_this in the .ipynb files under prefix in a bucket
+
+    notebooks are read and rewritten in memory, up to max_workers at a time, and only uploaded if their
+    content changed. uploads are conditional on the generation that was read, so a notebook edited by
+    someone else in the meantime is left alone and reported as a conflict rather than overwritten.
+
+    function inputs:
+        bucket_name : name of the bucket (no gs:// prefix)
+        replace_this, with_this : target string and its replacement
+        max_workers : maximum number of notebooks processed at a time
+
+    function returns:
+        list of (blob_name, status, error) tuples in listing order, where status is one of
+        'updated', 'unchanged', 'conflict' or 'failed'
+    '''
+    storage_client = storage_client or gcs.Client()
+    bucket = storage_client.bucket(bucket_name)
+    blobs = [blob for blob in storage_client.list_blobs(bucket_name, prefix=prefix) if blob.name.endswith('.ipynb')]
+    if not blobs:
+        return []
+
+    replace_bytes = replace_this.encode('utf-8')
+    with_bytes = with_this.encode('utf-8')
+
+    def rewrite_notebook(listed_blob):
+        blob = bucket.blob(listed_blob.name)
+        generation = listed_blob.generation
+        try:
+            content = blob.download_as_bytes(if_generation_match=generation)
+            if replace_bytes not in content:
+                return listed_blob.name, 'unchanged', None
+            blob.upload_from_string(content.replace(replace_bytes, with_bytes),
+                                    content_type=listed_blob.content_type or NOTEBOOK_CONTENT_TYPE,
+                                    if_generation_match=generation)
+            return listed_blob.name, 'updated', None
+        except (gexceptions.PreconditionFailed, gexceptions.NotFound) as e:
+            # changed or removed since it was listed
+            return listed_blob.name, 'conflict', str(e)
+        except Exception as e:
+            return listed_blob.name, 'failed', str(e)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(blobs)))) as executor:
+        for blob_name, status, error in executor.map(rewrite_notebook, blobs):
+            if status == 'conflict':
+                logger.warning('gs://%s/%s was modified while it was being updated, not overwriting it - %s', bucket_name, blob_name, error)
+            elif status == 'failed':
+                logger.error('gs://%s/%s could not be updated - %s', bucket_name, blob_name, error)
+            results.append((blob_name, status, error))
+    return results
+
+
 def format_timedelta(time_delta, hours_thresh):
     ''' returns HTML '''
     # check if it took too long, in which case flag to highlight in html
@@ -1,16 +1,137 @@
 import os
 import json
 import argparse
+import threading
+import time
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
 from firecloud import api as fapi
 from firecloud import errors as ferrors
-from update_workspace_dd import run_subprocess, update_attributes, update_entities, update_notebooks
+from google.cloud import storage as gcs
+from update_workspace_dd import update_attributes, update_entities, update_notebooks
 
 
-def copy_multiple(df, set_auth_domain=None):
+# stages of a hard copy, and how many workspaces may be in each stage at once when copying several workspaces
+COPY_STAGES = ['clone', 'bucket_copy', 'rewrite']
+DEFAULT_STAGE_LIMITS = {
+    'clone': 8,        # API calls only
+    'bucket_copy': 2,  # bounded, as this is where the bandwidth goes
+    'rewrite': 4,      # attribute, entity and notebook rewrites
+}
+DEFAULT_MAX_CONCURRENT_COPIES = 8
+
+# bucket replication: only the object fields needed to compare source and destination are listed
+REPLICATION_LIST_FIELDS = 'items(name,size,crc32c,generation),nextPageToken'
+DEFAULT_BUCKET_COPY_WORKERS = 16 # objects copied at once within a bucket
+REPLICATION_PROGRESS_INTERVAL = 30 # seconds
+
+# only the parts of the workspace descriptors that hard_copy needs, requested with `fields=`
+ORIGINAL_WORKSPACE_FIELDS = 'workspace.bucketName,workspace.authorizationDomain'
+NEW_WORKSPACE_FIELDS = 'workspace.bucketName,workspace.attributes'
+
+STATUS_COLUMNS = ['original_project', 'original_workspace', 'new_project', 'new_workspace',
+                  'stage', 'status', 'started', 'finished', 'error']
+
+
+class CopyStatusTable:
+    """ per-workspace progress of copy_multiple, rewritten to status_tsv (if given) on every change
+    so a long batch can be followed while it runs
+    """
+
+    def __init__(self, df, status_tsv=None):
+        self.status_tsv = status_tsv
+        self.lock = threading.Lock()
+        self.rows = [{'original_project': row['original_project'],
+                      'original_workspace': row['original_workspace'],
+                      'new_project': row['new_project'],
+                      'new_workspace': row['new_workspace'],
+                      'stage': None, 'status': 'queued', 'started': None, 'finished': None, 'error': None}
+                     for _, row in df.iterrows()]
+        self._write()
+
+    def update(self, i, **fields):
+        with self.lock:
+            self.rows[i].update(fields)
+            self._write()
+
+    def _write(self):
+        if self.status_tsv is None:
+            return
+        tmp_path = self.status_tsv + '.tmp'
+        self.to_dataframe().to_csv(tmp_path, sep='\t', index=False)
+        os.replace(tmp_path, self.status_tsv)
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.rows, columns=STATUS_COLUMNS)
+
+
+def read_copy_status(status_tsv):
+    """ read a status_tsv written by an earlier copy_multiple run; returns a dict of
+    (original_project, original_workspace, new_project, new_workspace): row, empty if there is no such file
+    """
+    if status_tsv is None or not os.path.exists(status_tsv):
+        return {}
+    status_df = pd.read_csv(status_tsv, sep='\t', dtype=str, keep_default_na=False)
+    return {(row['original_project'], row['original_workspace'], row['new_project'], row['new_workspace']): row.to_dict()
+            for _, row in status_df.iterrows()}
+
+
+def get_workspace_descriptor(workspace_project, workspace_name, fields=None):
+    """ get the workspace json, limited to fields (a comma-delimited list, e.g. 'workspace.bucketName') """
+    response = fapi.get_workspace(workspace_project, workspace_name, fields=fields)
+    if response.status_code not in [200]:
+        raise ferrors.FireCloudServerError(response.status_code, response.content)
+    return response.json()
+
+
+class WorkspaceDescriptors:
+    """ fetches each workspace's descriptor (limited to fields) at most once, shared across threads, so
+    a workspace copied to several new workspaces is only fetched once per run
+    """
+
+    def __init__(self, fields=None):
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.descriptors = {}
+
+    def get(self, workspace_project, workspace_name):
+        key = (workspace_project, workspace_name)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self.descriptors:
+                self.descriptors[key] = get_workspace_descriptor(workspace_project, workspace_name, self.fields)
+            return self.descriptors[key]
+
+
+@contextmanager
+def copy_stage(stage, stage_limits=None, report_stage=None):
+    """ run a stage of hard_copy once there's a free slot for it in stage_limits (a dict of stage: semaphore) """
+    limit = stage_limits.get(stage) if stage_limits else None
+
+    if report_stage is not None:
+        report_stage(stage, 'waiting' if limit is not None else 'running')
+    with (limit if limit is not None else nullcontext()):
+        if report_stage is not None and limit is not None:
+            report_stage(stage, 'running')
+        yield
+
+
+def copy_multiple(df, set_auth_domain=None, max_concurrent_copies=DEFAULT_MAX_CONCURRENT_COPIES, stage_limits=None, status_tsv=None,
+                  bucket_copy_workers=DEFAULT_BUCKET_COPY_WORKERS, resume=False):
     """ df is a pandas dataframe containing one row per workspace to be cloned. 
     the columns in this dataframe must include: original_workspace, original_project, new_project
     if the column 'new_workspace' is not present, the new workspaces will be named the same as the original workspaces
+
+    up to max_concurrent_copies workspaces are copied at once, with each stage of the copy further limited by
+    stage_limits (a dict of stage: max workspaces in that stage, defaulting to DEFAULT_STAGE_LIMITS).
+    per-workspace progress is kept in a status table, written to status_tsv if given. a workspace that fails
+    is recorded as failed and does not stop the others. with resume, copies into new workspaces that already
+    exist are continued (see hard_copy); if status_tsv is left from an earlier run, workspaces it records as
+    copied are skipped and the others restart at the stage they last reached.
     """
     n_workspaces_to_copy = len(df)
 
@@ -18,34 +139,111 @@ def copy_multiple(df, set_auth_domain=None):
     if 'new_workspace' not in list(df.columns):
         df['new_workspace'] = df['original_workspace']
 
-    copy_status = [] 
-    copy_status_text = []
+    stage_limits = {**DEFAULT_STAGE_LIMITS, **(stage_limits or {})}
+    stage_semaphores = {stage: threading.BoundedSemaphore(max(1, limit)) for stage, limit in stage_limits.items()}
+    # read before the status table overwrites status_tsv
+    previous_status = read_copy_status(status_tsv) if resume else {}
+    status_table = CopyStatusTable(df, status_tsv)
+    original_descriptors = WorkspaceDescriptors(ORIGINAL_WORKSPACE_FIELDS)
 
-    for i in range(n_workspaces_to_copy):
+    def copy_one(i):
         original_workspace = df.loc[i]['original_workspace']
         original_project = df.loc[i]['original_project']
         new_workspace = df.loc[i]['new_workspace']
         new_project = df.loc[i]['new_project']
 
+        def report_stage(stage, status):
+            status_table.update(i, stage=stage, status=status)
+
+        # pick up where an earlier run left this workspace: the stage it failed (or was interrupted) in
+        previous = previous_status.get((original_project, original_workspace, new_project, new_workspace), {})
+        if previous.get('status') == 'copy successful':
+            print(f'\nSkipping {original_project}/{original_workspace} to {new_project}/{new_workspace}: already copied')
+            status_table.update(i, **{column: previous[column] or None for column in ['status', 'started', 'finished']})
+            return previous['status']
+        start_stage = previous.get('stage') if previous.get('stage') in COPY_STAGES else COPY_STAGES[0]
+
         print(f'\nPreparing to copy {original_project}/{original_workspace} to {new_project}/{new_workspace} ...')
-        result = hard_copy(original_workspace, original_project, new_workspace, new_project, set_auth_domain)
-        copy_status.append(result)
-        copy_status_text.append(f'{result} : {original_project}/{original_workspace} to {new_project}/{new_workspace}')
-    
-    # todo: save this?
+        status_table.update(i, status='running', started=datetime.now().isoformat(timespec='seconds'))
+        try:
+            result = hard_copy(original_workspace, original_project, new_workspace, new_project, set_auth_domain,
+                               stage_limits=stage_semaphores, report_stage=report_stage, bucket_copy_workers=bucket_copy_workers,
+                               original_workspace_descriptor=original_descriptors.get(original_project, original_workspace),
+                               resume=resume, start_stage=start_stage)
+            status_table.update(i, stage=None, status=result, finished=datetime.now().isoformat(timespec='seconds'))
+        except Exception as e:
+            print(f'\nERROR copying {original_project}/{original_workspace} to {new_project}/{new_workspace}: {e}')
+            result = 'failed'
+            status_table.update(i, status=result, error=str(e), finished=datetime.now().isoformat(timespec='seconds'))
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrent_copies, n_workspaces_to_copy))) as executor:
+        copy_status = list(executor.map(copy_one, range(n_workspaces_to_copy)))
+
+    copy_status_text = []
+    for i, result in enumerate(copy_status):
+        copy_status_text.append(f"{result} : {df.loc[i]['original_project']}/{df.loc[i]['original_workspace']} to {df.loc[i]['new_project']}/{df.loc[i]['new_workspace']}")
+
     df['copy_status']=copy_status
 
     print('\n'.join(copy_status_text))
 
+    return status_table.to_dataframe()
+
+
+def hard_copy(original_workspace, original_project, new_workspace, new_project, set_auth_domain=None, stage_limits=None, report_stage=None,
+              bucket_copy_workers=DEFAULT_BUCKET_COPY_WORKERS, original_workspace_descriptor=None, resume=False, start_stage=COPY_STAGES[0]):
+    # stage_limits and report_stage are used by copy_multiple to schedule concurrent copies, see copy_stage
+    # if the new workspace already exists, the copy stops there - unless resume is set, in which case the bucket copy
+    # (which skips objects already copied) and the rewrites are run again, e.g. to finish a copy that failed part way.
+    # start_stage skips the stages before it, for a new workspace that an earlier run got that far with
+    start_stage_index = COPY_STAGES.index(start_stage)
+    with copy_stage('clone', stage_limits, report_stage):
+        # each workspace's descriptor is fetched once (with only the fields needed) and shared by every step below
+        if original_workspace_descriptor is None:
+            original_workspace_descriptor = get_workspace_descriptor(original_project, original_workspace, ORIGINAL_WORKSPACE_FIELDS)
 
-def hard_copy(original_workspace, original_project, new_workspace, new_project, set_auth_domain=None):
-    # try:
+        result = None
+        if start_stage_index <= COPY_STAGES.index('clone'):
+            result = clone_workspace(original_workspace, original_project, new_workspace, new_project, set_auth_domain,
+                                     original_workspace_descriptor=original_workspace_descriptor)
+        if result is not None:
+            if not resume:
+                return result
+            print(f'Resuming copy into existing workspace {new_project}/{new_workspace}')
+
+        new_workspace_descriptor = get_workspace_descriptor(new_project, new_workspace, NEW_WORKSPACE_FIELDS)
+
+        # get bucket info for original and new workspace
+        original_bucket = original_workspace_descriptor['workspace']['bucketName']
+        new_bucket = new_workspace_descriptor['workspace']['bucketName']
+
+    # copy bucket over
+    if start_stage_index <= COPY_STAGES.index('bucket_copy'):
+        with copy_stage('bucket_copy', stage_limits, report_stage):
+            replicate_bucket(original_bucket, new_bucket, max_workers=bucket_copy_workers)
+
+    # update data references
+    with copy_stage('rewrite', stage_limits, report_stage):
+        update_attributes(new_workspace, new_project, replace_this=original_bucket, with_this=new_bucket, workspace=new_workspace_descriptor)
+        update_entities(new_workspace, new_project, replace_this=original_bucket, with_this=new_bucket)
+        update_notebooks(new_workspace, new_project, replace_this=original_bucket, with_this=new_bucket, workspace=new_workspace_descriptor)
+
+    # done
+    print(f'\nFinished copying {original_project}/{original_workspace} to {new_project}/{new_workspace}.\nCheck it out at https://app.terra.bio/#workspaces/{new_project}/{new_workspace}')
+
+    return 'copy successful'
+
+
+def clone_workspace(original_workspace, original_project, new_workspace, new_project, set_auth_domain=None, original_workspace_descriptor=None):
+    """ clone the workspace (without copying its bucket); returns 'already exists' if the new workspace
+    already exists, otherwise None
+    """
     # check for auth_domain info
     if set_auth_domain is None:
-        response = fapi.get_workspace(namespace=original_project, workspace=original_workspace)
-        if response.status_code not in [200]:
-            raise ferrors.FireCloudServerError(response.status_code, response.content)
-        authorization_domain = response.json()['workspace']['authorizationDomain']
+        if original_workspace_descriptor is None:
+            original_workspace_descriptor = get_workspace_descriptor(original_project, original_workspace, ORIGINAL_WORKSPACE_FIELDS)
+        authorization_domain = original_workspace_descriptor['workspace']['authorizationDomain']
         if len(authorization_domain) > 0:
             authorization_domain = authorization_domain[0]['membersGroupName']
     else:
@@ -65,29 +263,98 @@ def hard_copy(original_workspace, original_project, new_workspace, new_project,
     elif response.status_code not in [201]:
         raise ferrors.FireCloudServerError(response.status_code, response.content)
 
-    # get bucket info for original and new workspace
-    original_bucket = fapi.get_workspace(original_project, original_workspace).json()['workspace']['bucketName']
-    new_bucket = fapi.get_workspace(new_project, new_workspace).json()['workspace']['bucketName']
-    
-    # copy bucket over
-    bucket_files = run_subprocess(['gsutil', 'ls', 'gs://' + original_bucket + '/'], 'Error listing bucket contents')
-    if len(bucket_files)>0:
-        gsutil_args = ['gsutil', '-m', 'rsync', '-r', 'gs://' + original_bucket, 'gs://' + new_bucket]
-        bucket_files = run_subprocess(gsutil_args, 'Error copying over original bucket to clone bucket')
-    
-    # update data references
-    update_attributes(new_workspace, new_project, replace_this=original_bucket, with_this=new_bucket)
-    update_entities(new_workspace, new_project, replace_this=original_bucket, with_this=new_bucket)
-    update_notebooks(new_workspace, new_project, replace_this=original_bucket, with_this=new_bucket)
+    return None
 
-    # done
-    print(f'\nFinished copying {original_project}/{original_workspace} to {new_project}/{new_workspace}.\nCheck it out at https://app.terra.bio/#workspaces/{new_project}/{new_workspace}')
 
-    return 'copy successful'
+def list_bucket_objects(storage_client, bucket_name):
+    """ returns a dict of object name: blob for every object in a bucket, listing only REPLICATION_LIST_FIELDS """
+    return {blob.name: blob for blob in storage_client.list_blobs(bucket_name, fields=REPLICATION_LIST_FIELDS)}
+
+
+def replicate_bucket(source_bucket, destination_bucket, max_workers=DEFAULT_BUCKET_COPY_WORKERS, storage_client=None):
+    """ copy every object in source_bucket to destination_bucket, like `gsutil -m rsync -r` (without deletes)
+
+    both buckets are listed at the same time and compared by name and crc32c, so objects already present in
+    the destination are skipped - which also makes it safe to rerun an interrupted copy. the remaining objects
+    are copied with server-side rewrites, up to max_workers at a time, and progress is reported in objects
+    and bytes per second.
+
+    a destination object is only written if it is unchanged since it was listed (or still doesn't exist), so
+    nothing written to the new bucket in the meantime is overwritten. raises RuntimeError if any object
+    could not be copied, after attempting all of them.
+    """
+    storage_client = storage_client or gcs.Client()
+
+    print(f'Listing gs://{source_bucket} and gs://{destination_bucket} ...')
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        source_listing = executor.submit(list_bucket_objects, storage_client, source_bucket)
+        destination_listing = executor.submit(list_bucket_objects, storage_client, destination_bucket)
+        source_objects = source_listing.result()
+        destination_objects = destination_listing.result()
+
+    to_copy = []
+    for name, source_blob in source_objects.items():
+        destination_blob = destination_objects.get(name)
+        if destination_blob is None:
+            to_copy.append((source_blob, 0)) # generation 0: only if it still doesn't exist
+        elif destination_blob.crc32c != source_blob.crc32c or destination_blob.size != source_blob.size:
+            to_copy.append((source_blob, destination_blob.generation))
+
+    n_skipped = len(source_objects) - len(to_copy)
+    bytes_to_copy = sum(source_blob.size or 0 for source_blob, _ in to_copy)
+    print(f'{len(source_objects)} objects in gs://{source_bucket}: {n_skipped} already in gs://{destination_bucket}, '
+          f'{len(to_copy)} to copy ({bytes_to_copy} bytes)')
+    if not to_copy:
+        return {'n_objects': len(source_objects), 'n_skipped': n_skipped, 'n_copied': 0, 'n_failed': 0, 'bytes_copied': 0, 'seconds': 0}
+
+    source = storage_client.bucket(source_bucket)
+    destination = storage_client.bucket(destination_bucket)
+
+    def copy_object(source_blob, destination_generation):
+        destination_blob = destination.blob(source_blob.name)
+        # large or cross-location objects can take several rewrite calls, each picking up from the last
+        token, bytes_rewritten, total_bytes = destination_blob.rewrite(source.blob(source_blob.name),
+                                                                       if_generation_match=destination_generation)
+        while token is not None:
+            token, bytes_rewritten, total_bytes = destination_blob.rewrite(source.blob(source_blob.name), token=token,
+                                                                           if_generation_match=destination_generation)
+        return total_bytes
+
+    n_copied = 0
+    bytes_copied = 0
+    failures = []
+    start = time.time()
+    last_report = start
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(to_copy)))) as executor:
+        futures = {executor.submit(copy_object, source_blob, generation): source_blob for source_blob, generation in to_copy}
+        for future in as_completed(futures):
+            source_blob = futures[future]
+            try:
+                bytes_copied += future.result()
+                n_copied += 1
+            except Exception as e:
+                failures.append((source_blob.name, str(e)))
+                print(f'  ERROR copying gs://{source_bucket}/{source_blob.name}: {e}')
+
+            now = time.time()
+            if now - last_report >= REPLICATION_PROGRESS_INTERVAL:
+                last_report = now
+                elapsed = now - start
+                print(f'  copied {n_copied}/{len(to_copy)} objects, {bytes_copied}/{bytes_to_copy} bytes '
+                      f'({n_copied / elapsed:.1f} objects/s, {bytes_copied / elapsed / 1e6:.1f} MB/s)')
+
+    elapsed = max(time.time() - start, 1e-6)
+    print(f'Copied {n_copied} objects ({bytes_copied} bytes) from gs://{source_bucket} to gs://{destination_bucket} in {elapsed:.0f}s '
+          f'({n_copied / elapsed:.1f} objects/s, {bytes_copied / elapsed / 1e6:.1f} MB/s)')
+
+    if failures:
+        raise RuntimeError(f'{len(failures)} objects could not be copied from gs://{source_bucket} to gs://{destination_bucket}; '
+                           f'rerun with --resume to retry only these, e.g. {failures[0][0]}: {failures[0][1]}')
+
+    return {'n_objects': len(source_objects), 'n_skipped': n_skipped, 'n_copied': n_copied, 'n_failed': len(failures),
+            'bytes_copied': bytes_copied, 'seconds': elapsed}
 
-    # except Exception as e:
-    #     print("Exited with " + str(e))
-    #     return e.output
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='')
@@ -99,13 +366,21 @@ if __name__ == "__main__":
     parser.add_argument('--set_auth_domain', default=None, help='authorization domain to set; if None, will copy auth domain of original workspace; if [], will set NO authorization domain')
 
     parser.add_argument('--tsv_path', type=str, default=None, help='path to tsv file that contains information about workspaces to copy')
+    parser.add_argument('--max_concurrent_copies', type=int, default=DEFAULT_MAX_CONCURRENT_COPIES, help='maximum number of workspaces (from --tsv_path) to copy at once')
+    parser.add_argument('--max_concurrent_bucket_copies', type=int, default=DEFAULT_STAGE_LIMITS['bucket_copy'], help='maximum number of workspace buckets to copy at once')
+    parser.add_argument('--bucket_copy_workers', type=int, default=DEFAULT_BUCKET_COPY_WORKERS, help='number of objects to copy at once within each workspace bucket')
+    parser.add_argument('--status_tsv', type=str, default=None, help='path to a tsv file to keep updated with the progress of each workspace (from --tsv_path)')
+    parser.add_argument('--resume', action='store_true', help='if a new workspace already exists, continue copying into it (bucket copy and rewrites) instead of skipping it, e.g. to finish a copy that failed part way. with an existing --status_tsv, workspaces it records as copied are skipped and the others restart at the stage they failed in')
 
     args = parser.parse_args()
 
     if args.tsv_path:
         df = pd.read_csv(args.tsv_path,header=0,delimiter='\t')
-        copy_multiple(df, args.set_auth_domain)
+        copy_multiple(df, args.set_auth_domain, max_concurrent_copies=args.max_concurrent_copies,
+                      stage_limits={'bucket_copy': args.max_concurrent_bucket_copies}, status_tsv=args.status_tsv,
+                      bucket_copy_workers=args.bucket_copy_workers, resume=args.resume)
     else:
         if args.new_workspace is None:
             args.new_workspace = args.original_workspace
-        hard_copy(args.original_workspace, args.original_project, args.new_workspace,args.new_project, args.set_auth_domain)
+        hard_copy(args.original_workspace, args.original_project, args.new_workspace,args.new_project, args.set_auth_domain,
+                  bucket_copy_workers=args.bucket_copy_workers, resume=args.resume)
@@ -0,0 +1,326 @@
+"""Benchmark mop_workspace.mop on a synthetic workspace without touching Terra or GCS.
+
+Synthetic entity tables and bucket listings are generated on the fly from their index (nothing is
+held in memory), served by an in-process fake Rawls and fake GCS client, and mop is run against them
+with deletions going to the fake bucket. Wall time per phase, peak memory and API call counts are
+reported so changes to mop can be compared at 1M or 10M blobs.
+
+Usage:
+    > python3 benchmark_mop.py --n-blobs 1000000 --reference-ratio 0.1 --depth 2
+"""
+import argparse
+import json
+import resource
+import threading
+import time
+
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+import mop_workspace
+
+
+BUCKET = "fc-benchmark-bucket"
+PAGE_SIZE = 1000  # objects per list page, as returned by GCS
+
+
+class SyntheticWorkspace:
+    """Deterministic layout of a Terra workspace bucket, computed from blob indices.
+
+    Blobs are laid out as submissions/<submission>/wf/<workflow>/call-<c>/[shard-<k>/...]/<file>,
+    with `files_per_call` files per call directory and `calls_per_submission` calls per submission.
+    Every round(1 / reference_ratio)-th call directory has one sample entity referencing its outputs.
+    Creation times are spread evenly over the last `max_age_weeks` weeks.
+    """
+    def __init__(self, n_blobs, reference_ratio, depth, files_per_call, calls_per_submission, max_age_weeks):
+        self.n_blobs = n_blobs
+        self.depth = depth
+        self.files_per_call = files_per_call
+        self.calls_per_submission = calls_per_submission
+        self.blobs_per_submission = files_per_call * calls_per_submission
+        self.n_submissions = -(-n_blobs // self.blobs_per_submission)
+        self.reference_period = max(1, round(1 / reference_ratio)) if reference_ratio > 0 else 0
+        self.refs_per_submission = (-(-calls_per_submission // self.reference_period)
+                                    if self.reference_period else 0)
+        self.n_entities = self.n_submissions * self.refs_per_submission
+        self.max_age = timedelta(weeks=max_age_weeks)
+        self.now = datetime.now(timezone.utc)
+
+    @staticmethod
+    def submission_id(submission):
+        return "{:08x}-0000-4000-8000-{:012x}".format(submission, submission)
+
+    def call_directory(self, submission, call):
+        shards = "".join("shard-{}/".format((call + level) % 7) for level in range(self.depth))
+        return "submissions/{}/wf/{:032x}/call-{}/{}".format(self.submission_id(submission), submission, call, shards)
+
+    @staticmethod
+    def file_name(file_index):
+        # the first files of each call are ones mop never deletes
+        if file_index == 0:
+            return "stdout"
+        if file_index == 1:
+            return "stderr"
+        return "out{}.bam".format(file_index)
+
+    def blob(self, index):
+        submission, rest = divmod(index, self.blobs_per_submission)
+        call, file_index = divmod(rest, self.files_per_call)
+        name = self.call_directory(submission, call) + self.file_name(file_index)
+        # spread creation times evenly (but not in listing order) over the age range
+        age = self.max_age * (((index * 7919) % 1000) / 1000)
+        return name, 1024 * (file_index + 1), self.now - age, index + 1
+
+    def entity(self, index):
+        submission, ref = divmod(index, self.refs_per_submission)
+        call_directory = "gs://{}/{}".format(BUCKET, self.call_directory(submission, ref * self.reference_period))
+        outputs = [call_directory + self.file_name(f) for f in range(2, min(self.files_per_call, 5))]
+        return {"name": "sample_{}".format(index), "entityType": "sample",
+                "attributes": {"sample_id": "sample_{}".format(index),
+                               "bam": outputs[0] if outputs else None,
+                               "extra_outputs": {"itemsType": "AttributeValue", "items": outputs[1:]}}}
+
+
+class ApiCounter:
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.timestamps = dict()
+        self._lock = threading.Lock()
+
+    def record(self, call):
+        with self._lock:
+            self.counts[call] += 1
+            self.timestamps.setdefault(call, time.perf_counter())
+
+
+class FakeResponse:
+    def __init__(self, body, status_code=200):
+        self._body = body
+        self.status_code = status_code
+        self.text = ""
+
+    def json(self):
+        return self._body
+
+
+class FakeRawls:
+    """Stands in for `firecloud.api` with the calls mop makes."""
+    def __init__(self, synthetic, counter):
+        self.synthetic = synthetic
+        self.counter = counter
+
+    @staticmethod
+    def _check_response_code(response, code):
+        if response.status_code != code:
+            raise ValueError("unexpected status {}".format(response.status_code))
+
+    def get_workspace(self, namespace, workspace, *args, **kwargs):
+        self.counter.record("rawls.get_workspace")
+        return FakeResponse({"workspace": {"name": workspace, "namespace": namespace, "bucketName": BUCKET,
+                                           "lastModified": "2020-01-01T00:00:00.000Z", "attributes": {}}})
+
+    def list_entity_types(self, namespace, workspace):
+        self.counter.record("rawls.list_entity_types")
+        if not self.synthetic.n_entities:
+            return FakeResponse({})
+        return FakeResponse({"sample": {"count": self.synthetic.n_entities, "idName": "sample_id",
+                                        "attributeNames": ["sample_id", "bam", "extra_outputs"]}})
+
+    def get_entities_query(self, namespace, workspace, etype, page=1, page_size=100, **kwargs):
+        self.counter.record("rawls.get_entities_query")
+        start = (page - 1) * page_size
+        stop = min(start + page_size, self.synthetic.n_entities)
+        return FakeResponse({"resultMetadata": {"filteredPageCount": -(-self.synthetic.n_entities // page_size),
+                                                "filteredCount": self.synthetic.n_entities},
+                             "results": [self.synthetic.entity(i) for i in range(start, stop)]})
+
+    def list_submissions(self, namespace, workspace):
+        self.counter.record("rawls.list_submissions")
+        return FakeResponse([{"submissionId": self.synthetic.submission_id(s), "status": "Done"}
+                             for s in range(self.synthetic.n_submissions)])
+
+
+class FakeBlob:
+    __slots__ = ("name", "size", "time_created", "updated", "generation")
+
+    def __init__(self, name, size=None, time_created=None, generation=None):
+        self.name = name
+        self.size = size
+        self.time_created = time_created
+        self.updated = time_created
+        self.generation = generation
+
+
+class FakePage(list):
+    @property
+    def remaining(self):
+        return len(self)
+
+
+class FakeBlobIterator:
+    def __init__(self, synthetic, counter, start, stop):
+        self.synthetic = synthetic
+        self.counter = counter
+        self.start = start
+        self.stop = stop
+
+    @property
+    def pages(self):
+        for page_start in range(self.start, self.stop, PAGE_SIZE):
+            self.counter.record("gcs.list_page")
+            yield FakePage(FakeBlob(*self.synthetic.blob(i))
+                           for i in range(page_start, min(page_start + PAGE_SIZE, self.stop)))
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+
+class FakeBucket:
+    def __init__(self, name, counter):
+        self.name = name
+        self.counter = counter
+
+    def blob(self, blob_name, generation=None):
+        return FakeBlob(blob_name, generation=generation)
+
+    def delete_blobs(self, blobs, on_error=None, **kwargs):
+        for _ in blobs:
+            self.counter.record("gcs.delete")
+
+    def delete_blob(self, blob_name, **kwargs):
+        self.counter.record("gcs.delete")
+
+
+class FakeStorage:
+    """Stands in for the `google.cloud.storage` module used by mop_workspace."""
+    __version__ = "benchmark"
+
+    def __init__(self, synthetic, counter):
+        storage = self
+
+        class Client:
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def get_bucket(self, bucket_name):
+                storage.counter.record("gcs.get_bucket")
+                return FakeBucket(bucket_name, storage.counter)
+
+            def bucket(self, bucket_name):
+                return FakeBucket(bucket_name, storage.counter)
+
+            def list_blobs(self, bucket_name, prefix=None, **kwargs):
+                return storage.list_blobs(prefix)
+
+        self.Client = Client
+        self.synthetic = synthetic
+        self.counter = counter
+
+    def list_blobs(self, prefix):
+        if not prefix:
+            return FakeBlobIterator(self.synthetic, self.counter, 0, self.synthetic.n_blobs)
+        # incremental mops list one submission directory at a time
+        for submission in range(self.synthetic.n_submissions):
+            if prefix == "submissions/{}/".format(self.synthetic.submission_id(submission)):
+                start = submission * self.synthetic.blobs_per_submission
+                return FakeBlobIterator(self.synthetic, self.counter, start,
+                                        min(start + self.synthetic.blobs_per_submission, self.synthetic.n_blobs))
+        return FakeBlobIterator(self.synthetic, self.counter, 0, 0)
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.seconds = defaultdict(float)
+
+    def wrap(self, phase, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds[phase] += time.perf_counter() - start
+        return timed
+
+
+def run_benchmark(synthetic, weeks_old, manifest_path=None, spill_dir=None, save_dir="mop_benchmark_data"):
+    """Run mop once against the fakes and return a dict of timings, peak memory and API call counts."""
+    counter = ApiCounter()
+    timer = PhaseTimer()
+
+    # (owner, attribute, phase) of everything to instrument; originals are restored afterwards
+    patches = [(mop_workspace, "fapi", None), (mop_workspace, "storage", None),
+               (mop_workspace, "list_bucket_files", "listing"),
+               (mop_workspace.CompactBlobListing, "finalize", "listing"),
+               (mop_workspace.ReferencedPathIndex, "classify_listing", "classification"),
+               (mop_workspace, "deletable_mask", "classification"),
+               (mop_workspace, "delete_files", "deletion")]
+    originals = [(owner, attribute, getattr(owner, attribute)) for owner, attribute, _ in patches]
+    for owner, attribute, phase in patches:
+        if phase:
+            setattr(owner, attribute, timer.wrap(phase, getattr(owner, attribute)))
+    mop_workspace.fapi = FakeRawls(synthetic, counter)
+    mop_workspace.storage = FakeStorage(synthetic, counter)
+
+    start = time.perf_counter()
+    try:
+        mop_workspace.mop("benchmark-project", "benchmark-workspace", include=None, exclude=None, dry_run=False,
+                          save_dir=save_dir, yes=True, verbose=0, weeks_old=weeks_old,
+                          manifest_path=manifest_path, spill_dir=spill_dir)
+    finally:
+        total = time.perf_counter() - start
+        for owner, attribute, original in originals:
+            setattr(owner, attribute, original)
+
+    # the entity scan runs from listing the entity types until the submissions are requested,
+    # which includes building the referenced-path index from the streamed references
+    timer.seconds["entity scan"] = (counter.timestamps.get("rawls.list_submissions", start)
+                                    - counter.timestamps.get("rawls.list_entity_types", start))
+    return {
+        "n_blobs": synthetic.n_blobs,
+        "n_entities": synthetic.n_entities,
+        "phase_seconds": {phase: round(timer.seconds[phase], 3)
+                          for phase in ("entity scan", "listing", "classification", "deletion")},
+        "total_seconds": round(total, 3),
+        # ru_maxrss is reported in KiB on Linux
+        "peak_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "api_calls": dict(sorted(counter.counts.items()))
+    }
+
+
+def print_report(result):
+    print("mop benchmark: {} blobs, {} entities".format(result["n_blobs"], result["n_entities"]))
+    for phase, seconds in result["phase_seconds"].items():
+        print("  {:<16}{:>10.3f} s".format(phase, seconds))
+    print("  {:<16}{:>10.3f} s".format("total", result["total_seconds"]))
+    print("  {:<16}{:>10.1f} MiB".format("peak RSS", result["peak_rss_mib"]))
+    for call, count in result["api_calls"].items():
+        print("  {:<28}{:>10}".format(call, count))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark mop_workspace.mop against a synthetic workspace.')
+
+    parser.add_argument('-n', '--n-blobs', type=int, default=1000000, help='number of objects in the synthetic bucket')
+    parser.add_argument('-r', '--reference-ratio', type=float, default=0.1,
+                        help='fraction of call directories referenced from the data table')
+    parser.add_argument('-d', '--depth', type=int, default=1, help='extra shard directory levels below each call')
+    parser.add_argument('--files-per-call', type=int, default=10, help='objects in each call directory')
+    parser.add_argument('--calls-per-submission', type=int, default=1000, help='call directories per submission')
+    parser.add_argument('--max-age-weeks', type=float, default=6,
+                        help='objects are created evenly over this many weeks before now')
+    parser.add_argument('--weeks-old', type=int, default=3, help='passed through to mop')
+    parser.add_argument('--manifest', type=str, default=None, help='passed through to mop')
+    parser.add_argument('--spill-dir', type=str, default=None, help='passed through to mop')
+    parser.add_argument('--save-dir', type=str, default='mop_benchmark_data', help='passed through to mop')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+
+    args = parser.parse_args()
+
+    synthetic = SyntheticWorkspace(args.n_blobs, args.reference_ratio, args.depth, args.files_per_call,
+                                   args.calls_per_submission, args.max_age_weeks)
+    result = run_benchmark(synthetic, args.weeks_old, args.manifest, args.spill_dir, args.save_dir)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
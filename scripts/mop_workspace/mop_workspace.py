@@ -1,51 +1,91 @@
 import argparse
+import glob
+import gzip
+import hashlib
+import json
+import numpy as np
 import os
+import pandas as pd
+import tempfile
+import threading
+import uuid
 
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, timezone
 from firecloud import api as fapi
+from fnmatch import translate
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud import storage  # note: please use version 2.5.0
 from io import open
 from six import string_types
 from toolz.itertoolz import partition_all
 from tqdm import tqdm
-from time import sleep
+from time import monotonic, sleep
 
 
-def _entity_paginator(namespace, workspace, etype, page_size=500,
-                      filter_terms=None, sort_direction="asc"):
-    """Pages through the get_entities_query endpoint to get all entities in
-       the workspace without crashing.
+def _iter_entity_pages(namespace, workspace, etype, page_size=500,
+                       filter_terms=None, sort_direction="asc"):
+    """Pages through the get_entities_query endpoint, yielding one page of
+       entities at a time so a whole entity type is never held in memory.
     """
 
     page = 1
-    all_entities = []
-    # Make initial request
-    r = fapi.get_entities_query(namespace, workspace, etype, page=page,
-                                page_size=page_size, sort_direction=sort_direction,
-                                filter_terms=filter_terms)
-    fapi._check_response_code(r, 200)
-
-    response_body = r.json()
-    # Get the total number of pages
-    total_pages = response_body['resultMetadata']['filteredPageCount']
-
-    # append the first set of results
-    entities = response_body['results']
-    all_entities.extend(entities)
-    # Now iterate over remaining pages to retrieve all the results
-    page = 2
+    total_pages = 1
     while page <= total_pages:
         r = fapi.get_entities_query(namespace, workspace, etype, page=page,
                                     page_size=page_size, sort_direction=sort_direction,
                                     filter_terms=filter_terms)
         fapi._check_response_code(r, 200)
-        entities = r.json()['results']
-        all_entities.extend(entities)
+
+        response_body = r.json()
+        # Get the total number of pages
+        total_pages = response_body['resultMetadata']['filteredPageCount']
+        yield response_body['results']
         page += 1
 
+
+def _entity_paginator(namespace, workspace, etype, page_size=500,
+                      filter_terms=None, sort_direction="asc"):
+    """Pages through the get_entities_query endpoint to get all entities in
+       the workspace without crashing.
+    """
+    all_entities = []
+    for entities in _iter_entity_pages(namespace, workspace, etype, page_size=page_size,
+                                       filter_terms=filter_terms, sort_direction=sort_direction):
+        all_entities.extend(entities)
     return all_entities
 
+
+def iter_referenced_files(values, bucket_prefix):
+    """Yield every string in `values` (workspace or entity attribute values) that is a path in
+    the bucket, walking basic values, 1-D arrays ({"itemsType": ..., "items": [...]}), compound
+    values, nested arrays and JSON-encoded strings in a single pass without recursion."""
+    stack = [iter(values)]
+    while stack:
+        for value in stack[-1]:
+            if isinstance(value, string_types):
+                if value.startswith(bucket_prefix):
+                    yield value
+                # arrays and objects stored as JSON strings are only parsed if they could hold a path
+                elif value[:1] in ('[', '{') and bucket_prefix in value:
+                    try:
+                        stack.append(iter((json.loads(value),)))
+                    except ValueError:
+                        continue
+                    break
+            # 1-D array attributes are dicts with the values stored in 'items'
+            elif isinstance(value, dict):
+                stack.append(iter(value['items'] if 'itemsType' in value else value.values()))
+                break
+            # Nested arrays resolve to lists
+            elif isinstance(value, list):
+                stack.append(iter(value))
+                break
+        else:
+            stack.pop()
+
+
 def _confirm_prompt(message, prompt="\nAre you sure? [y/yes (default: no)]: ",
                     affirmations=("Y", "Yes", "yes", "y")):
     """
@@ -70,22 +110,11 @@ def human_readable_size(size_in_bytes):
     return "{} {}".format(size_str, units[reduce_count])
 
 
-def list_bucket_files(project, bucket_name, referenced_files, verbose):
-    """Lists all the blobs (files) in the bucket, returns a dictionary of metadata
-    including file size, of the format
-        {full_file_path_1: {"file_name": str,
-                            "file_path": str,
-                            "submission_id": str,
-                            "size": int,
-                            "is_in_data_table": bool,
-                            "time_created": datetime},
-         full_file_path_2: {"file_name": str,
-                            "file_path": str,
-                            "submission_id": str,
-                            "size": int,
-                            "is_in_data_table": bool,
-                            "time_created": datetime}
-        }
+def list_bucket_files(project, bucket_name, verbose, listing, prefixes=None, submission_ids=None):
+    """Lists all the blobs (files) in the bucket into `listing`, a CompactBlobListing, and returns
+    the number of files added. If `prefixes` is given, only blobs under those prefixes are listed
+    (used by incremental mops to skip directories recorded in the manifest). If `submission_ids` is
+    given, only blobs in those submissions' directories are kept.
     """
     if verbose:
         print("listing contents of bucket gs://" + bucket_name)
@@ -101,71 +130,527 @@ def list_bucket_files(project, bucket_name, referenced_files, verbose):
         exit(1)
 
     # Note: Client.list_bucket_files requires at least package version 1.17.0.
-    blobs = storage_client.list_blobs(bucket_name)
+    # only request the fields mop actually uses to keep list pages small
+    fields = "items(name,size,timeCreated,updated,generation),nextPageToken"
+    if prefixes is None:
+        blob_iterators = [storage_client.list_blobs(bucket_name, fields=fields)]
+    else:
+        blob_iterators = [storage_client.list_blobs(bucket_name, prefix=prefix, fields=fields)
+                          for prefix in prefixes]
 
     if verbose:
         print("finished listing bucket contents. processing files now in chunks of 1000.")
 
-    bucket_dict = dict()
+    n_blobs = 0
+    n_files = 0
+    for blobs in blob_iterators:
+        for page in blobs.pages:  # iterating through pages is way faster than not
+            if verbose:
+                n_blobs += page.remaining
+                print(f'...processing {n_blobs} blobs', end='\r')
+            for blob in page:
+                if blob.name.endswith('/'):  # if this is a directory
+                    continue
+                if submission_ids is not None and get_submission_id(blob.name) not in submission_ids:
+                    continue
+                listing.append(blob.name, blob.size, to_micros(blob.time_created), to_micros(blob.updated),
+                               blob.generation)
+                n_files += 1
+
+    if verbose:
+        print(f'Found {n_files} files in bucket {bucket_name}')
+
+    return n_files
+
+
+def get_submission_id(blob_name):
+    """Return the submission id a blob's path belongs to (None for top-level objects)."""
+    components = blob_name.split('/', 2)
+    # support new submissions directory structure in Terra bucket
+    # new format is gs://bucket_id/submissions/submission_id/remaining_path
+    if components[0] == "submissions":
+        return components[1] if len(components) > 1 else None
+    # old format is gs://bucket_id/submission_id/remaining_path
+    return components[0] if len(components) > 1 else None
+
 
-    def extract_file_metadata(blob):
-        blob_name = blob.name
+# HELPER FUNCTIONS FOR COMPACT LISTINGS
 
-        if blob_name.endswith('/'):  # if this is a directory
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_micros(timestamp):
+    """Convert a timezone-aware datetime to integer microseconds since the epoch (-1 for None)."""
+    if timestamp is None:
+        return -1
+    return (timestamp - _EPOCH) // timedelta(microseconds=1)
+
+
+class CompactBlobListing:
+    """Columnar listing of the blobs in one bucket, costing tens of bytes per blob instead of a dict.
+
+    Bucket-relative names are stored back to back in a single utf-8 buffer indexed by int64 offsets,
+    next to int64 columns for size, time_created and updated (microseconds since the epoch) and
+    generation (-1 where unknown). Rows are accumulated in chunks; with `spill_dir`, chunks are written
+    to disk and the final columns are memory-mapped, so resident memory stays bounded by the chunk size.
+    Call `finalize` once all rows are appended.
+    """
+    COLUMNS = ('size', 'time_created', 'updated', 'generation')
+
+    def __init__(self, bucket_name, spill_dir=None, chunk_size=100000):
+        self.bucket_name = bucket_name
+        self.bucket_prefix = "gs://" + bucket_name + "/"
+        self.spill_dir = spill_dir
+        self.chunk_size = chunk_size
+        self.names = None
+        self.offsets = None
+        self.columns = dict()
+        self._rows = []
+        self._chunks = []
+
+    def append(self, name, size, time_created, updated=-1, generation=None):
+        """Add a blob. Times are microseconds since the epoch, see `to_micros`."""
+        self._rows.append((name.encode('utf-8'), 0 if pd.isna(size) else int(size), time_created, updated,
+                           -1 if generation is None else int(generation)))
+        if len(self._rows) >= self.chunk_size:
+            self._flush()
+
+    def append_columns(self, names, lengths, columns):
+        """Add many blobs at once: `names` is a uint8 array of their utf-8 names back to back, `lengths`
+        the length of each name and `columns` a dict of int64 arrays, one per COLUMNS."""
+        self._flush()
+        chunk = {"names": np.asarray(names, dtype=np.uint8), "lengths": np.asarray(lengths, dtype=np.int64)}
+        for column in self.COLUMNS:
+            chunk[column] = np.asarray(columns[column], dtype=np.int64)
+        if len(chunk["lengths"]):
+            self._add_chunk(chunk)
+
+    def _flush(self):
+        if not self._rows:
+            return
+        rows = self._rows
+        self._rows = []
+        chunk = {"names": np.frombuffer(b''.join(row[0] for row in rows), dtype=np.uint8),
+                 "lengths": np.fromiter((len(row[0]) for row in rows), dtype=np.int64, count=len(rows))}
+        for i, column in enumerate(self.COLUMNS, start=1):
+            chunk[column] = np.fromiter((row[i] for row in rows), dtype=np.int64, count=len(rows))
+        self._add_chunk(chunk)
+
+    def _add_chunk(self, chunk):
+        if self.spill_dir:
+            chunk_path = os.path.join(self.spill_dir, f"listing_chunk_{len(self._chunks)}.npz")
+            np.savez(chunk_path, **chunk)
+            self._chunks.append(chunk_path)
+        else:
+            self._chunks.append(chunk)
+
+    def _allocate(self, name, dtype, shape):
+        if self.spill_dir:
+            return np.lib.format.open_memmap(os.path.join(self.spill_dir, f"listing_{name}.npy"),
+                                             mode='w+', dtype=dtype, shape=(shape,))
+        return np.empty(shape, dtype=dtype)
+
+    def finalize(self):
+        """Concatenate the accumulated chunks into the final columns."""
+        self._flush()
+        if self.spill_dir:
+            # only the sizes are needed up front, each chunk is loaded again when it's copied
+            sizes = []
+            for chunk_path in self._chunks:
+                with np.load(chunk_path) as chunk:
+                    sizes.append((len(chunk["lengths"]), len(chunk["names"])))
+        else:
+            sizes = [(len(chunk["lengths"]), len(chunk["names"])) for chunk in self._chunks]
+        n_rows = sum(n for n, _ in sizes)
+        n_bytes = sum(b for _, b in sizes)
+
+        self.names = self._allocate("names", np.uint8, n_bytes)
+        self.offsets = self._allocate("offsets", np.int64, n_rows + 1)
+        self.offsets[0] = 0
+        self.columns = {column: self._allocate(column, np.int64, n_rows) for column in self.COLUMNS}
+
+        row = 0
+        byte = 0
+        for chunk in self._chunks:
+            if self.spill_dir:
+                chunk_path = chunk
+                chunk = dict(np.load(chunk_path))
+                os.remove(chunk_path)
+            n = len(chunk["lengths"])
+            self.names[byte:byte + len(chunk["names"])] = chunk["names"]
+            self.offsets[row + 1:row + n + 1] = byte + np.cumsum(chunk["lengths"])
+            for column in self.COLUMNS:
+                self.columns[column][row:row + n] = chunk[column]
+            row += n
+            byte += len(chunk["names"])
+        self._chunks = []
+        return self
+
+    def __len__(self):
+        return 0 if self.offsets is None else len(self.offsets) - 1
+
+    def iter_names(self, start=0, stop=None):
+        """Yield the bucket-relative names of rows start..stop."""
+        stop = len(self) if stop is None else stop
+        offsets = self.offsets[start:stop + 1].tolist()
+        buffer = self.names[offsets[0]:offsets[-1]].tobytes()
+        base = offsets[0]
+        for begin, end in zip(offsets[:-1], offsets[1:]):
+            yield buffer[begin - base:end - base].decode('utf-8')
+
+    def names_at(self, rows):
+        """Bucket-relative names of the given row indices."""
+        return [self.names[self.offsets[row]:self.offsets[row + 1]].tobytes().decode('utf-8') for row in rows]
+
+    def to_frame(self, rows):
+        """Materialize the given rows as a DataFrame with the columns `deletable_mask` and deletion use."""
+        names = pd.Series(self.names_at(rows), dtype=object)
+        generations = self.columns['generation'][rows]
+        return pd.DataFrame({
+            "file_path": self.bucket_prefix + names,
+            "file_name": names.str.rsplit('/', n=1).str[-1],
+            "size": self.columns['size'][rows],
+            "time_created": pd.to_datetime(self.columns['time_created'][rows], unit='us', utc=True),
+            "generation": np.where(generations >= 0, generations, np.nan)
+        })
+
+
+# HELPER FUNCTIONS FOR INCREMENTAL MOP
+
+# submissions in these states will not write any more files to the bucket
+TERMINAL_SUBMISSION_STATUSES = ("Done", "Aborted")
+
+
+def load_manifest(manifest_path):
+    """Read a mop manifest from a local path or gs:// url. Returns None if it doesn't exist yet.
+    Paths ending in .gz are read as gzipped json. The listed objects are kept in a separate file,
+    see `add_manifest_objects_to_listing`."""
+    if manifest_path.startswith("gs://"):
+        bucket_name, blob_name = manifest_path[len("gs://"):].split("/", 1)
+        blob = storage.Client().bucket(bucket_name).blob(blob_name)
+        if not blob.exists():
+            return None
+        content = blob.download_as_bytes()
+    else:
+        if not os.path.exists(manifest_path):
             return None
+        with open(manifest_path, "rb") as infile:
+            content = infile.read()
+
+    if manifest_path.endswith(".gz"):
+        content = gzip.decompress(content)
+    return json.loads(content)
+
+
+def get_manifest_objects_path(manifest_path):
+    """The listing recorded with a manifest is kept next to it, as <manifest_path>.objects.npz."""
+    return manifest_path + ".objects.npz"
 
-        full_file_path = "gs://" + bucket_name + "/" + blob_name
-        # support new submissions directory structure in Terra bucket
-        submissions_dir = "submissions"
-        if full_file_path.split('/', 4)[3] == submissions_dir:
-            # new format is gs://bucket_id/submissions/submission_id/remaining_path
-            submission_id = full_file_path.split('/', 5)[4]
+
+def _save_file(path, write_file):
+    """Write a local path or gs:// url with `write_file(local_path)`. The file is written to a temporary
+    path first, then moved into place (local paths) or uploaded (gs:// urls), so an interrupted run never
+    leaves a truncated file behind."""
+    if path.startswith("gs://"):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = os.path.join(temp_dir, os.path.basename(path))
+            write_file(temp_path)
+            bucket_name, blob_name = path[len("gs://"):].split("/", 1)
+            storage.Client().bucket(bucket_name).blob(blob_name).upload_from_filename(temp_path)
+    else:
+        temp_path = path + ".tmp"
+        write_file(temp_path)
+        os.replace(temp_path, path)
+
+
+def save_manifest(manifest_path, manifest, listing=None, exclude_rows=()):
+    """Write a mop manifest to a local path or gs:// url. Paths ending in .gz are written gzipped.
+
+    If `listing` is given, its rows (minus `exclude_rows`) are saved column by column next to the manifest
+    (see `write_manifest_objects`), and the manifest records an id that the two files have to share to be
+    used together. Both files are replaced atomically, the listing first.
+    """
+    manifest = dict(manifest)
+    if listing is not None:
+        manifest["objects_id"] = uuid.uuid4().hex
+        _save_file(get_manifest_objects_path(manifest_path),
+                   lambda path: write_manifest_objects(path, listing, manifest["objects_id"], exclude_rows,
+                                                       compressed=manifest_path.endswith(".gz")))
+
+    def write_manifest_file(path):
+        opener = gzip.open if manifest_path.endswith(".gz") else open
+        with opener(path, "wt", encoding="utf-8") as outfile:
+            json.dump(manifest, outfile)
+    _save_file(manifest_path, write_manifest_file)
+
+
+def submission_ids_of_names(names):
+    """Vectorized `get_submission_id` for a Series of blob names (None for top-level objects)."""
+    components = names.str.split('/', n=2, expand=True).reindex(columns=[0, 1])
+    submission_ids = components[1].where(components[0] == "submissions", components[0])
+    # names without a '/' are top-level objects
+    return submission_ids.where(components[1].notna(), None)
+
+
+def write_manifest_objects(path, listing, objects_id, exclude_rows=(), compressed=False, chunk_size=250000):
+    """Save a finalized CompactBlobListing, skipping `exclude_rows` (e.g. files deleted by this mop), as the
+    .npz file of columns kept next to a manifest. Each row's submission is stored as an index into a list of
+    submission ids, so a later run can select the rows of the submissions it needs without parsing names."""
+    keep = np.ones(len(listing), dtype=bool)
+    keep[np.asarray(exclude_rows, dtype=np.int64)] = False
+    lengths = np.diff(listing.offsets)
+
+    submission_codes = dict()
+    submission_index = []
+    for start in range(0, len(listing), chunk_size):
+        rows = start + np.flatnonzero(keep[start:start + chunk_size])
+        # factorize codes top-level objects (no submission id) as -1, which picks the trailing -1 below
+        codes, uniques = pd.factorize(submission_ids_of_names(pd.Series(listing.names_at(rows), dtype=object)))
+        global_codes = np.array([submission_codes.setdefault(submission_id, len(submission_codes))
+                                 for submission_id in uniques] + [-1], dtype=np.int64)
+        submission_index.append(global_codes[codes])
+
+    columns = {column: np.asarray(listing.columns[column])[keep] for column in CompactBlobListing.COLUMNS}
+    with open(path, "wb") as outfile:
+        (np.savez_compressed if compressed else np.savez)(
+            outfile,
+            objects_id=np.array(objects_id),
+            names=np.asarray(listing.names)[np.repeat(keep, lengths)],
+            lengths=lengths[keep],
+            submission_index=np.concatenate(submission_index) if submission_index else np.zeros(0, dtype=np.int64),
+            submission_ids=np.array(list(submission_codes), dtype=str),
+            **columns)
+
+
+def add_manifest_objects_to_listing(listing, manifest_path, manifest, submission_ids):
+    """Append the objects recorded with a manifest that belong to the given submissions to a listing,
+    selecting them with a mask over the saved columns. Returns the number of files added, or None if the
+    recorded objects are missing or weren't written with this manifest."""
+    objects_path = get_manifest_objects_path(manifest_path)
+    if "objects_id" not in manifest:
+        return None
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if objects_path.startswith("gs://"):
+            bucket_name, blob_name = objects_path[len("gs://"):].split("/", 1)
+            blob = storage.Client().bucket(bucket_name).blob(blob_name)
+            if not blob.exists():
+                return None
+            local_path = os.path.join(temp_dir, os.path.basename(objects_path))
+            blob.download_to_filename(local_path)
         else:
-            # old format is gs://bucket_id/submission_id/remaining_path
-            # Splits the bucket file: "gs://bucket_Id/submission_id/file_path", by the '/' symbol
-            # and stores values in a 5 length array: ['gs:', '' , 'bucket_Id', submission_id, file_path]
-            # to extract the submission id from the 4th element (index 3) of the array
-            submission_id = full_file_path.split('/', 4)[3]
-
-        file_metadata = {
-            "file_name": blob_name.split('/')[-1],
-            "file_path": full_file_path,
-            "submission_id": submission_id,
-            "size": blob.size,
-            "is_in_data_table": full_file_path in referenced_files,
-            "time_created": blob.time_created
-        }
+            if not os.path.exists(objects_path):
+                return None
+            local_path = objects_path
 
-        return file_metadata
+        # columns are only read from the file when they're accessed
+        with np.load(local_path) as objects:
+            if str(objects["objects_id"]) != manifest["objects_id"]:
+                return None
+            wanted_codes = np.flatnonzero(np.isin(objects["submission_ids"], list(submission_ids)))
+            keep = np.isin(objects["submission_index"], wanted_codes)
+            lengths = objects["lengths"]
+            listing.append_columns(objects["names"][np.repeat(keep, lengths)], lengths[keep],
+                                   {column: objects[column][keep] for column in CompactBlobListing.COLUMNS})
+            return int(keep.sum())
 
-    n_blobs = 0
-    for page in blobs.pages:  # iterating through pages is way faster than not
-        if verbose:
-            n_blobs += page.remaining
-            print(f'...processing {n_blobs} blobs', end='\r')
-        for blob in page:
-            file_metadata = extract_file_metadata(blob)
-            if file_metadata:
-                full_file_path = file_metadata['file_path']
-                bucket_dict[full_file_path] = file_metadata
 
-    if verbose:
-        print(f'Found {len(bucket_dict)} files in bucket {bucket_name}')
+def get_entity_type_signature(entity_type_metadata):
+    """Summarize an entity type from the list_entity_types response so changes can be detected cheaply."""
+    return {"count": entity_type_metadata.get("count"),
+            "attribute_names": sorted(entity_type_metadata.get("attributeNames", []))}
+
+
+# HELPER FUNCTIONS FOR INVENTORY-BASED MOP
+
+# map column names used by Storage Insights reports and the gcs_inventory_loader BQ table to ours
+INVENTORY_COLUMNS = {"timeCreated": "time_created", "updated": "updated"}
 
-    return bucket_dict
+# files that are never deleted in a mop, regardless of include/exclude patterns
+KEEP_FILE_NAMES = ('rc', 'exec.sh', 'script', 'stderr', 'stdout', 'output')
+KEEP_FILE_SUFFIXES = ('.log', '-rc.txt')
 
 
-def delete_files_call(bucket_name, list_of_blobs_to_delete):
+def load_inventory(inventory_source, bucket_name, verbose):
+    """Load a pre-generated object inventory for the bucket instead of listing it through the API.
+
+    `inventory_source` is either a BigQuery table given as bq://project.dataset.table (e.g. the
+    gcs_inventory_loader table used by van_allen_tools/query_bucket_object_inventory.py) or the
+    path (or glob of shards) of a Storage Insights inventory report in CSV or Parquet format.
+    Returns a DataFrame with the columns file_path, file_name, submission_id, size, time_created, generation.
+    Missing sizes are read as 0; generation is NaN where the inventory doesn't record it.
+    """
+    if verbose:
+        print("loading object inventory for bucket gs://{} from {}".format(bucket_name, inventory_source))
+
+    if inventory_source.startswith("bq://"):
+        # only needed for inventories kept in BigQuery
+        from google.cloud import bigquery
+
+        table = inventory_source[len("bq://"):]
+        bqclient = bigquery.Client(project=table.split('.')[0])
+        query = f"SELECT name, size, timeCreated, generation FROM `{table}` WHERE bucket = @bucket"
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("bucket", "STRING", bucket_name)])
+        inventory_df = bqclient.query(query, job_config=job_config).result().to_dataframe()
+    else:
+        paths = sorted(glob.glob(inventory_source)) or [inventory_source]
+        inventory_df = pd.concat([pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path)
+                                  for path in paths], ignore_index=True)
+
+    inventory_df = inventory_df.rename(columns=INVENTORY_COLUMNS)
+    if 'bucket' in inventory_df.columns:
+        inventory_df = inventory_df[inventory_df['bucket'] == bucket_name]
+    if 'generation' not in inventory_df.columns:
+        inventory_df['generation'] = None
+    inventory_df['generation'] = pd.to_numeric(inventory_df['generation'], errors='coerce')
+
+    # the same object can appear in more than one inventory snapshot, keep the newest generation
+    inventory_df = inventory_df.sort_values('generation').drop_duplicates('name', keep='last')
+    # drop directory placeholder objects
+    inventory_df = inventory_df[~inventory_df['name'].str.endswith('/')]
+
+    # same submission id rules as get_submission_id, applied to the whole column
+    first_dir = inventory_df['name'].str.split('/', n=1).str[0]
+    second_dir = inventory_df['name'].str.split('/', n=2).str[1]
+
+    inventory_df = pd.DataFrame({
+        "file_path": "gs://" + bucket_name + "/" + inventory_df['name'],
+        "file_name": inventory_df['name'].str.rsplit('/', n=1).str[-1],
+        "submission_id": second_dir.where(first_dir == "submissions", first_dir),
+        "size": pd.to_numeric(inventory_df['size'], errors='coerce').fillna(0).astype(np.int64),
+        "time_created": pd.to_datetime(inventory_df['time_created'], utc=True),
+        "generation": inventory_df['generation']
+    })
+
+    if verbose:
+        print(f'Found {len(inventory_df)} files in inventory for bucket {bucket_name}')
+
+    return inventory_df
+
+
+def _globs_to_regex(globs):
+    """Combine UNIX glob-style patterns into one regex with `fnmatchcase` semantics."""
+    return '|'.join(translate(glob_pattern) for glob_pattern in globs)
+
+
+def deletable_mask(file_names, times_created, include, exclude, weeks_old):
+    """Vectorized mop filter: returns a boolean Series that is True for files old enough to delete
+    that aren't logs/return codes/scripts and that pass the include or exclude glob patterns."""
+    cutoff = pd.Timestamp.now(tz='UTC') - pd.Timedelta(weeks=weeks_old)
+    mask = pd.to_datetime(times_created, utc=True) <= cutoff
+
+    # Don't delete logs, return codes, the tool's exec.sh or script, stdout, stderr, and output
+    for suffix in KEEP_FILE_SUFFIXES:
+        mask &= ~file_names.str.endswith(suffix)
+    mask &= ~file_names.isin(KEEP_FILE_NAMES)
+
+    # fnmatch's regexes need Python's re, which pandas only uses for object (not arrow-backed) strings
+    # Only delete specified unreferenced files
+    if include:
+        mask &= file_names.astype(object).str.match(_globs_to_regex(include))
+    # Don't delete specified unreferenced files
+    elif exclude:
+        mask &= ~file_names.astype(object).str.match(_globs_to_regex(exclude))
+
+    return mask
+
+
+def get_inventory_versions(inventory_by_path, files):
+    """Look up `files` in inventory generation and time_created columns indexed by file_path; returns
+    lists of generations and creation times (microseconds since the epoch) aligned with `files`, None
+    where unknown."""
+    versions = inventory_by_path.reindex(files)
+    generations = [None if pd.isna(generation) else int(generation) for generation in versions['generation'].tolist()]
+    times_created = [None if pd.isna(time_created) else to_micros(time_created)
+                     for time_created in versions['time_created'].tolist()]
+    return generations, times_created
+
+
+class RateLimiter:
+    """Spaces out requests made from any number of threads to at most `max_qps` per second."""
+    def __init__(self, max_qps):
+        self.interval = 1.0 / max_qps
+        self._next_request = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = monotonic()
+            wait = self._next_request - now
+            self._next_request = max(self._next_request, now) + self.interval
+        if wait > 0:
+            sleep(wait)
+
+
+def delete_files_call(bucket_name, list_of_blobs_to_delete, generations=None, rate_limiter=None, times_created=None,
+                      storage_client=None):
+    """Delete blobs, only if they still have the given `generations` (None entries are deleted
+    unconditionally). Blobs without a generation but with a creation time in `times_created` (e.g. from an
+    inventory without a generation column) are looked up first and only deleted, at their live
+    generation, if they were created at that time. Returns the number of blobs kept because they changed.
+    Pass the caller's `storage_client` so concurrent calls share one client and its connection pool."""
     # don't throw an error if blob not found
     on_error = lambda blob: None
 
-    storage_client = storage.Client()
+    if storage_client is None:
+        storage_client = storage.Client()
 
     bucket = storage_client.bucket(bucket_name)
-    bucket.delete_blobs(list_of_blobs_to_delete, on_error=on_error)
+    if generations is None and times_created is None and rate_limiter is None:
+        bucket.delete_blobs(list_of_blobs_to_delete, on_error=on_error)
+        return 0
 
+    # generation-conditional deletes: if the object was overwritten since it was listed
+    # (e.g. a stale inventory), the precondition fails and the newer object is kept
+    if generations is None:
+        generations = [None] * len(list_of_blobs_to_delete)
+    if times_created is None:
+        times_created = [None] * len(list_of_blobs_to_delete)
+    n_skipped = 0
+    for blob, generation, time_created in zip(list_of_blobs_to_delete, generations, times_created):
+        if generation is None and time_created is not None:
+            if rate_limiter:
+                rate_limiter.acquire()
+            live_blob = bucket.get_blob(blob.name)
+            if live_blob is None:
+                continue
+            if to_micros(live_blob.time_created) != time_created:
+                n_skipped += 1
+                continue
+            generation = live_blob.generation
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            bucket.delete_blob(blob.name, if_generation_match=generation)
+        except NotFound:
+            pass
+        except PreconditionFailed:
+            n_skipped += 1
+    return n_skipped
+
+
+def delete_batch(bucket_name, blob_names, generations=None, rate_limiter=None, max_retries=3, times_created=None,
+                 storage_client=None):
+    """Delete one batch of blobs, retrying the whole batch on errors (already deleted blobs are
+    skipped as not found). Returns the number of blobs kept because their generation changed."""
+    if storage_client is None:
+        storage_client = storage.Client()
+    bucket = storage_client.bucket(bucket_name)
+    blobs = [bucket.blob(blob_name) for blob_name in blob_names]
 
-def delete_files(bucket_name, files_to_delete, verbose, retry=0):
+    retry = 0
+    while True:
+        try:
+            return delete_files_call(bucket_name, blobs, generations, rate_limiter, times_created, storage_client)
+        except Exception:
+            if retry >= max_retries:
+                raise
+            retry += 1
+            sleep(retry)
+
+
+def delete_files(bucket_name, files_to_delete, verbose, retry=0, generations=None, times_created=None,
+                 storage_client=None):
     # retry delete if it fails with an internal server error
     if retry > 3:
         print("WARNING: internal errors not resolved by retries. Intermediate files not deleted.")
@@ -176,7 +661,10 @@ def delete_files(bucket_name, files_to_delete, verbose, retry=0):
 
     # try to delete files
     try:
-        '''Delete files in a GCP bucket. Input is a list of full file paths to delete.'''
+        '''Delete files in a GCP bucket. Input is a list of full file paths to delete.
+        If `generations` (a list aligned with files_to_delete) is given, each file is only deleted
+        if it still has that generation; None entries are deleted unconditionally, unless `times_created`
+        gives their creation time to check first (see `delete_files_call`).'''
         n_files_to_delete = len(files_to_delete)
         if verbose:
             print(f"Preparing to delete {n_files_to_delete} files from bucket {bucket_name}")
@@ -184,48 +672,185 @@ def delete_files(bucket_name, files_to_delete, verbose, retry=0):
         # extract blob_name (full path minus bucket name)
         blob_names = [full_path.replace("gs://" + bucket_name + "/", "") for full_path in files_to_delete]
 
-        storage_client = storage.Client()
+        # one client (and connection pool) shared by every chunk and kept across retries
+        if storage_client is None:
+            storage_client = storage.Client()
 
         bucket = storage_client.bucket(bucket_name)
         blobs = [bucket.blob(blob_name) for blob_name in blob_names]
 
         CHUNK_SIZE = 100
 
+        chunked_generations = generations
+        chunked_times_created = times_created
 
         if n_files_to_delete > CHUNK_SIZE:
             chunked_blobs = list(partition_all(CHUNK_SIZE, blobs))
             n_chunks = len(chunked_blobs)
+            if chunked_generations is None:
+                chunked_generations = [None] * n_chunks
+            else:
+                chunked_generations = list(partition_all(CHUNK_SIZE, chunked_generations))
+            if chunked_times_created is None:
+                chunked_times_created = [None] * n_chunks
+            else:
+                chunked_times_created = list(partition_all(CHUNK_SIZE, chunked_times_created))
 
             if verbose:
                 print(f"Prepared {n_chunks} chunks, processing deletions in parallel.")
 
             with ThreadPoolExecutor(max_workers=50) as e:
-                list(tqdm(e.map(delete_files_call, [bucket_name]*n_chunks, chunked_blobs), total=n_chunks))
+                n_skipped = sum(tqdm(e.map(delete_files_call, [bucket_name]*n_chunks, chunked_blobs,
+                                           chunked_generations, [None]*n_chunks, chunked_times_created,
+                                           [storage_client]*n_chunks),
+                                     total=n_chunks))
 
         else:
             if verbose:
                 print(f"Deleting {n_files_to_delete} files from bucket {bucket_name}")
-            delete_files_call(bucket_name, blobs)
+            n_skipped = delete_files_call(bucket_name, blobs, chunked_generations, times_created=chunked_times_created,
+                                          storage_client=storage_client)
 
+        if n_skipped:
+            print(f"WARNING: {n_skipped} files changed since they were listed and were not deleted.")
         if verbose:
-            print(f"Successfully deleted {len(blobs)} files from bucket.")
+            print(f"Successfully deleted {len(blobs) - n_skipped} files from bucket.")
     except Exception:
         # try again
         incremented_retry = retry + 1
         print("Encountered an internal error. Retrying...")
         sleep(sleep_time)
-        return delete_files(bucket_name, files_to_delete, incremented_retry)
+        return delete_files(bucket_name, files_to_delete, verbose, incremented_retry, generations, times_created,
+                            storage_client)
 
 
 
-def get_parent_directory(filepath):
-    """Given input `gs://some/file/path/to_object.txt` returns parent directory `gs://some/file/path`.
-    If file is already at top level, the function returns bucket name"""
-    return '/'.join(filepath.split('/')[:-1])
+# reasons a file is kept, indexed by the codes returned from ReferencedPathIndex.classify_listing
+KEEP_REASONS = (None, "referenced", "sibling", "in_referenced_directory")
 
 
-def mop(project, workspace, include, exclude, dry_run, save_dir, yes, verbose, weeks_old):
-    '''Clean up unreferenced data in a workspace'''
+class _HashedNameSet:
+    """Set of strings stored as sorted 64-bit keys plus a compact name buffer.
+
+    Keys only need to be consistent within one run, so Python's 64-bit string hash is used; a key
+    match is confirmed against the stored name so a collision can't produce a false positive.
+    """
+    def __init__(self, names):
+        names = list(names)
+        keys = np.fromiter((hash(name) for name in names), dtype=np.int64, count=len(names))
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        encoded = [names[i].encode('utf-8') for i in order]
+        self._buffer = b''.join(encoded)
+        self._offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        self._offsets[1:] = np.cumsum([len(name) for name in encoded])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def contains(self, keys, names):
+        """Vectorized membership: boolean array for `names`, whose keys are `keys`."""
+        found = np.zeros(len(keys), dtype=bool)
+        if not len(self.keys):
+            return found
+        positions = np.searchsorted(self.keys, keys)
+        hits = np.flatnonzero(self.keys[np.minimum(positions, len(self.keys) - 1)] == keys)
+        for i in hits:
+            # confirm the match, checking every stored name that shares the key
+            name = names[i].encode('utf-8')
+            position = positions[i]
+            while position < len(self.keys) and self.keys[position] == keys[i]:
+                if self._buffer[self._offsets[position]:self._offsets[position + 1]] == name:
+                    found[i] = True
+                    break
+                position += 1
+        return found
+
+
+class ReferencedPathIndex:
+    """Index of the bucket paths referenced in a workspace.
+
+    Referenced gs:// urls are normalized to bucket-relative names once, then held as sorted 64-bit
+    keys (with the names kept for confirmation) together with the keys of their parent task-level
+    directories. Listings are classified in vectorized chunks with one key lookup per path component.
+    """
+    def __init__(self, bucket_name, referenced_files=()):
+        self.bucket_prefix = "gs://" + bucket_name + "/"
+        prefix_length = len(self.bucket_prefix)
+        names = set()
+        for referenced_file in referenced_files:
+            # urls outside the bucket are ignored; a trailing slash marks a directory
+            if referenced_file.startswith(self.bucket_prefix):
+                names.add(referenced_file[prefix_length:].rstrip('/'))
+        # order-independent hash of the referenced names, to tell whether references changed between mops
+        sha = hashlib.sha256()
+        for name in sorted(names):
+            sha.update(name.encode("utf-8"))
+            sha.update(b"\n")
+        self.digest = sha.hexdigest()
+        # we will not delete files in any task-level directory containing referenced files
+        directories = set(name.rpartition('/')[0] for name in names)
+        # ancestors deeper than the deepest referenced path can't be referenced
+        self._max_depth = max((name.count('/') + 1 for name in names), default=0)
+
+        self._files = _HashedNameSet(names)
+        self._directories = _HashedNameSet(directories)
+        self.n_files = len(self._files)
+        self.n_directories = len(self._directories)
+
+    def classify_names(self, names):
+        """Return an int8 array of KEEP_REASONS codes for a list of bucket-relative names:
+        0 for deletion candidates, otherwise referenced, sibling of a referenced file (shares its
+        task-level directory) or under a referenced directory."""
+        keys = np.fromiter((hash(name) for name in names), dtype=np.int64, count=len(names))
+        parents = [name.rpartition('/')[0] for name in names]
+        parent_keys = np.fromiter((hash(parent) for parent in parents), dtype=np.int64, count=len(names))
+
+        ancestor_rows = []
+        ancestors = []
+        for row, name in enumerate(names):
+            end = name.find('/')
+            depth = 1
+            while end != -1 and depth <= self._max_depth:
+                ancestor_rows.append(row)
+                ancestors.append(name[:end])
+                end = name.find('/', end + 1)
+                depth += 1
+        ancestor_keys = np.fromiter((hash(ancestor) for ancestor in ancestors), dtype=np.int64, count=len(ancestors))
+        in_referenced_directory = np.zeros(len(names), dtype=bool)
+        in_referenced_directory[np.asarray(ancestor_rows, dtype=np.int64)[self._files.contains(ancestor_keys, ancestors)]] = True
+
+        codes = np.zeros(len(names), dtype=np.int8)
+        codes[in_referenced_directory] = 3
+        codes[self._directories.contains(parent_keys, parents)] = 2
+        codes[self._files.contains(keys, names)] = 1
+        return codes
+
+    def classify_listing(self, listing, chunk_size=250000):
+        """Classify every row of a finalized CompactBlobListing, see `classify_names`."""
+        codes = np.zeros(len(listing), dtype=np.int8)
+        for start in range(0, len(listing), chunk_size):
+            stop = min(start + chunk_size, len(listing))
+            codes[start:stop] = self.classify_names(list(listing.iter_names(start, stop)))
+        return codes
+
+
+def mop(project, workspace, include, exclude, dry_run, save_dir, yes, verbose, weeks_old, manifest_path=None,
+        inventory=None, spill_dir=None):
+    '''Clean up unreferenced data in a workspace.
+
+    If `manifest_path` (local path or gs:// url) is given, the bucket listing and entity references
+    from this run are saved there, and a follow-up run only re-lists submission directories that
+    were new or still running last time and only re-scans entity types that may have changed.
+
+    If `inventory` is given (see `load_inventory`), the bucket isn't listed; candidates are selected
+    from the inventory and only deleted if their generation still matches it. Where the inventory has no
+    generation, the live object's creation time has to match the inventory's instead.
+
+    The listing is held in a CompactBlobListing; with `spill_dir` it is kept on disk instead of in memory.
+    '''
+    if manifest_path and inventory:
+        raise ValueError("A manifest and an inventory can't be used together.")
 
     # show version of google storage
     print(f"using google.cloud.storage version: {storage.__version__}")
@@ -237,142 +862,173 @@ def mop(project, workspace, include, exclude, dry_run, save_dir, yes, verbose, w
     fapi._check_response_code(r, 200)
     workspace_json = r.json()
     bucket = workspace_json['workspace']['bucketName']
-    bucket_prefix = 'gs://' + bucket
+    bucket_prefix = 'gs://' + bucket + '/'
     workspace_name = workspace_json['workspace']['name']
 
     if verbose:
         print("{} -- {}".format(workspace_name, bucket_prefix))
 
-    # Handle Basic Values, Compound data structures, and Nestings thereof
-    def update_referenced_files(referenced_files, attrs, bucket_prefix):
-        for attr in attrs:
-            # 1-D array attributes are dicts with the values stored in 'items'
-            if isinstance(attr, dict) and attr.get('itemsType') == 'AttributeValue':
-                update_referenced_files(referenced_files, attr['items'], bucket_prefix)
-            # Compound data structures resolve to dicts
-            elif isinstance(attr, dict):
-                update_referenced_files(referenced_files, attr.values(), bucket_prefix)
-            # Nested arrays resolve to lists
-            elif isinstance(attr, list):
-                update_referenced_files(referenced_files, attr, bucket_prefix)
-            elif isinstance(attr, string_types) and attr.startswith(bucket_prefix):
-                referenced_files.add(attr)
-
-    # Build a set of bucket files that are referenced in the workspace attributes and data table
-    referenced_files = set()
-    # 0. Add any files that are in workspace attributes
-    for value in workspace_json['workspace']['attributes'].values():
-        if isinstance(value, string_types) and value.startswith(bucket_prefix):
-            referenced_files.add(value)
+    manifest = None
+    if manifest_path:
+        manifest = load_manifest(manifest_path)
+        if manifest and manifest.get('bucket') != bucket:
+            print(f"WARNING: manifest {manifest_path} was written for bucket {manifest.get('bucket')}, ignoring it.")
+            manifest = None
+        if verbose:
+            print("Loaded manifest from {}".format(manifest_path) if manifest else
+                  "No usable manifest at {}, doing a full mop".format(manifest_path))
+
     # 1. Get a list of the entity types in the workspace
     r = fapi.list_entity_types(project, workspace)
     fapi._check_response_code(r, 200)
-    entity_types = r.json().keys()
-    # 2. For each entity type, request all the entities
-    for etype in entity_types:
-        if verbose:
-            print("Getting annotations for " + etype + " entities...")
-        # use the paginated version of the query
-        entities = _entity_paginator(project, workspace, etype,
-                                     page_size=1000, filter_terms=None,
-                                     sort_direction="asc")
-        for entity in entities:
-            update_referenced_files(referenced_files,
-                                    entity['attributes'].values(),
-                                    bucket_prefix)
-
+    entity_types = r.json()
+    # Rawls doesn't expose per-type modification times, so a cached type is only reused when the
+    # workspace hasn't been modified since the last run and the type's row count and columns match.
+    workspace_last_modified = workspace_json['workspace'].get('lastModified')
+    cached_entity_types = dict()
+    if manifest and manifest.get('workspace_last_modified') == workspace_last_modified:
+        cached_entity_types = manifest.get('entity_types', dict())
+    entity_snapshot = dict()
+
+    def iter_workspace_referenced_files():
+        '''Stream the bucket files referenced in the workspace attributes and data tables.'''
+        # 0. Add any files that are in workspace attributes
+        yield from iter_referenced_files(workspace_json['workspace']['attributes'].values(), bucket_prefix)
+        # 2. For each entity type, stream the entities a page at a time
+        for etype, etype_metadata in entity_types.items():
+            signature = get_entity_type_signature(etype_metadata)
+            cached = cached_entity_types.get(etype)
+            if cached and cached['signature'] == signature:
+                if verbose:
+                    print("Reusing annotations for " + etype + " entities from manifest...")
+                etype_referenced_files = cached['referenced_files']
+            else:
+                if verbose:
+                    print("Getting annotations for " + etype + " entities...")
+                # use the paginated version of the query
+                etype_referenced_files = (referenced_file
+                                          for entities in _iter_entity_pages(project, workspace, etype,
+                                                                             page_size=1000, filter_terms=None,
+                                                                             sort_direction="asc")
+                                          for entity in entities
+                                          for referenced_file in iter_referenced_files(
+                                              entity['attributes'].values(), bucket_prefix))
+            # references per type are only kept when they're needed for the manifest
+            if manifest_path:
+                etype_referenced_files = sorted(set(etype_referenced_files))
+                entity_snapshot[etype] = {"signature": signature,
+                                          "referenced_files": etype_referenced_files}
+            yield from etype_referenced_files
+
+    # we will not delete referenced files, files under referenced directories, or files in any
+    # task-level directory containing referenced files.
+    referenced_index = ReferencedPathIndex(bucket, iter_workspace_referenced_files())
     if verbose:
-        num = len(referenced_files)
+        num = referenced_index.n_files
         print("Found {} referenced files in workspace {}".format(num, workspace_name))
+        if manifest:
+            changed = "unchanged" if manifest.get('referenced_files_hash') == referenced_index.digest else "changed"
+            print("Referenced files {} since last mop".format(changed))
+        num = referenced_index.n_directories
+        print("Found {} referenced task-level directories in workspace {}".format(num, workspace_name))
 
     # Retrieve user's submission information
     user_submission_request = fapi.list_submissions(project, workspace)
     # Check if API call was successful, in the case of failure, the function will return an error
     fapi._check_response_code(user_submission_request, 200)
     # Sort user submission ids for future bucket file verification
-    submission_ids = set(item['submissionId'] for item in user_submission_request.json())
+    submissions = {item['submissionId']: item['status'] for item in user_submission_request.json()}
+    submission_ids = set(submissions)
+
+    # List files present in the bucket, keeping only files in the user's submission directories.
+    listing = CompactBlobListing(bucket, spill_dir=spill_dir)
+    if inventory:
+        inventory_df = load_inventory(inventory, bucket, verbose)
+        inventory_df = inventory_df[inventory_df['submission_id'].isin(submission_ids)]
+        # without a creation time, a file's age and version can't be checked, so it is never deleted
+        inventory_df = inventory_df[inventory_df['time_created'].notna()]
+        time_created = (inventory_df['time_created'] - _EPOCH) // pd.Timedelta(microseconds=1)
+        for file_path, size, created, generation in zip(inventory_df['file_path'], inventory_df['size'],
+                                                        time_created, inventory_df['generation']):
+            listing.append(file_path[len(listing.bucket_prefix):], size, created,
+                           generation=None if pd.isna(generation) else generation)
+        del inventory_df
+    elif manifest:
+        # submissions that had already finished at the last run won't have written anything new,
+        # so their files are taken from the manifest and only the remaining submission directories
+        # are listed. anything missed here is caught by a later full mop, never deleted wrongly.
+        finished_submissions = set(manifest.get('finished_submissions', []))
+        cached_submission_ids = submission_ids & finished_submissions
+        if add_manifest_objects_to_listing(listing, manifest_path, manifest, cached_submission_ids) is None:
+            print("WARNING: objects recorded with manifest {} are missing or out of date, listing every submission.".format(manifest_path))
+            cached_submission_ids = set()
+        prefixes = []
+        for submission_id in submission_ids - cached_submission_ids:
+            prefixes.extend(["submissions/" + submission_id + "/", submission_id + "/"])
+        if verbose:
+            print("Reusing listing of {} finished submissions, listing {} new or running submissions".format(
+                len(cached_submission_ids), len(submission_ids) - len(cached_submission_ids)))
+        list_bucket_files(project, bucket, verbose, listing, prefixes=prefixes)
+    else:
+        list_bucket_files(project, bucket, verbose, listing, submission_ids=submission_ids)
+    listing.finalize()
 
-    # we will not delete files in any task-level directory containing referenced files.
-    referenced_directories = set()
-    # get all referenced directories
-    referenced_directories = set([get_parent_directory(f) for f in referenced_files])
     if verbose:
-        num = len(referenced_directories)
-        print("Found {} referenced task-level directories in workspace {}".format(num, workspace_name))
-
-    # List files present in the bucket
-    bucket_dict = list_bucket_files(project, bucket, referenced_files, verbose)
+        print("Found {} submission-related files in bucket {}".format(len(listing), bucket))
+
+    def write_manifest(deleted_rows=()):
+        '''Record the listing and entity snapshot from this run for the next incremental mop.'''
+        if not manifest_path:
+            return
+        new_manifest = {
+            "bucket": bucket,
+            "listed_at": datetime.now().astimezone().isoformat(),
+            "workspace_last_modified": workspace_last_modified,
+            "referenced_files_hash": referenced_index.digest,
+            "finished_submissions": sorted(sid for sid, status in submissions.items()
+                                           if status in TERMINAL_SUBMISSION_STATUSES),
+            "entity_types": entity_snapshot
+        }
+        # the listing is saved column by column next to the manifest
+        save_manifest(manifest_path, new_manifest, listing, exclude_rows=deleted_rows)
+        if verbose:
+            print("Saved mop manifest to {}".format(manifest_path))
 
-    # Check to see if bucket file path contain the user's submission id
-    # to ensure deletion of files in the submission directories only.
-    submission_bucket_files = set(file_metadata['file_path'] for file_metadata in bucket_dict.values() if file_metadata['submission_id'] in submission_ids)
+    # keep only files that aren't referenced, under a referenced directory, or next to a referenced file
+    keep_reasons = referenced_index.classify_listing(listing)
+    candidate_rows = np.flatnonzero(keep_reasons == 0)
 
     if verbose:
-        num = len(submission_bucket_files)
-        print("Found {} submission-related files in bucket {}".format(num, bucket))
-
-    # Set difference shows files in bucket that aren't referenced
-    unreferenced_files = submission_bucket_files - referenced_files
-
-    ## remove any files in task-level directories that contain referenced files
-
-    # find all other files in the same task-level directories as referenced files
-    sibling_referenced_files = []
-    for f in unreferenced_files:
-        if get_parent_directory(f) in referenced_directories:
-            sibling_referenced_files.append(f)
-
-    # remove them from the list of unreferenced files (treat them as referenced)
-    unreferenced_files = unreferenced_files - set(sibling_referenced_files)
-
-    # Filter out files like .logs and rc.txt
-    def can_delete(f, weeks_old_before_delete):
-        '''Return true if this file should not be deleted in a mop.'''
-        time_created = bucket_dict[f]['time_created']
-
-        if time_created > datetime.now(time_created.tzinfo) - timedelta(weeks = weeks_old_before_delete):
-            return False
-        filename = f.rsplit('/', 1)[-1]
-        # Don't delete logs
-        if filename.endswith('.log'):
-            return False
-        # Don't delete return codes from jobs
-        if filename.endswith('-rc.txt'):
-            return False
-        if filename == "rc":
-            return False
-        # Don't delete tool's exec.sh or script
-        if filename in ('exec.sh', 'script'):
-            return False
-        # keep stdout, stderr, and output
-        if filename in ('stderr', 'stdout', 'output'):
-            return False
-        # Only delete specified unreferenced files
-        if include:
-            for glob in include:
-                if fnmatchcase(filename, glob):
-                    return True
-            return False
-        # Don't delete specified unreferenced files
-        if exclude:
-            for glob in exclude:
-                if fnmatchcase(filename, glob):
-                    return False
-
-        return True
-
-    deletable_files = [f for f in unreferenced_files if can_delete(f, weeks_old)]
+        print("Found {} unreferenced submission-related files in bucket {}".format(len(candidate_rows), bucket))
+
+    # Filter out files like .logs and rc.txt, one chunk of candidates at a time
+    CHUNK_SIZE = 250000
+    deletable_rows = []
+    for start in range(0, len(candidate_rows), CHUNK_SIZE):
+        chunk_rows = candidate_rows[start:start + CHUNK_SIZE]
+        chunk_df = listing.to_frame(chunk_rows)
+        mask = deletable_mask(chunk_df['file_name'], chunk_df['time_created'], include, exclude, weeks_old)
+        deletable_rows.append(chunk_rows[mask.to_numpy()])
+    deletable_rows = np.concatenate(deletable_rows) if deletable_rows else np.zeros(0, dtype=np.int64)
+
+    deletable_files = [listing.bucket_prefix + name for name in listing.names_at(deletable_rows)]
+    generations = [generation if generation >= 0 else None
+                   for generation in listing.columns['generation'][deletable_rows].tolist()]
+    times_created = [time_created if time_created >= 0 else None
+                     for time_created in listing.columns['time_created'][deletable_rows].tolist()]
 
     if len(deletable_files) == 0:
         if verbose:
             print("No files to mop in " + workspace_name)
+        write_manifest()
         return 0
 
-    deletable_size = human_readable_size(sum(bucket_dict[f]['size']
-                                             for f in deletable_files))
+    deletable_size = human_readable_size(int(listing.columns['size'][deletable_rows].sum()))
 
     workspace_no_spaces = workspace.replace(' ','_')
 
+    # the list is only saved to disk when verbose or in a dry run
+    files_to_delete_list_path = None
     if verbose or dry_run:
         # save list to disk
         print("Found {} files to delete.".format(len(deletable_files)) +
@@ -391,16 +1047,64 @@ def mop(project, workspace, include, exclude, dry_run, save_dir, yes, verbose, w
         workspace_json['workspace']['name'])
 
     if dry_run or (not yes and not _confirm_prompt(message)):
+        write_manifest()
         return files_to_delete_list_path
 
     # use GCP client library to delete files
-    delete_files(bucket, deletable_files, verbose)
+    delete_files(bucket, deletable_files, verbose, generations=generations, times_created=times_created)
+    write_manifest(deleted_rows=deletable_rows)
 
     return files_to_delete_list_path
 
 
-def mop_files_from_list(project, workspace, delete_from_list, dry_run, yes, verbose):
-    '''Clean up data in workspace from a given list of files to delete.'''
+def iter_file_list(delete_from_list, start_line=0):
+    """Stream the lines of a (optionally gzipped) newline-delimited file list, skipping the first `start_line`."""
+    opener = gzip.open if delete_from_list.endswith('.gz') else open
+    with opener(delete_from_list, 'rt') as infile:
+        for line_number, line in enumerate(infile):
+            if line_number >= start_line:
+                yield line.strip()
+
+
+def get_file_list_version(delete_from_list):
+    """Return the size and modification time of a file list, to tell whether it changed between runs."""
+    stat = os.stat(delete_from_list)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def read_progress(progress_path, list_version):
+    """Return the number of lines and files of a file list already processed by an interrupted run.
+
+    Progress recorded against a different version of the list (see get_file_list_version) is discarded.
+    """
+    if not os.path.exists(progress_path):
+        return 0, 0
+    with open(progress_path, 'r') as infile:
+        progress = json.load(infile)
+    if {key: progress.get(key) for key in list_version} != list_version:
+        print("WARNING: the file list changed since {} was written, starting from the beginning of the list".format(progress_path))
+        return 0, 0
+    return progress['lines_done'], progress['files_done']
+
+
+def write_progress(progress_path, list_version, lines_done, files_done):
+    """Record how many lines and files of a file list have been processed, replacing the file atomically."""
+    with open(progress_path + '.tmp', 'w') as outfile:
+        json.dump(dict(list_version, lines_done=lines_done, files_done=files_done), outfile)
+    os.replace(progress_path + '.tmp', progress_path)
+
+
+def mop_files_from_list(project, workspace, delete_from_list, dry_run, yes, verbose, inventory=None,
+                        batch_size=1000, workers=8, max_qps=None):
+    '''Clean up data in workspace from a given list of files to delete.
+
+    The list (optionally gzipped) is streamed in batches of `batch_size` lines, deleted by `workers`
+    concurrent batches with at most `max_qps` delete requests per second overall. Progress is recorded
+    in `<delete_from_list>.progress`, so an interrupted run resumes after the last completed batch as
+    long as the list itself hasn't changed.
+    If `inventory` is given, files found in it are only deleted if their generation (or, where it has no
+    generation, their creation time) still matches.
+    '''
     # First retrieve the workspace to get bucket information
     if verbose:
         print("Retrieving workspace information...")
@@ -408,25 +1112,89 @@ def mop_files_from_list(project, workspace, delete_from_list, dry_run, yes, verb
     fapi._check_response_code(r, 200)
     workspace_json = r.json()
     bucket = workspace_json['workspace']['bucketName']
-    bucket_prefix = 'gs://' + bucket
+    bucket_prefix = 'gs://' + bucket + '/'
 
     if verbose:
         print("{} -- {}".format(workspace_json, bucket_prefix))
 
-    with open(delete_from_list, 'r') as infile:
-        deletable_files_input = infile.readlines()
+    progress_path = delete_from_list + '.progress'
+    list_version = get_file_list_version(delete_from_list)
+    start_line, start_files = read_progress(progress_path, list_version)
+    if verbose and start_line:
+        print("Resuming after the first {} lines of {}".format(start_line, delete_from_list))
 
-    # ensure that all the files are actually in the workspace bucket
-    deletable_files = [f.rstrip('\n') for f in deletable_files_input if bucket_prefix in f]
+    if dry_run:
+        # ensure that all the files are actually in the workspace bucket
+        n_deletable_files = sum(1 for f in iter_file_list(delete_from_list, start_line) if f.startswith(bucket_prefix))
+        print("Would delete {} files in {} ({})".format(n_deletable_files, bucket_prefix, workspace))
+        return 0
 
-    message = "WARNING: Delete {} files in {} ({})".format(
-        len(deletable_files), bucket_prefix, workspace)
+    # the list is only read once, while deleting, so the files are counted as they go
+    message = "WARNING: Delete the files in {} listed in {} ({})".format(bucket_prefix, delete_from_list, workspace)
+    if start_line:
+        message += ", resuming after {} files already processed".format(start_files)
 
-    if dry_run or (not yes and not _confirm_prompt(message)):
+    if not yes and not _confirm_prompt(message):
         return 0
 
-    # use GCP client library to delete files
-    delete_files(bucket, deletable_files, verbose)
+    inventory_by_path = None
+    if inventory:
+        inventory_df = load_inventory(inventory, bucket, verbose)
+        inventory_by_path = inventory_df.set_index('file_path')[['generation', 'time_created']]
+        del inventory_df
+
+    rate_limiter = RateLimiter(max_qps) if max_qps else None
+    # one client (and connection pool) shared by every batch
+    storage_client = storage.Client()
+
+    def batches():
+        '''Yield (lines processed once the batch is done, blob names, generations, creation times) per batch.'''
+        line_number = start_line
+        for lines in partition_all(batch_size, iter_file_list(delete_from_list, start_line)):
+            line_number += len(lines)
+            files = [f for f in lines if f.startswith(bucket_prefix)]
+            generations, times_created = get_inventory_versions(inventory_by_path, files) if inventory_by_path is not None else (None, None)
+            yield line_number, [f[len(bucket_prefix):] for f in files], generations, times_created
+
+    # use GCP client library to delete files, keeping a bounded number of batches in flight. batches
+    # are collected in submission order so the recorded progress never skips an unfinished batch.
+    counts = {"deleted": 0, "skipped": 0}
+    in_flight = deque()
+
+    def collect_oldest_batch():
+        lines_done, n_files, future = in_flight.popleft()
+        counts["skipped"] += future.result()
+        counts["deleted"] += n_files
+        write_progress(progress_path, list_version, lines_done, start_files + counts["deleted"])
+        if verbose:
+            print(f'...processed {start_files + counts["deleted"]} files', end='\r')
+
+    with ThreadPoolExecutor(max_workers=workers) as e:
+        try:
+            for lines_done, blob_names, generations, times_created in batches():
+                in_flight.append((lines_done, len(blob_names),
+                                  e.submit(delete_batch, bucket, blob_names, generations, rate_limiter,
+                                           times_created=times_created, storage_client=storage_client)))
+                if len(in_flight) >= 2 * workers:
+                    collect_oldest_batch()
+            while in_flight:
+                collect_oldest_batch()
+        except Exception as error:
+            for _, _, future in in_flight:
+                future.cancel()
+            print(f"WARNING: deletion stopped with error: {error}")
+            print(f"Progress saved to {progress_path}, run the same command again to resume.")
+            exit(1)
+
+    if verbose:
+        print()
+    n_skipped = counts["skipped"]
+    if n_skipped:
+        print(f"WARNING: {n_skipped} files changed since the inventory was taken and were not deleted.")
+    if verbose:
+        print(f"Successfully deleted {counts['deleted'] - n_skipped} files from bucket {bucket}.")
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
 
     return 0
 
@@ -454,12 +1222,30 @@ if __name__ == "__main__":
     parser.add_argument('--dry-run', action='store_true',
                       help='Show deletions that would be performed')
     parser.add_argument('--delete-from-list', type=str, default=None,
-                      help='path to tsv containing newline-delimited files to delete')
+                      help='path to tsv (optionally gzipped) containing newline-delimited files to delete')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='with --delete-from-list, number of lines of the list deleted per batch')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='with --delete-from-list, number of batches deleted concurrently')
+    parser.add_argument('--max-qps', type=float, default=None,
+                        help='with --delete-from-list, maximum delete requests per second (default: no limit)')
     parser.add_argument('--save-dir', type=str, default='mop_data',
                       help='Directory to save manifests')
+    listing_group = parser.add_mutually_exclusive_group()
+    listing_group.add_argument('--manifest', type=str, default=None,
+                               help='local path or gs:// url of a mop manifest. If it exists, only submissions and '
+                                    'entity types that changed since the last run are re-scanned; it is rewritten '
+                                    'after each run, with the bucket listing saved next to it as <manifest>.objects.npz.')
+    listing_group.add_argument('--inventory', type=str, default=None,
+                               help='use a pre-generated object inventory instead of listing the bucket: a Storage '
+                                    'Insights CSV/Parquet report (path or glob of shards) or a BigQuery table as '
+                                    'bq://project.dataset.table. Files are only deleted if unchanged since.')
     parser.add_argument('--weeks-old', type=int, default=3,
                         help='number of weeks old (from creation time) a file must be before it will be deleted. '
                              'Default is 3 weeks, set to 0 to delete everything.')
+    parser.add_argument('--spill-dir', type=str, default=None,
+                        help='directory to keep the bucket listing in on disk instead of in memory (overwritten each run), '
+                             'for buckets with many millions of files')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-i', '--include', nargs='+', metavar="glob",
                        help="Only delete unreferenced files matching the " +
@@ -471,7 +1257,9 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     if args.delete_from_list:
-        mop_files_from_list(args.project, args.workspace, args.delete_from_list, args.dry_run, args.yes, args.verbose)
+        mop_files_from_list(args.project, args.workspace, args.delete_from_list, args.dry_run, args.yes, args.verbose,
+                            args.inventory, args.batch_size, args.workers, args.max_qps)
     else:
-        mop(args.project, args.workspace, args.include, args.exclude, args.dry_run, args.save_dir, args.yes, args.verbose, args.weeks_old)
+        mop(args.project, args.workspace, args.include, args.exclude, args.dry_run, args.save_dir, args.yes, args.verbose,
+            args.weeks_old, args.manifest, args.inventory, args.spill_dir)
 
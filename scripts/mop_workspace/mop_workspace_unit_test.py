@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatchcase
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import mop_workspace
+
+
+BUCKET = 'fc-bucket'
+TASK_DIR = 'submissions/sub-1/wf/wf-1/call-align'
+REFERENCED_FILES = [
+    f'gs://{BUCKET}/{TASK_DIR}/sample.bam',
+    # a trailing slash marks a referenced directory
+    f'gs://{BUCKET}/uploads/batch-1/',
+    # same paths in a bucket whose name starts with the workspace bucket's name
+    f'gs://{BUCKET}2/submissions/sub-1/wf/wf-1/call-sort/sorted.bam',
+    f'gs://{BUCKET}2/uploads/batch-2/',
+]
+# expected KEEP_REASONS for bucket-relative names in BUCKET
+EXPECTED_REASONS = {
+    f'{TASK_DIR}/sample.bam': 'referenced',
+    f'{TASK_DIR}/sample.bai': 'sibling',
+    f'{TASK_DIR}/stdout': 'sibling',
+    'uploads/batch-1/sample.fastq': 'in_referenced_directory',
+    'uploads/batch-1/lane-1/sample.fastq': 'in_referenced_directory',
+    f'{TASK_DIR}/attempt-2/sample.bam': None,
+    'uploads/batch-10/sample.fastq': None,
+    'submissions/sub-1/wf/wf-1/call-sort/sorted.bam': None,
+    'uploads/batch-2/sample.fastq': None,
+    'unreferenced.txt': None,
+}
+
+
+def reasons(codes):
+    return [mop_workspace.KEEP_REASONS[code] for code in codes]
+
+
+def make_listing(names, spill_dir=None, chunk_size=3):
+    listing = mop_workspace.CompactBlobListing(BUCKET, spill_dir=spill_dir, chunk_size=chunk_size)
+    for i, name in enumerate(names):
+        listing.append(name, i, i * 10, generation=i)
+    return listing.finalize()
+
+
+# TEST: referenced files, their siblings and files under referenced directories are kept
+def test_referenced_path_index_classify_names():
+    index = mop_workspace.ReferencedPathIndex(BUCKET, REFERENCED_FILES)
+    names = list(EXPECTED_REASONS)
+
+    assert index.n_files == 2
+    assert reasons(index.classify_names(names)) == list(EXPECTED_REASONS.values())
+
+
+# TEST: paths in a bucket whose name is a prefix of the workspace bucket's aren't taken as references
+def test_referenced_path_index_bucket_name_prefix():
+    index = mop_workspace.ReferencedPathIndex(f'{BUCKET}2', [f'gs://{BUCKET}/{TASK_DIR}/sample.bam'])
+
+    assert index.n_files == 0
+    assert reasons(index.classify_names([f'{TASK_DIR}/sample.bam'])) == [None]
+
+
+@pytest.mark.parametrize('spill', [False, True])
+def test_referenced_path_index_classify_listing(tmp_path, spill):
+    index = mop_workspace.ReferencedPathIndex(BUCKET, REFERENCED_FILES)
+    names = list(EXPECTED_REASONS)
+    listing = make_listing(names, spill_dir=str(tmp_path) if spill else None)
+
+    codes = index.classify_listing(listing, chunk_size=4)
+
+    assert reasons(codes) == list(EXPECTED_REASONS.values())
+
+
+# TEST: a name whose 64-bit key collides with a referenced one is not taken as referenced
+def test_hashed_name_set_rejects_key_collision(monkeypatch):
+    # every string gets the same key
+    monkeypatch.setattr(mop_workspace, 'hash', lambda name: 42, raising=False)
+    names = mop_workspace._HashedNameSet(['a/referenced.bam', 'a/other.bam'])
+    queries = ['a/referenced.bam', 'a/colliding.bam', 'a/other.bam']
+
+    assert list(names.contains(np.full(len(queries), 42, dtype=np.int64), queries)) == [True, False, True]
+
+    index = mop_workspace.ReferencedPathIndex(BUCKET, REFERENCED_FILES)
+    assert reasons(index.classify_names(list(EXPECTED_REASONS))) == list(EXPECTED_REASONS.values())
+
+
+# TEST: the compact listing keeps names and columns row-aligned, in memory or spilled to disk
+@pytest.mark.parametrize('spill', [False, True])
+def test_compact_blob_listing_round_trip(tmp_path, spill):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    listing = mop_workspace.CompactBlobListing(BUCKET, spill_dir=str(tmp_path) if spill else None, chunk_size=2)
+    listing.append('a/one.txt', 1, mop_workspace.to_micros(now), generation=11)
+    listing.append('a/dös.txt', float('nan'), mop_workspace.to_micros(now - timedelta(days=1)))
+    listing.append('b/three.txt', 3, mop_workspace.to_micros(now), generation=33)
+    listing.append_columns(np.frombuffer(b'c/fourc/five', dtype=np.uint8), [6, 6],
+                           {'size': [4, 5], 'time_created': [0, 0], 'updated': [-1, -1], 'generation': [44, -1]})
+    listing.finalize()
+
+    assert len(listing) == 5
+    assert list(listing.iter_names()) == ['a/one.txt', 'a/dös.txt', 'b/three.txt', 'c/four', 'c/five']
+    assert list(listing.iter_names(1, 3)) == ['a/dös.txt', 'b/three.txt']
+    assert listing.names_at([4, 1]) == ['c/five', 'a/dös.txt']
+
+    frame = listing.to_frame(np.array([0, 1, 4]))
+    assert list(frame['file_path']) == [f'gs://{BUCKET}/a/one.txt', f'gs://{BUCKET}/a/dös.txt', f'gs://{BUCKET}/c/five']
+    assert list(frame['file_name']) == ['one.txt', 'dös.txt', 'five']
+    assert list(frame['size']) == [1, 0, 5]
+    assert frame['time_created'].iloc[0] == pd.Timestamp(now)
+    assert frame['time_created'].iloc[1] == pd.Timestamp(now - timedelta(days=1))
+    assert frame['generation'].iloc[0] == 11
+    assert frame['generation'].isna().tolist() == [False, True, True]
+
+
+def can_delete(file_name, time_created, include, exclude, weeks_old):
+    """The per-file filter deletable_mask replaced."""
+    if time_created > datetime.now(time_created.tzinfo) - timedelta(weeks=weeks_old):
+        return False
+    if file_name.endswith('.log') or file_name.endswith('-rc.txt'):
+        return False
+    if file_name in ('rc', 'exec.sh', 'script', 'stderr', 'stdout', 'output'):
+        return False
+    if include:
+        return any(fnmatchcase(file_name, glob) for glob in include)
+    if exclude:
+        return not any(fnmatchcase(file_name, glob) for glob in exclude)
+    return True
+
+
+# TEST: the vectorized filter agrees with the per-file one
+@pytest.mark.parametrize('include, exclude', [
+    (None, None),
+    (['*.bam', '*.ba?'], None),
+    (['sample_[0-9].*'], None),
+    (None, ['*.bam']),
+    (None, ['*.[!b]*', 'Sample*']),
+])
+@pytest.mark.parametrize('weeks_old', [0, 3])
+def test_deletable_mask_matches_per_file_filter(include, exclude, weeks_old):
+    now = datetime.now(timezone.utc)
+    file_names = ['sample_1.bam', 'sample_1.bai', 'Sample_2.BAM', 'sample_x.vcf', 'task.log', 'task-rc.txt', 'rc',
+                  'exec.sh', 'script', 'stderr', 'stdout', 'output', 'output.txt', 'no_extension', 'a.b.bam', '[x].bam']
+    times_created = [now - timedelta(weeks=i % 5, hours=1) for i in range(len(file_names))]
+
+    mask = mop_workspace.deletable_mask(pd.Series(file_names), pd.Series(times_created), include, exclude, weeks_old)
+
+    assert list(mask) == [can_delete(name, time_created, include, exclude, weeks_old)
+                          for name, time_created in zip(file_names, times_created)]
@@ -5,6 +5,7 @@
 # Imports and configuration
 import sys
 import os
+import csv
 import logging
 import argparse
 import pandas as pd
@@ -15,6 +16,193 @@ from google.cloud import bigquery
 import uuid
 import json
 import datetime
+import hashlib
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Columns of the results dataframe
+RESULT_COLUMNS = ["metric_type", "source_table", "source_column", "metric", "n", "d", "r", "flag"]
+
+# Default number of BigQuery jobs that are allowed to run at the same time
+DEFAULT_MAX_CONCURRENT_QUERIES = 10
+
+# Class to collect result rows as lightweight lists, optionally streaming them to a file, and materialize a dataframe once at the end
+class ResultCollector:
+    def __init__(self, stream_path=None, stream_format=None):
+        self.rows = []
+        self.stream_path = stream_path
+        self.stream_format = stream_format
+        self._stream_file = None
+        self._csv_writer = None
+        self._parquet_writer = None
+        if stream_path is not None:
+            if stream_format == "parquet":
+                # Imported here so pyarrow is only required when streaming to parquet
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                self._pa = pa
+                self._parquet_schema = pa.schema([(col, pa.string()) for col in RESULT_COLUMNS[:4]] + [(col, pa.float64()) for col in RESULT_COLUMNS[4:]])
+                self._parquet_writer = pq.ParquetWriter(stream_path, self._parquet_schema)
+            else:
+                self._stream_file = open(stream_path, "w", newline="")
+                self._csv_writer = csv.writer(self._stream_file, delimiter="\t" if stream_format == "tsv" else ",")
+                self._csv_writer.writerow(RESULT_COLUMNS)
+                self._stream_file.flush()
+
+    # Function to record a batch of result rows (and stream them out, if configured)
+    def add(self, rows):
+        rows = [list(row) for row in rows]
+        if len(rows) == 0:
+            return
+        self.rows.extend(rows)
+        if self._csv_writer is not None:
+            self._csv_writer.writerows(rows)
+            self._stream_file.flush()
+        elif self._parquet_writer is not None:
+            columns = list(zip(*rows))
+            arrays = [self._pa.array([None if val is None else str(val) for val in columns[i]], type=self._pa.string()) for i in range(4)]
+            arrays += [self._pa.array([None if val is None else float(val) for val in columns[i]], type=self._pa.float64()) for i in range(4, len(RESULT_COLUMNS))]
+            self._parquet_writer.write_table(self._pa.Table.from_arrays(arrays, schema=self._parquet_schema))
+
+    # Function to close the stream file (if any)
+    def close(self):
+        if self._stream_file is not None:
+            self._stream_file.close()
+            self._stream_file = None
+            self._csv_writer = None
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+    # Function to build the results dataframe in a single step
+    def to_dataframe(self):
+        return pd.DataFrame.from_records(self.rows, columns = RESULT_COLUMNS)
+
+# Default percent of each table sampled for linkage checks in fast mode
+DEFAULT_SAMPLE_PERCENT = 10
+
+# HyperLogLog++ precision used for sketches (also the precision behind BigQuery's APPROX_COUNT_DISTINCT) and its relative error at ~95% confidence (2 x 1.04/sqrt(2^15))
+HLL_PRECISION = 15
+HLL_RELATIVE_ERROR = 0.0115
+
+# Function to mark a metric as approximate, including a description of its error bound
+def approximate_metric(metric, bound_description):
+    return "{0} [approximate: {1}]".format(metric, bound_description)
+
+# Function to describe the ~95% confidence bound for a ratio estimated from a sample of d records
+def sample_bound_description(n, d, sample_percent):
+    if d is None or d == 0:
+        return "{0:g}% sample, no sampled records".format(sample_percent)
+    r = n/d
+    if n == 0:
+        # Rule of three for a proportion when no events are observed in the sample
+        return "{0:g}% sample, r <= {1:.4f} at 95% confidence".format(sample_percent, 3/d)
+    return "{0:g}% sample, r +/- {1:.4f} at 95% confidence".format(sample_percent, 1.96*(r*(1 - r)/d)**0.5)
+
+# Class to cache query results locally, keyed on the query text and the last modified time and row count of every table it reads
+class QueryCache:
+    CACHE_VERSION = 1
+
+    def __init__(self, client, cache_file_path, bq_project, bq_schema):
+        self.client = client
+        self.cache_file_path = cache_file_path
+        self.table_pattern = re.compile(r"`{0}\.{1}\.([^`]+)`".format(re.escape(bq_project), re.escape(bq_schema)))
+        self.bq_project = bq_project
+        self.bq_schema = bq_schema
+        self.table_signatures = {}
+        self.hit_count = 0
+        self.entries = {}
+        if os.path.isfile(cache_file_path):
+            try:
+                with open(cache_file_path, "r") as cache_file:
+                    cache_dict = json.load(cache_file)
+                if cache_dict.get("version") == self.CACHE_VERSION:
+                    self.entries = cache_dict.get("entries", {})
+                else:
+                    logging.warning("Query cache file {} was written by a different version of this script. Will rebuild it.".format(cache_file_path))
+            except Exception as e:
+                logging.warning("Error reading query cache file {0} ({1}). Will rebuild it.".format(cache_file_path, str(e)))
+
+    # Function to retrieve (and remember) the last modified time and row count of a table, or None if its results can't be cached
+    def get_table_signature(self, table):
+        if table not in self.table_signatures:
+            signature = None
+            try:
+                table_metadata = self.client.get_table("{0}.{1}.{2}".format(self.bq_project, self.bq_schema, table))
+                # Views and tables with rows still in the streaming buffer can change without updating their metadata
+                if table_metadata.table_type == "TABLE" and table_metadata.streaming_buffer is None and table_metadata.modified is not None:
+                    signature = [table_metadata.modified.isoformat(), table_metadata.num_rows]
+            except Exception as e:
+                logging.warning("Error retrieving metadata for table {0} ({1}). Its results won't be cached.".format(table, str(e)))
+            self.table_signatures[table] = signature
+        return self.table_signatures[table]
+
+    # Function to build the cache key and table signatures for a query, or None if any of the tables it reads can't be cached
+    def get_query_signature(self, query):
+        table_signature_dict = {}
+        for table in sorted(set(self.table_pattern.findall(query))):
+            table_signature = self.get_table_signature(table)
+            if table_signature is None:
+                return None, None
+            table_signature_dict[table] = table_signature
+        return hashlib.sha256(query.encode("utf-8")).hexdigest(), table_signature_dict
+
+    # Function to return the cache entry for a query, or None if the query hasn't been cached or its tables have changed
+    def get_entry(self, query):
+        query_key, table_signature_dict = self.get_query_signature(query)
+        entry = self.entries.get(query_key) if query_key is not None else None
+        if entry is None or entry["tables"] != table_signature_dict:
+            return None
+        return entry
+
+    # Function to check whether a query's results are cached, without counting it as a hit (e.g. when estimating costs)
+    def contains(self, query):
+        return self.get_entry(query) is not None
+
+    # Function to return the cached rows for a query, or None if the query hasn't been cached or its tables have changed. Hits are counted for the log summary.
+    def lookup(self, query):
+        entry = self.get_entry(query)
+        if entry is None:
+            return None
+        self.hit_count += 1
+        return entry["rows"]
+
+    # Function to record the rows returned by a query
+    def store(self, query, rows):
+        query_key, table_signature_dict = self.get_query_signature(query)
+        if query_key is not None:
+            self.entries[query_key] = {"tables": table_signature_dict, "rows": rows, "cached_at": datetime.datetime.now().isoformat()}
+
+    # Function to write the cache back out to disk
+    def save(self):
+        temp_file_path = self.cache_file_path + ".tmp"
+        try:
+            with open(temp_file_path, "w") as cache_file:
+                json.dump({"version": self.CACHE_VERSION, "entries": self.entries}, cache_file, default=str)
+            os.replace(temp_file_path, self.cache_file_path)
+        except Exception as e:
+            logging.warning("Error writing query cache file {0} ({1}).".format(self.cache_file_path, str(e)))
+
+# Class to track the estimated bytes processed by check queries against a --maxBytes budget
+class QueryBudget:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.category_bytes = {}
+
+    # Function to check whether a query with the specified estimate still fits in the budget
+    def fits(self, n_bytes):
+        return self.used_bytes + n_bytes <= self.max_bytes
+
+    # Function to record the estimate for a query that will be run
+    def charge(self, category, n_bytes):
+        self.used_bytes += n_bytes
+        self.category_bytes[category] = self.category_bytes.get(category, 0) + n_bytes
+
+    # Function to summarize the estimated bytes processed by category
+    def summary(self):
+        category_str = "".join(["\n {0}: {1:,} bytes".format(category, n_bytes) for category, n_bytes in self.category_bytes.items()])
+        return "Estimated bytes processed: {0:,} of the {1:,} byte budget.{2}".format(self.used_bytes, self.max_bytes, category_str)
 
 # Function to create argument parser
 def create_arg_parser():
@@ -25,6 +213,12 @@ def create_arg_parser():
     parser.add_argument("--env", help = "Optional parameter to specify which TDR environment the data to be validated lives in. Use 'prod' to specify production or 'dev' to specify development. If unspecified, the script will assume the data is in production.")
     parser.add_argument("--schemaFilePath", help = "Optional parameter to specify the relative path to a JSON schema definition file to compare against the schema being used for the data in TDR. This file should contain 'tables' and 'relationships' properties and be formatted like the TDR schema definition object. If unspecified, the schema comparison checks will be skipped.")
     parser.add_argument("--outputDirectory", help = "Optional parameter to specify the relative path to the directory where the results and log files should be written. If unspecified, these file will be created in the directory the script is run from.")
+    parser.add_argument("--streamResultsFormat", help = "Optional parameter to specify a format ('tsv', 'csv', or 'parquet') in which results should also be streamed to a file as each group of checks completes, so partial results survive a failure. If unspecified, results are only written out once all checks are complete.")
+    parser.add_argument("--fast", action = "store_true", help = "Optional flag to run approximate checks for a quick signal on very large datasets: distinct counts use APPROX_COUNT_DISTINCT, linkage checks are run against a TABLESAMPLE of the referencing side, and orphaned files are estimated with HyperLogLog sketches. Approximate result rows are marked as such, along with their error bounds. If unspecified, exact checks are run.")
+    parser.add_argument("--samplePercent", type = float, help = "Optional parameter to specify the percent of each table sampled for linkage checks when running with --fast. If unspecified, {}% of each table is sampled.".format(DEFAULT_SAMPLE_PERCENT))
+    parser.add_argument("--cacheFilePath", help = "Optional parameter to specify the relative path to a JSON file used to cache query results between runs. A cached result is reused when its query is unchanged and none of the tables it reads have been modified (based on the BigQuery table's last modified time and row count). If unspecified, every query is executed.")
+    parser.add_argument("--maxBytes", type = int, help = "Optional parameter to specify a budget for the total bytes processed by the BigQuery check queries. Every query is dry-run first and its estimate is recorded in the output. Linkage checks that don't fit are run against a sample instead, and any other check that doesn't fit is skipped. If unspecified, all checks are run without estimating their cost.")
+    parser.add_argument("--maxConcurrentQueries", type = int, help = "Optional parameter to specify the maximum number of BigQuery jobs to run at the same time. If unspecified, the script will run up to {} queries concurrently.".format(DEFAULT_MAX_CONCURRENT_QUERIES))
     return parser
 
 # Function to validate UUID provided is value
@@ -87,6 +281,14 @@ def process_tdr_schema(tdr_schema_dict):
     array_field_set = set()
     field_list = []
     relationship_count = len(tdr_schema_dict["relationships"])
+    # Index relationships by (table, column) in both directions
+    joins_to_index = {}
+    joins_from_index = {}
+    for relation_entry in tdr_schema_dict["relationships"]:
+        from_key = (relation_entry["_from"]["table"], relation_entry["_from"]["column"])
+        to_key = (relation_entry["to"]["table"], relation_entry["to"]["column"])
+        joins_to_index.setdefault(from_key, []).append({"table": to_key[0], "column": to_key[1]})
+        joins_from_index.setdefault(to_key, []).append({"table": from_key[0], "column": from_key[1]})
     for table_entry in tdr_schema_dict["tables"]:
         table_set.add(table_entry["name"])
         for column_entry in table_entry["columns"]:
@@ -100,233 +302,398 @@ def process_tdr_schema(tdr_schema_dict):
                 field_dict["is_primary_key"] = True
             else:
                 field_dict["is_primary_key"] = False
-            joins_to_list = []
-            for relation_entry in tdr_schema_dict["relationships"]:
-                joins_to_dict = {}
-                if relation_entry["_from"]["table"] == table_entry["name"] and relation_entry["_from"]["column"] == column_entry["name"]:
-                    joins_to_dict["table"] = relation_entry["to"]["table"]
-                    joins_to_dict["column"] = relation_entry["to"]["column"]
-                    joins_to_list.append(joins_to_dict)
-            field_dict["joins_to"] = joins_to_list
-            joins_from_list = []
-            for relation_entry in tdr_schema_dict["relationships"]:
-                joins_from_dict = {}
-                if relation_entry["to"]["table"] == table_entry["name"] and relation_entry["to"]["column"] == column_entry["name"]:
-                    joins_from_dict["table"] = relation_entry["_from"]["table"]
-                    joins_from_dict["column"] = relation_entry["_from"]["column"]
-                    joins_from_list.append(joins_from_dict)
-            field_dict["joins_from"] = joins_from_list
+            field_dict["joins_to"] = [dict(entry) for entry in joins_to_index.get((table_entry["name"], column_entry["name"]), [])]
+            field_dict["joins_from"] = [dict(entry) for entry in joins_from_index.get((table_entry["name"], column_entry["name"]), [])]
             field_list.append(field_dict)
             if column_entry["array_of"] == True:
                 array_field_set.add(table_entry["name"] + "." + column_entry["name"])
     return table_set, array_field_set, field_list, relationship_count 
 
-# Function to collect table level statistics: row counts
-def run_table_profiling_checks(client, df, bq_project, bq_schema, table_set, field_list):
+# Function to execute a single query and collect its rows as dictionaries
+def execute_query(client, query):
+    return [dict(row.items()) for row in client.query(query).result()]
+
+# Function to execute a batch of queries concurrently, returning (rows, error) tuples in the order the queries were provided. Queries with results in the cache (if provided) aren't re-executed.
+def execute_queries(client, query_list, max_concurrent_queries, cache=None):
+    results = [None] * len(query_list)
+    pending_idx_list = []
+    for idx, query in enumerate(query_list):
+        cached_rows = cache.lookup(query) if cache is not None else None
+        if cached_rows is not None:
+            results[idx] = (cached_rows, None)
+        else:
+            pending_idx_list.append(idx)
+    if cache is not None and len(query_list) > 0:
+        logging.info("{0} of {1} queries served from the query cache.".format(len(query_list) - len(pending_idx_list), len(query_list)))
+    if len(pending_idx_list) == 0:
+        return results
+    with ThreadPoolExecutor(max_workers = max(1, min(max_concurrent_queries, len(pending_idx_list)))) as executor:
+        future_dict = {executor.submit(execute_query, client, query_list[idx]): idx for idx in pending_idx_list}
+        for future in as_completed(future_dict):
+            idx = future_dict[future]
+            try:
+                results[idx] = (future.result(), None)
+                if cache is not None:
+                    cache.store(query_list[idx], results[idx][0])
+            except Exception as e:
+                logging.error("Error during query execution: {}".format(str(e)))
+                #print(query_list[idx])
+                results[idx] = (None, str(e))
+    if cache is not None:
+        cache.save()
+    return results
+
+# Function to dry-run a single query and return its estimated bytes processed
+def dry_run_query(client, query):
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    return client.query(query, job_config=job_config).total_bytes_processed
+
+# Function to dry-run a batch of queries concurrently, returning the estimated bytes processed by each (0 for queries served from the cache, None if the dry run fails)
+def estimate_query_bytes(client, query_list, max_concurrent_queries, cache=None):
+    estimate_list = [None] * len(query_list)
+    pending_idx_list = []
+    for idx, query in enumerate(query_list):
+        if cache is not None and cache.contains(query):
+            estimate_list[idx] = 0
+        else:
+            pending_idx_list.append(idx)
+    if len(pending_idx_list) == 0:
+        return estimate_list
+    with ThreadPoolExecutor(max_workers = max(1, min(max_concurrent_queries, len(pending_idx_list)))) as executor:
+        future_dict = {executor.submit(dry_run_query, client, query_list[idx]): idx for idx in pending_idx_list}
+        for future in as_completed(future_dict):
+            try:
+                estimate_list[future_dict[future]] = future.result()
+            except Exception as e:
+                logging.warning("Error during query dry run: {}".format(str(e)))
+    return estimate_list
+
+# Function to apply the bytes budget to a batch of queries. If the queries don't fit and a cheaper fallback variant of each is provided, the fallback variants are used instead. Queries that still don't fit are skipped.
+# Queries without a cheaper variant have None in place of their fallback, and are run exactly in either case.
+# Returns the variant chosen for each query ("exact", "fallback", or None when skipped) and the cost rows recording each estimate.
+def apply_query_budget(client, budget, category, query_list, cost_key_list, max_concurrent_queries, cache=None, fallback_query_list=None):
+    estimate_list = estimate_query_bytes(client, query_list, max_concurrent_queries, cache)
+    total_estimate = sum([estimate for estimate in estimate_list if estimate is not None])
+    fallback_idx_list = [idx for idx, fallback_query in enumerate(fallback_query_list or []) if fallback_query is not None]
+    use_fallback = len(fallback_idx_list) > 0 and not budget.fits(total_estimate)
+    if use_fallback:
+        logging.warning("Estimated bytes processed by {0} queries ({1:,}) exceed the remaining --maxBytes budget. Will run cheaper variants of {2} of these queries.".format(category, total_estimate, len(fallback_idx_list)))
+        fallback_estimate_list = estimate_query_bytes(client, [fallback_query_list[idx] for idx in fallback_idx_list], max_concurrent_queries, cache)
+        for idx, estimate in zip(fallback_idx_list, fallback_estimate_list):
+            estimate_list[idx] = estimate
+    variant_list = []
+    cost_rows = []
+    for idx, ((source_table, source_column), estimate) in enumerate(zip(cost_key_list, estimate_list)):
+        metric = "Estimated bytes processed by {} query".format(category)
+        flag = None
+        query_use_fallback = use_fallback and fallback_query_list[idx] is not None
+        if estimate is None:
+            # Let queries that fail their dry run execute, so the failure is recorded against the check
+            variant = "fallback" if query_use_fallback else "exact"
+            metric += " (dry run failed)"
+        elif budget.fits(estimate):
+            variant = "fallback" if query_use_fallback else "exact"
+            budget.charge(category, estimate)
+            if query_use_fallback:
+                metric += " (cheaper variant run to fit --maxBytes budget)"
+                flag = 1
+        else:
+            variant = None
+            metric += " (skipped, exceeds remaining --maxBytes budget)"
+            flag = 1
+        variant_list.append(variant)
+        cost_rows.append(["Query Cost", source_table, source_column, metric, estimate, None, None, flag])
+    skipped_count = variant_list.count(None)
+    if skipped_count > 0:
+        logging.warning("{0} of {1} {2} queries skipped to stay within the --maxBytes budget.".format(skipped_count, len(query_list), category))
+    return variant_list, cost_rows
+
+# Function to build the result row recorded in place of a check that was skipped to stay within the bytes budget
+def build_skipped_row(metric_type, source_table, source_column, metric):
+    return [metric_type, source_table, source_column, "Check skipped: {0} (estimated bytes processed exceed the remaining --maxBytes budget)".format(metric), None, None, None, 1]
+
+# Function to build the result row recorded in place of a check whose query failed
+def build_error_row(metric_type, source_table, source_column, metric, error):
+    error_summary = error.strip().splitlines()[0] if error.strip() else "unknown error"
+    return [metric_type, source_table, source_column, "Query execution failed for check: {0} ({1})".format(metric, error_summary), None, None, None, 1]
+
+# Function to convert the rows returned by a check query (already shaped like the results dataframe) into result rows
+def rows_to_results(rows):
+    return [[row[col] for col in RESULT_COLUMNS] for row in rows]
+
+# Maximum number of columns profiled by a single table-level query (each column adds two aggregates)
+MAX_COLUMNS_PER_PROFILING_QUERY = 500
+
+# Function to build a single-scan profiling query for a table: the row count plus null/empty and distinct counts for each column
+def build_table_profiling_query(bq_project, bq_schema, table, column_list, approximate=False):
+    select_list = ["COUNT(*) AS row_count"]
+    distinct_function = "APPROX_COUNT_DISTINCT({})" if approximate else "COUNT(DISTINCT {})"
+    for idx, column_entry in enumerate(column_list):
+        col = "`{}`".format(column_entry["column"])
+        if column_entry["is_array"] == True:
+            # Arrays count as empty when they have no elements, and are compared by their JSON representation
+            select_list.append("COUNTIF(IFNULL(ARRAY_LENGTH({col}), 0) = 0) AS null_{idx}".format(col = col, idx = idx))
+            select_list.append((distinct_function + " AS distinct_{idx}").format("IF(ARRAY_LENGTH({col}) > 0, TO_JSON_STRING({col}), NULL)".format(col = col), idx = idx))
+        else:
+            select_list.append("COUNTIF({col} IS NULL) AS null_{idx}".format(col = col, idx = idx))
+            select_list.append((distinct_function + " AS distinct_{idx}").format(col, idx = idx))
+    return "SELECT {select} FROM `{project}.{schema}.{table}`".format(select = ",\n       ".join(select_list), project = bq_project, schema = bq_schema, table = table)
+
+# Function to unpivot the single row returned by a table profiling query into result rows
+def unpivot_table_profiling_results(table, column_list, result_row, approximate=False):
+    result_list = []
+    row_count = result_row["row_count"]
+    distinct_metric = "Count of distinct values in column"
+    if approximate:
+        distinct_metric = approximate_metric(distinct_metric, "HyperLogLog++ estimate, +/- {0:.1%} at 95% confidence".format(HLL_RELATIVE_ERROR))
+    for idx, column_entry in enumerate(column_list):
+        is_fileref = column_entry["datatype"] == "fileref"
+        null_count = result_row["null_{}".format(idx)]
+        distinct_count = result_row["distinct_{}".format(idx)]
+        result_list.append(["Summary Stats", table, column_entry["column"], "Count of nulls or empty lists in column" + (" (fileref)" if is_fileref else ""),
+                            null_count, row_count, null_count/row_count if row_count > 0 else None, 1 if null_count > 0 and is_fileref else None])
+        result_list.append(["Summary Stats", table, column_entry["column"], distinct_metric,
+                            distinct_count, row_count, distinct_count/row_count if row_count > 0 else None, None])
+    return result_list
+
+# Function to collect table level statistics: row counts, null counts, and distinct value counts
+def run_table_profiling_checks(client, results, bq_project, bq_schema, table_set, field_list, max_concurrent_queries=DEFAULT_MAX_CONCURRENT_QUERIES, approximate=False, cache=None, budget=None):
     logging.info("Building and executing table-level queries...")
-    # Loop through tables in the table set and pull record counts (and record empty tables for use in column-level queries)
+    # Build a single-scan profiling query for each table, splitting very wide tables across a few queries
+    query_list = []
+    query_key_list = []
+    table_column_dict = {}
+    for column_entry in field_list:
+        table_column_dict.setdefault(column_entry["table"], []).append(column_entry)
+    for table_entry in sorted(table_set):
+        column_list = table_column_dict.get(table_entry, [])
+        column_chunks = [column_list[i:i + MAX_COLUMNS_PER_PROFILING_QUERY] for i in range(0, len(column_list), MAX_COLUMNS_PER_PROFILING_QUERY)] or [[]]
+        for chunk_idx, column_chunk in enumerate(column_chunks):
+            query_list.append(build_table_profiling_query(bq_project, bq_schema, table_entry, column_chunk, approximate))
+            query_key_list.append((table_entry, chunk_idx, column_chunk))
+
+    # Apply the bytes budget (if any)
+    result_list = []
+    variant_list = ["exact"] * len(query_list)
+    if budget is not None:
+        variant_list, cost_rows = apply_query_budget(client, budget, "table profiling", query_list, [(key[0], "All") for key in query_key_list], max_concurrent_queries, cache)
+        result_list.extend(cost_rows)
+    run_idx_list = [idx for idx, variant in enumerate(variant_list) if variant is not None]
+
+    # Execute the queries concurrently and unpivot the results (recording empty tables for use in column-level queries)
     empty_table_list = []
-    query_count = 0
-    for table_entry in table_set:
-
-        # Construct the table record count query
-        row_count_query = """SELECT 'Summary Stats' AS metric_type, '{table}' AS source_table, 'All' AS source_column, 
-                   'Count of records in table' AS metric, 
-                   COUNT(*) AS n, null AS d, null AS r, 
-                   CASE WHEN COUNT(*) = 0 THEN 1 END AS flag 
-                   FROM `{project}.{schema}.{table}`""".format(project = bq_project, schema = bq_schema, table = table_entry)
-
-        # Execute the query and append results to dataframe
-        query_count += 1
-        #print(row_count_query)
-        try:
-            df_temp = client.query(row_count_query).result().to_dataframe()
-            df = df.append(df_temp)
-            if df_temp["n"].values[0] == 0:
+    query_results = dict(zip(run_idx_list, execute_queries(client, [query_list[idx] for idx in run_idx_list], max_concurrent_queries, cache)))
+    for idx, (table_entry, chunk_idx, column_chunk) in enumerate(query_key_list):
+        if idx not in query_results:
+            result_list.append(build_skipped_row("Summary Stats", table_entry, "All", "Table profiling"))
+            continue
+        rows, error = query_results[idx]
+        if error is not None:
+            result_list.append(build_error_row("Summary Stats", table_entry, "All", "Table profiling", error))
+            continue
+        row_count = rows[0]["row_count"]
+        if chunk_idx == 0:
+            result_list.append(["Summary Stats", table_entry, "All", "Count of records in table", row_count, None, None, 1 if row_count == 0 else None])
+            if row_count == 0:
                 empty_table_list.append(table_entry)
-            else:
+        # Skip column-level stats for tables that don't have records
+        if row_count > 0:
+            result_list.extend(unpivot_table_profiling_results(table_entry, column_chunk, rows[0], approximate))
 
-                # Identify all fileref columns
-                fileref_col_list = []
-                for column_entry in field_list:
-                    if column_entry["table"] == table_entry and column_entry["datatype"] == "fileref":
-                        fileref_col_list.append("'" + column_entry["column"] + "'")
-                if len(fileref_col_list) > 0:
-                    fileref_col_str = ", ".join(fileref_col_list)
-                else:
-                    fileref_col_str = "''"
-
-                # Construct the null column count query
-                null_query = """WITH null_counts AS
-                        (
-                          SELECT column_name, COUNT(1) AS cnt
-                          FROM `{project}.{schema}.{table}`, 
-                          UNNEST(REGEXP_EXTRACT_ALL(TO_JSON_STRING(`{project}.{schema}.{table}`), r'"(\w+)":(?:null|\[\])')) column_name
-                          GROUP BY column_name
-                        ),
-                        table_count AS
-                        (
-                          SELECT COUNT(*) AS cnt FROM `{project}.{schema}.{table}`
-                        )
-                        SELECT 'Summary Stats' AS metric_type, src.table_name AS source_table, src.column_name AS source_column, 
-                        'Count of nulls or empty lists in column'||CASE WHEN src.column_name IN ({fileref_list}) THEN ' (fileref)' ELSE '' END AS metric,
-                        COALESCE(tar.cnt, 0) AS n, 
-                        table_count.cnt AS d,
-                        CASE WHEN table_count.cnt > 0 THEN COALESCE(tar.cnt, 0)/table_count.cnt END AS r,
-                        CASE WHEN COALESCE(tar.cnt, 0) > 0 AND src.column_name IN ({fileref_list}) THEN 1 END AS flag
-                        FROM `{project}.{schema}.INFORMATION_SCHEMA.COLUMNS` src
-                          LEFT JOIN null_counts tar ON src.column_name = tar.column_name
-                          CROSS JOIN table_count
-                        WHERE src.table_name = '{table}'
-                        AND src.column_name NOT IN ('datarepo_row_id', 'datarepo_ingest_date')""".format(project = bq_project, schema = bq_schema, table = table_entry, fileref_list = fileref_col_str)
-
-                # Execute the null count query and append results to dataframe
-                query_count += 1
-                #print(null_query)
-                try:
-                    df = df.append(client.query(null_query).result().to_dataframe())
-                except Exception as e:
-                    logging.error("Error during query execution: {}".format(str(e)))
-                
-                # Construct the distinct column value query
-                distinct_query = """WITH distinct_counts AS
-                        (
-                          SELECT column_name, APPROX_COUNT_DISTINCT(CASE WHEN column_value NOT IN ('null', '[]') THEN column_value END) AS cnt
-                          FROM `{project}.{schema}.{table}`,
-                          UNNEST(REGEXP_EXTRACT_ALL(TO_JSON_STRING(`{project}.{schema}.{table}`), r'"(\w+)":')) AS column_name WITH OFFSET pos1,
-                          UNNEST(REGEXP_EXTRACT_ALL(TO_JSON_STRING(`{project}.{schema}.{table}`), r':(.+?),')) AS column_value WITH OFFSET pos2
-                          WHERE pos1 = pos2
-                          GROUP BY column_name
-                        ),
-                        table_count AS
-                        (
-                          SELECT COUNT(*) AS cnt FROM `{project}.{schema}.{table}`
-                        )
-                        SELECT 'Summary Stats' AS metric_type, src.table_name AS source_table, src.column_name AS source_column, 
-                        'Count of distinct values in column' AS metric,
-                        COALESCE(tar.cnt, 0) AS n, 
-                        table_count.cnt AS d,
-                        CASE WHEN table_count.cnt > 0 THEN COALESCE(tar.cnt, 0)/table_count.cnt END AS r,
-                        null AS flag
-                        FROM `{project}.{schema}.INFORMATION_SCHEMA.COLUMNS` src
-                          LEFT JOIN distinct_counts tar ON src.column_name = tar.column_name
-                          CROSS JOIN table_count
-                        WHERE src.table_name = '{table}'
-                        AND src.column_name NOT IN ('datarepo_row_id', 'datarepo_ingest_date')""".format(project = bq_project, schema = bq_schema, table = table_entry)
-                                        
-                # Execute the distinct count query and append results to dataframe
-                query_count += 1
-                #print(distinct_query)  
-                try:
-                    df = df.append(client.query(distinct_query).result().to_dataframe())
-                except Exception as e:
-                    logging.error("Error during query execution: {}".format(str(e)))
-        except Exception as e:
-            logging.error("Error during query execution: {}".format(str(e)))
+    # Record results
+    results.add(result_list)
+
+    logging.info("Table-level queries complete. {0} queries executed.".format(len(run_idx_list)))
+    return empty_table_list
+
+# Function to collect the tables in the BigQuery dataset that can't be sampled with TABLESAMPLE: views (which is every table of a snapshot), materialized views, and external tables.
+# If the dataset's tables can't be listed, every table in table_set is treated as unsampleable, so queries fall back to reading them in full.
+def get_unsampleable_table_set(client, bq_project, bq_schema, table_set):
+    try:
+        return set([table_item.table_id for table_item in client.list_tables("{0}.{1}".format(bq_project, bq_schema)) if table_item.table_type != "TABLE"])
+    except Exception as e:
+        logging.warning("Error listing the tables in {0}.{1} ({2}). Will run exact checks in place of sampled ones.".format(bq_project, bq_schema, str(e)))
+        return set(table_set)
+
+# Function to build a query returning the (datarepo_row_id, key) pairs for the non-null values of a column, unnesting array columns
+# TABLESAMPLE is only allowed on tables, so tables in unsampleable_table_set are read in full even when a sample percent is specified
+def build_key_query(bq_project, bq_schema, table, column, array_field_set, sample_percent=None, unsampleable_table_set=()):
+    sample = " TABLESAMPLE SYSTEM ({:g} PERCENT)".format(sample_percent) if sample_percent is not None and table not in unsampleable_table_set else ""
+    if table + "." + column in array_field_set:
+        return "SELECT datarepo_row_id, key FROM `{project}.{schema}.{table}`{sample} CROSS JOIN UNNEST(`{col}`) AS key".format(project = bq_project, schema = bq_schema, table = table, sample = sample, col = column)
+    return "SELECT datarepo_row_id, `{col}` AS key FROM `{project}.{schema}.{table}`{sample} WHERE `{col}` IS NOT NULL".format(project = bq_project, schema = bq_schema, table = table, sample = sample, col = column)
+
+# Function to build a single query for all of the linkage and reverse linkage checks that point at a target table, so they run as one job. Each referenced target column and each referencing source column is defined (and unnested) once in a CTE.
+# BigQuery doesn't materialize CTEs, so each check still reads the columns it uses; grouping saves jobs, not bytes. With include_linkage_checks=False, only the reverse linkage checks are built.
+# When a sample percent is specified, only the side of each check being counted (the foreign key rows for linkage checks, the primary key values for reverse linkage checks) is sampled, so the other side is still complete.
+# Checks whose counted side is in unsampleable_table_set (e.g. a snapshot view) are run exactly.
+def build_referential_integrity_query(bq_project, bq_schema, target_table, relationship_list, pk_column_list, array_field_set, empty_table_list, sample_percent=None, unsampleable_table_set=(), include_linkage_checks=True):
+    cte_list = []
+    select_list = []
+    check_list = []
+
+    # Distinct keys of each referenced column of the target table
+    target_cte_dict = {}
+    for target_col in [rel[2] for rel in relationship_list] + [pk_entry["column"] for pk_entry in pk_column_list]:
+        if target_col not in target_cte_dict:
+            target_cte_dict[target_col] = "tar_{}".format(len(target_cte_dict))
+            cte_list.append("{cte} AS (SELECT DISTINCT key FROM ({keys}))".format(cte = target_cte_dict[target_col], keys = build_key_query(bq_project, bq_schema, target_table, target_col, array_field_set)))
+
+    # Non-null values of each source column that references the target table
+    source_cte_dict = {}
+    for source_table, source_col, target_col in relationship_list:
+        if (source_table, source_col) not in source_cte_dict:
+            source_cte_dict[(source_table, source_col)] = "src_{}".format(len(source_cte_dict))
+            cte_list.append("{cte} AS ({keys})".format(cte = source_cte_dict[(source_table, source_col)], keys = build_key_query(bq_project, bq_schema, source_table, source_col, array_field_set)))
+
+    # Sampled rows of each source column, for linkage checks, and sampled primary key values, for reverse linkage checks
+    sample_cte_dict = {}
+    if sample_percent is not None:
+        for source_table, source_col, target_col in (relationship_list if include_linkage_checks else []):
+            if (source_table, source_col) not in sample_cte_dict and source_table not in empty_table_list and source_table not in unsampleable_table_set:
+                sample_cte_dict[(source_table, source_col)] = "src_sample_{}".format(len(sample_cte_dict))
+                cte_list.append("{cte} AS ({keys})".format(cte = sample_cte_dict[(source_table, source_col)], keys = build_key_query(bq_project, bq_schema, source_table, source_col, array_field_set, sample_percent, unsampleable_table_set)))
+        for pk_entry in (pk_column_list if target_table not in unsampleable_table_set else []):
+            sample_cte_dict[(target_table, pk_entry["column"])] = "pk_sample_{}".format(len(sample_cte_dict))
+            cte_list.append("{cte} AS (SELECT DISTINCT key FROM ({keys}))".format(cte = sample_cte_dict[(target_table, pk_entry["column"])], keys = build_key_query(bq_project, bq_schema, target_table, pk_entry["column"], array_field_set, sample_percent, unsampleable_table_set)))
+
+    # Linkage checks: source rows with a value that doesn't join to the target column (skipped for empty source tables)
+    for source_table, source_col, target_col in (relationship_list if include_linkage_checks else []):
+        if source_table in empty_table_list:
+            continue
+        metric = "Count of non-null rows that do not fully join to {target}".format(target = target_table + "." + target_col)
+        select_list.append("""SELECT 'Referential Integrity' AS metric_type, '{table}' AS source_table, '{col}' AS source_column, 
+                       '{metric}' AS metric, 
+                       COUNT(DISTINCT CASE WHEN tar.key IS NULL THEN src.datarepo_row_id END) AS n, 
+                       COUNT(DISTINCT src.datarepo_row_id) AS d, 
+                       CASE WHEN COUNT(DISTINCT src.datarepo_row_id) > 0 THEN COUNT(DISTINCT CASE WHEN tar.key IS NULL THEN src.datarepo_row_id END)/COUNT(DISTINCT src.datarepo_row_id) END AS r, 
+                       CASE WHEN COUNT(DISTINCT CASE WHEN tar.key IS NULL THEN src.datarepo_row_id END) > 0 THEN 1 END AS flag
+                       FROM {src_cte} src LEFT JOIN {tar_cte} tar ON src.key = tar.key""".format(table = source_table, col = source_col, metric = metric, src_cte = sample_cte_dict.get((source_table, source_col), source_cte_dict[(source_table, source_col)]), tar_cte = target_cte_dict[target_col]))
+        check_list.append(("Referential Integrity", source_table, source_col, metric))
 
-    logging.info("Table-level queries complete. {0} queries executed.".format(query_count))
-    return df, empty_table_list
+    # Reverse linkage checks: primary key values that aren't referenced by any of the foreign key columns that point to them
+    for pk_entry in pk_column_list:
+        fk_cte = "fks_{}".format(len(cte_list))
+        fk_select_list = ["SELECT key FROM {cte}".format(cte = source_cte_dict[(rel[0], rel[1])]) for rel in relationship_list if rel[2] == pk_entry["column"]]
+        cte_list.append("{cte} AS ({fk_selects})".format(cte = fk_cte, fk_selects = " UNION DISTINCT ".join(fk_select_list)))
+        source_col_list_string = ", ".join([entry["table"] + "." + entry["column"] for entry in pk_entry["joins_from"]])
+        metric = "Count of rows where primary key is not referenced by foreign key fields ({fk_list})".format(fk_list = source_col_list_string)
+        select_list.append("""SELECT 'Referential Integrity' AS metric_type, '{table}' AS source_table, '{col}' AS source_column, 
+                       '{metric}' AS metric,
+                       COUNT(DISTINCT CASE WHEN fk.key IS NULL THEN pk.key END) AS n,
+                       COUNT(DISTINCT pk.key) AS d,
+                       CASE WHEN COUNT(DISTINCT pk.key) > 0 THEN COUNT(DISTINCT CASE WHEN fk.key IS NULL THEN pk.key END)/COUNT(DISTINCT pk.key) END AS r, 
+                       CASE WHEN COUNT(DISTINCT CASE WHEN fk.key IS NULL THEN pk.key END) > 0 THEN 1 END AS flag
+                       FROM {tar_cte} pk LEFT JOIN {fk_cte} fk ON pk.key = fk.key""".format(table = target_table, col = pk_entry["column"], metric = metric, tar_cte = sample_cte_dict.get((target_table, pk_entry["column"]), target_cte_dict[pk_entry["column"]]), fk_cte = fk_cte))
+        check_list.append(("Referential Integrity", target_table, pk_entry["column"], metric))
 
-# Function to collect column level statistics: null counts, unique counts, linkage counts (counts of records where foreign key doesn"t join to a primary key), and reverse linkage counts (counts of records where a primary key isn"t reference by any foriegn key)
-def run_column_profiling_checks(client, df, bq_project, bq_schema, field_list, array_field_set, empty_table_list):
+    if len(select_list) == 0:
+        return None, check_list
+    query = "WITH " + ",\n".join(cte_list) + "\n" + "\nUNION ALL\n".join(select_list)
+    return query, check_list
+
+# Function to build a separate query for each of the checks in build_referential_integrity_query's single query for a target table, in the order of its check list
+def build_referential_integrity_check_queries(bq_project, bq_schema, target_table, relationship_list, pk_column_list, array_field_set, empty_table_list, sample_percent=None, unsampleable_table_set=()):
+    query_list = []
+    for relationship in relationship_list:
+        if relationship[0] not in empty_table_list:
+            query_list.append(build_referential_integrity_query(bq_project, bq_schema, target_table, [relationship], [], array_field_set, empty_table_list, sample_percent, unsampleable_table_set)[0])
+    for pk_entry in pk_column_list:
+        pk_relationship_list = [relationship for relationship in relationship_list if relationship[2] == pk_entry["column"]]
+        query_list.append(build_referential_integrity_query(bq_project, bq_schema, target_table, pk_relationship_list, [pk_entry], array_field_set, empty_table_list, sample_percent, unsampleable_table_set, include_linkage_checks=False)[0])
+    return query_list
+
+# Function to convert the rows returned by a referential integrity query into result rows. Counts from a sample are marked as approximate with the bound on their ratio; each row's source table is the side that was sampled, unless it couldn't be.
+def referential_integrity_rows_to_results(rows, sample_percent, unsampleable_table_set):
+    result_list = rows_to_results(rows)
+    if sample_percent is not None:
+        for result_row in result_list:
+            if result_row[1] not in unsampleable_table_set:
+                result_row[3] = approximate_metric(result_row[3], sample_bound_description(result_row[4], result_row[5], sample_percent))
+    return result_list
+
+# Function to collect column level statistics: linkage counts (counts of records where foreign key doesn"t join to a primary key), and reverse linkage counts (counts of records where a primary key isn"t reference by any foriegn key)
+def run_column_profiling_checks(client, results, bq_project, bq_schema, field_list, array_field_set, empty_table_list, max_concurrent_queries=DEFAULT_MAX_CONCURRENT_QUERIES, sample_percent=None, cache=None, budget=None):
     logging.info("Building and executing column-level queries...")
-    # Loop through columns and pull null counts and distinct value counts
-    query_count = 0
+    # Group relationships (source table, source column, target column) and primary keys with reverse linkage checks by target table
+    relationship_dict = {}
+    pk_column_dict = {}
     for column_entry in field_list:
-    
-        # Skip column-level queries for tables that don't have records (to save processing time)
-        if column_entry["table"] not in empty_table_list:
-    
-            # Loop through join_to fields (if any) and build linkage queries
-            table_name = column_entry["table"]
-            col_name = column_entry["column"]
-            for join_entry in column_entry["joins_to"]:
-
-                # Set parameters for linkage queries
-                target_table = join_entry["table"]
-                target_col = join_entry["column"]
-                target_table_col = target_table + "." + target_col
-                if column_entry["is_array"] == True:
-                    src_col_name = "{col}_unnest".format(col = col_name)
-                    from_statement = "(select * from `{project}.{schema}.{table}` t left join unnest(t.{col}) as {unnest_col}) src".format(project = bq_project, schema = bq_schema, table = table_name, col = col_name, unnest_col = src_col_name)
-                    where_statement = "array_length(src.{col}) > 0".format(col = col_name)
-                else:
-                    src_col_name = col_name
-                    from_statement = "`{project}.{schema}.{table}` src".format(project = bq_project, schema = bq_schema, table = table_name)
-                    where_statement = "src.{col} is not null".format(col = col_name)
-                if target_table_col in array_field_set:
-                    tar_col_name = "{col}_unnest".format(col = target_col)
-                    join_statement = "(select * from `{project}.{schema}.{table}` t left join unnest(t.{col}) as {unnest_col}) tar".format(project = bq_project, schema = bq_schema, table = target_table, col = target_col, unnest_col = tar_col_name)
+        for join_entry in column_entry["joins_to"]:
+            relationship_dict.setdefault(join_entry["table"], []).append((column_entry["table"], column_entry["column"], join_entry["column"]))
+        # Skip reverse linkage checks for tables that don't have records (to save processing time)
+        if column_entry["is_primary_key"] == True and len(column_entry["joins_from"]) > 0 and column_entry["table"] not in empty_table_list:
+            pk_column_dict.setdefault(column_entry["table"], []).append(column_entry)
+
+    # Collect the tables that can't be sampled, if queries will be sampled (or may fall back to sampling to fit the bytes budget)
+    unsampleable_table_set = set()
+    if sample_percent is not None or budget is not None:
+        unsampleable_table_set = get_unsampleable_table_set(client, bq_project, bq_schema, set([column_entry["table"] for column_entry in field_list]))
+        if sample_percent is not None and len(unsampleable_table_set) > 0:
+            logging.warning("Tables that can't be sampled (e.g. snapshot views) will be read in full for linkage checks: {}".format(", ".join(sorted(unsampleable_table_set))))
+
+    # Build one query per target table (and, when running against a bytes budget without sampling, a sampled fallback for each, or None when none of its checks can be sampled)
+    query_list = []
+    fallback_query_list = []
+    check_group_list = []
+    target_table_list = []
+    for target_table in sorted(set(relationship_dict.keys()).union(pk_column_dict.keys())):
+        query, check_list = build_referential_integrity_query(bq_project, bq_schema, target_table, relationship_dict.get(target_table, []), pk_column_dict.get(target_table, []), array_field_set, empty_table_list, sample_percent, unsampleable_table_set)
+        if query is not None:
+            #print(query)
+            query_list.append(query)
+            check_group_list.append(check_list)
+            target_table_list.append(target_table)
+            if budget is not None and sample_percent is None:
+                fallback_query = build_referential_integrity_query(bq_project, bq_schema, target_table, relationship_dict.get(target_table, []), pk_column_dict.get(target_table, []), array_field_set, empty_table_list, DEFAULT_SAMPLE_PERCENT, unsampleable_table_set)[0]
+                fallback_query_list.append(fallback_query if fallback_query != query else None)
+
+    # Apply the bytes budget (if any)
+    result_list = []
+    variant_list = ["exact"] * len(query_list)
+    if budget is not None:
+        variant_list, cost_rows = apply_query_budget(client, budget, "referential integrity", query_list, [(target_table, "All") for target_table in target_table_list], max_concurrent_queries, cache, fallback_query_list if sample_percent is None else None)
+        result_list.extend(cost_rows)
+    run_idx_list = [idx for idx, variant in enumerate(variant_list) if variant is not None]
+    run_query_list = [fallback_query_list[idx] if variant_list[idx] == "fallback" else query_list[idx] for idx in run_idx_list]
+
+    sample_percent_list = [DEFAULT_SAMPLE_PERCENT if variant == "fallback" else sample_percent for variant in variant_list]
+
+    # Execute the queries concurrently
+    query_results = dict(zip(run_idx_list, execute_queries(client, run_query_list, max_concurrent_queries, cache)))
+
+    # A grouped query fails as a whole, so re-run the checks of each failed group one by one, so one failing check doesn't take down the others
+    retry_query_dict = {}
+    for idx, (rows, error) in query_results.items():
+        if error is not None and len(check_group_list[idx]) > 1:
+            logging.warning("Referential integrity query for {0} failed. Re-running its {1} checks one by one.".format(target_table_list[idx], len(check_group_list[idx])))
+            retry_query_dict[idx] = build_referential_integrity_check_queries(bq_project, bq_schema, target_table_list[idx], relationship_dict.get(target_table_list[idx], []), pk_column_dict.get(target_table_list[idx], []), array_field_set, empty_table_list, sample_percent_list[idx], unsampleable_table_set)
+    retry_idx_list = sorted(retry_query_dict.keys())
+    retry_results = iter(execute_queries(client, [query for idx in retry_idx_list for query in retry_query_dict[idx]], max_concurrent_queries, cache))
+
+    # Record results in the order the queries were built
+    for idx, check_list in enumerate(check_group_list):
+        if idx not in query_results:
+            result_list.extend([build_skipped_row(*check) for check in check_list])
+            continue
+        rows, error = query_results[idx]
+        if idx in retry_query_dict:
+            for check in check_list:
+                check_rows, check_error = next(retry_results)
+                if check_error is not None:
+                    result_list.append(build_error_row(*check, check_error))
                 else:
-                    tar_col_name = target_col
-                    join_statement = "`{project}.{schema}.{table}` tar".format(project = bq_project, schema = bq_schema, table = target_table)
+                    result_list.extend(referential_integrity_rows_to_results(check_rows, sample_percent_list[idx], unsampleable_table_set))
+        elif error is not None:
+            result_list.extend([build_error_row(*check, error) for check in check_list])
+        else:
+            result_list.extend(referential_integrity_rows_to_results(rows, sample_percent_list[idx], unsampleable_table_set))
+    results.add(result_list)
 
-                # Construct the linkage query
-                linkage_query = """SELECT 'Referential Integrity' AS metric_type, '{table}' AS source_table, '{col}' AS source_column, 
-                       'Count of non-null rows that do not fully join to {target}' AS metric, 
-                       COUNT(DISTINCT CASE WHEN tar.datarepo_row_id IS NULL THEN src.datarepo_row_id END) AS n, 
-                       COUNT(DISTINCT src.datarepo_row_id) AS d, 
-                       CASE WHEN COUNT(DISTINCT src.datarepo_row_id) > 0 THEN COUNT(DISTINCT CASE WHEN tar.datarepo_row_id IS NULL THEN src.datarepo_row_id END)/COUNT(DISTINCT src.datarepo_row_id) END AS r, 
-                       CASE WHEN COUNT(DISTINCT CASE WHEN tar.datarepo_row_id IS NULL THEN src.datarepo_row_id END) > 0 THEN 1 END AS flag
-                       FROM {frm}
-                       LEFT JOIN {join}
-                       ON src.{src_col} = tar.{tar_col}
-                       WHERE {where}""".format(project = bq_project, schema = bq_schema, table = table_name, col = col_name, target = target_table_col, frm = from_statement, join = join_statement, src_col = src_col_name, tar_col = tar_col_name, where = where_statement)
-
-                # Execute the referential integrity query and append results to dataframe
-                query_count += 1
-                #print(linkage_query)
-                try:
-                    df = df.append(client.query(linkage_query).result().to_dataframe())
-                except Exception as e:
-                    logging.error("Error during query execution: {}".format(str(e)))
-
-            # For primary key fields, loop through join_from fields and build reverse linkage checks
-            if column_entry["is_primary_key"] == True and len(column_entry["joins_from"]) > 0:
-
-                # Construct CTE that includes all foreign keys that reference the primary key
-                counter = 0
-                cte_query = "WITH temp_fks AS ("
-                source_col_list = []
-                for entry in column_entry["joins_from"]:
-                    cte_query_segment = ""
-                    counter += 1
-                    source_table = entry["table"]
-                    source_column = entry["column"]
-                    source_table_col = entry["table"] + "." + entry["column"]
-                    source_col_list.append(source_table_col)
-                    if counter > 1:
-                        cte_query_segment = "UNION ALL "
-                    if source_table_col in array_field_set:
-                        cte_query_segment += "SELECT DISTINCT {tar_col} FROM `{project}.{schema}.{table}` CROSS JOIN UNNEST({src_col}) AS {tar_col}".format(project = bq_project, schema = bq_schema, table = source_table, src_col = source_column, tar_col = col_name)
-                    else:
-                        cte_query_segment += "SELECT DISTINCT {src_col} as {tar_col}  FROM `{project}.{schema}.{table}`".format(project = bq_project, schema = bq_schema, table = source_table, src_col = source_column, tar_col = col_name)
-                    cte_query = cte_query + cte_query_segment + " "
-                cte_query = cte_query + ")"
-                source_col_list_string = ", ".join(source_col_list)
-
-                # Construct the reverse linkage query
-                reverse_linkage_query = """{cte} SELECT 'Referential Integrity' As metric_type, '{table}' AS source_table, '{col}' AS source_column, 
-                                      'Count of rows where primary key is not referenced by foreign key fields ({fk_list})' AS metric,
-                                      COUNT(DISTINCT CASE WHEN tar.{col} IS NULL THEN src.{col} END) AS n,
-                                      COUNT(DISTINCT src.{col}) AS d,
-                                      CASE WHEN COUNT(DISTINCT src.{col}) > 0 THEN COUNT(DISTINCT CASE WHEN tar.{col} IS NULL THEN src.{col} END)/COUNT(DISTINCT src.{col}) END AS r, 
-                                      CASE WHEN COUNT(DISTINCT CASE WHEN tar.{col} IS NULL THEN src.{col} END) > 0 THEN 1 END AS flag
-                                      FROM `{project}.{schema}.{table}` src LEFT JOIN temp_fks tar ON src.{col} = tar.{col}""".format(cte = cte_query, project = bq_project, schema = bq_schema, table = table_name, col = col_name, fk_list = source_col_list_string)
-
-                # Execute the reverse linkage query and append results to dataframe
-                query_count += 1
-                #print(reverse_linkage_query)
-                try:
-                    df = df.append(client.query(reverse_linkage_query).result().to_dataframe())
-                except Exception as e:
-                    logging.error("Error during query execution: {}".format(str(e)))
-                
-    logging.info("Column-level queries complete. {0} queries executed.".format(query_count))
-    return df
+    logging.info("Column-level queries complete. {0} queries executed for {1} checks.".format(len(run_idx_list) + sum(len(query_list) for query_list in retry_query_dict.values()), sum(len(check_list) for check_list in check_group_list)))
 
 # Function to collect the files in TDR that aren't referenced in the table data
-def run_orphan_file_checks(client, df, bq_project, bq_schema, field_list, array_field_set):
+def run_orphan_file_checks(client, results, bq_project, bq_schema, field_list, array_field_set, max_concurrent_queries=DEFAULT_MAX_CONCURRENT_QUERIES, approximate=False, cache=None, budget=None):
     logging.info("Building and executing orphaned files query...")
     # Collect file reference fields
     file_ref_list = []
@@ -373,26 +740,47 @@ def run_orphan_file_checks(client, df, bq_project, bq_schema, field_list, array_
                           FROM `{project}.{schema}.datarepo_load_history` src LEFT JOIN temp_fks tar ON src.file_id = tar.file_id
                           WHERE state = 'succeeded'""".format(cte = cte_query, project = bq_project, schema = bq_schema, fk_list = source_col_list_string)
 
-    # Execute the orphaned files query and append results to dataframe
+    # In fast mode, estimate the orphaned files by comparing HyperLogLog sketches instead: |loaded - referenced| = |loaded U referenced| - |referenced|
+    if approximate:
+        orphaned_file_query = """{cte}, loaded AS (SELECT HLL_COUNT.INIT(file_id, {precision}) AS sketch FROM `{project}.{schema}.datarepo_load_history` WHERE state = 'succeeded'),
+                              referenced AS (SELECT HLL_COUNT.INIT(file_id, {precision}) AS sketch FROM temp_fks)
+                              SELECT IFNULL(HLL_COUNT.EXTRACT(l.sketch), 0) AS loaded_count,
+                              IFNULL(HLL_COUNT.EXTRACT(r.sketch), 0) AS referenced_count,
+                              IFNULL((SELECT HLL_COUNT.MERGE(sketch) FROM (SELECT l.sketch AS sketch UNION ALL SELECT r.sketch)), 0) AS union_count
+                              FROM loaded l CROSS JOIN referenced r""".format(cte = cte_query, precision = HLL_PRECISION, project = bq_project, schema = bq_schema)
+
+    # Execute the orphaned files query and record results
     #print(orphaned_file_query)
-    try:
-        df_temp = client.query(orphaned_file_query).result().to_dataframe()
-        df = df.append(df_temp)
-        orphan_count = df_temp["n"].values[0]
-    except Exception as e:
-        logging.error("Error during query execution: {}".format(str(e)))
+    metric = "Count of file_ids not referenced by a fileref field ({fk_list})".format(fk_list = source_col_list_string)
+    if budget is not None:
+        variant_list, cost_rows = apply_query_budget(client, budget, "orphaned files", [orphaned_file_query], [("datarepo_load_history", "file_id")], max_concurrent_queries, cache)
+        results.add(cost_rows)
+        if variant_list[0] is None:
+            results.add([build_skipped_row("Orphaned Files", "datarepo_load_history", "file_id", metric)])
+            logging.info("Orphaned file query skipped.")
+            return
+    rows, error = execute_queries(client, [orphaned_file_query], max_concurrent_queries, cache)[0]
+    if error is not None:
+        results.add([build_error_row("Orphaned Files", "datarepo_load_history", "file_id", metric, error)])
+    elif approximate:
+        loaded_count = rows[0]["loaded_count"]
+        orphan_count = max(rows[0]["union_count"] - rows[0]["referenced_count"], 0)
+        orphan_bound = int(round(HLL_RELATIVE_ERROR*(rows[0]["union_count"] + rows[0]["referenced_count"])))
+        results.add([["Orphaned Files", "datarepo_load_history", "file_id", approximate_metric(metric, "HyperLogLog++ sketch estimate, n +/- {0} at 95% confidence".format(orphan_bound)),
+                      orphan_count, loaded_count, orphan_count/loaded_count if loaded_count > 0 else None, 1 if orphan_count > 0 else None]])
+    else:
+        results.add(rows_to_results(rows))
+        orphan_count = rows[0]["n"]
     
     logging.info("Orphaned file query complete. {0} orphaned files found.".format(orphan_count))
-    return df
 
 # Function to compare the TDR schema definition with the referenced schema definition
-def run_schema_comparison_checks(df, tdr_schema_dict, comparison_schema):
+def run_schema_comparison_checks(results, tdr_schema_dict, comparison_schema):
     logging.info("Executing schema comparison checks...")
     result_list = []
     # Table existence comparison
     tdr_table_set = set()
     comp_table_set = set()
-    #disjunctive_table_set = set()
     for table_entry in tdr_schema_dict["tables"]:
         tdr_table_set.add(table_entry["name"])
     try:
@@ -410,100 +798,73 @@ def run_schema_comparison_checks(df, tdr_schema_dict, comparison_schema):
     disjunctive_table_set = in_tdr_not_comp.union(in_comp_not_tdr)
     logging.info("Table comparison results: \n Count tables present in TDR schema but not comparison schema file: {0} \n Count tables present in comparison schema file but not TDR schema: {1}".format(len(in_tdr_not_comp), len(in_comp_not_tdr)))
     
-    # Column existence comparison
-    tdr_column_set = set()
-    comp_column_set = set()
+    # Index columns by (table, column) for both schemas
+    tdr_column_dict = {}
+    comp_column_dict = {}
     for table_entry in tdr_schema_dict["tables"]:
-        if table_entry["name"] not in disjunctive_table_set:
-            for column_entry in table_entry["columns"]:
-                tdr_column_set.add(table_entry["name"] + " - " + column_entry["name"])
+        for column_entry in table_entry["columns"]:
+            tdr_column_dict[(table_entry["name"], column_entry["name"])] = column_entry
     try:
         for table_entry in comparison_schema["tables"]:
-            if table_entry["name"] not in disjunctive_table_set:
-                for column_entry in table_entry["columns"]:
-                    comp_column_set.add(table_entry["name"] + " - " + column_entry["name"]) 
+            for column_entry in table_entry["columns"]:
+                comp_column_dict[(table_entry["name"], column_entry["name"])] = column_entry
     except KeyError:
         logging.error("Comparison schema file 'tables' property is missing or malformed. Will skip remaining schema comparison checks.")
         return
+
+    # Column existence comparison
+    tdr_column_set = set([key for key in tdr_column_dict if key[0] not in disjunctive_table_set])
+    comp_column_set = set([key for key in comp_column_dict if key[0] not in disjunctive_table_set])
     in_tdr_not_comp = tdr_column_set.difference(comp_column_set)
-    for item in in_tdr_not_comp:
-        result_list.append(["Schema Comparison", item.split(" - ")[0], item.split(" - ")[1], "In TDR schema but not comparison schema", 0, 0, 0, 0])
+    for table_name, column_name in in_tdr_not_comp:
+        result_list.append(["Schema Comparison", table_name, column_name, "In TDR schema but not comparison schema", 0, 0, 0, 0])
     in_comp_not_tdr = comp_column_set.difference(tdr_column_set)
-    for item in in_comp_not_tdr:
-        result_list.append(["Schema Comparison", item.split(" - ")[0], item.split(" - ")[1], "In comparison schema but not TDR schema", 0, 0, 0, 1])  
+    for table_name, column_name in in_comp_not_tdr:
+        result_list.append(["Schema Comparison", table_name, column_name, "In comparison schema but not TDR schema", 0, 0, 0, 1])  
     logging.info("Column comparison results for tables present in both schemas: \n Count columns present in TDR schema but not comparison schema file: {0} \n Count columns present in comparison schema file but not TDR schema: {1}".format(len(in_tdr_not_comp), len(in_comp_not_tdr)))
     
-    # Column attribute differences
-    column_diff_set = set()
+    # Column attribute differences (missing "array_of" and "required" attributes default to False)
+    column_diff_dict = {}
     try:
-        for table_entry in comparison_schema["tables"]:
-            for column_entry in table_entry["columns"]:
-                for tdr_table_entry in tdr_schema_dict["tables"]:
-                    if tdr_table_entry["name"] == table_entry["name"]:
-                        for tdr_column_entry in tdr_table_entry["columns"]:
-                            if tdr_column_entry["name"] == column_entry["name"]:
-                                diff_attr_list = []
-                                # Compare "datatype" attribute
-                                if tdr_column_entry["datatype"] != column_entry["datatype"]:
-                                    diff_attr_list.append("datatype")
-                                
-                                # Compare "array_of" attribute
-                                try:
-                                    comp_array_of = column_entry["array_of"]
-                                except KeyError:
-                                    comp_array_of = False
-                                try:
-                                    tdr_array_of = tdr_column_entry["array_of"]
-                                except KeyError:
-                                    tdr_array_of = False
-                                if comp_array_of != tdr_array_of:
-                                    diff_attr_list.append("array_of")
-                                
-                                # Compare "required" attribute
-                                try:
-                                    comp_required = column_entry["required"]
-                                except KeyError:
-                                    comp_required = False
-                                try:
-                                    tdr_required = tdr_column_entry["required"]
-                                except KeyError:
-                                    tdr_required = False
-                                if comp_required != tdr_required:
-                                    diff_attr_list.append("required")
-                                
-                                # Add column differences to column_diff_set
-                                if len(diff_attr_list) > 0:
-                                    diff_attr_str = ','.join(diff_attr_list)
-                                    column_diff_set.add(table_entry["name"] + " - " + column_entry["name"] + " - " + diff_attr_str)
+        for column_key, column_entry in comp_column_dict.items():
+            tdr_column_entry = tdr_column_dict.get(column_key)
+            if tdr_column_entry is not None:
+                diff_attr_list = []
+                if tdr_column_entry["datatype"] != column_entry["datatype"]:
+                    diff_attr_list.append("datatype")
+                if tdr_column_entry.get("array_of", False) != column_entry.get("array_of", False):
+                    diff_attr_list.append("array_of")
+                if tdr_column_entry.get("required", False) != column_entry.get("required", False):
+                    diff_attr_list.append("required")
+                if len(diff_attr_list) > 0:
+                    column_diff_dict[column_key] = ",".join(diff_attr_list)
     except KeyError:
         logging.error("Comparison schema file 'tables' property is missing or malformed. Will skip remaining schema comparison checks.")
         return
-    for item in column_diff_set:
-        result_list.append(["Schema Comparison", item.split(" - ")[0], item.split(" - ")[1], "Difference in attributes of shared column (" + item.split(" - ")[2] + ")", 0, 0, 0, 1])  
-    logging.info("Column attribute comparison results for columns present in both schemas: \n Count columns with differing attributes between TDR schema and comparison schema file: {0}".format(len(column_diff_set)))
+    for (table_name, column_name), diff_attr_str in column_diff_dict.items():
+        result_list.append(["Schema Comparison", table_name, column_name, "Difference in attributes of shared column (" + diff_attr_str + ")", 0, 0, 0, 1])  
+    logging.info("Column attribute comparison results for columns present in both schemas: \n Count columns with differing attributes between TDR schema and comparison schema file: {0}".format(len(column_diff_dict)))
     
-    # Relationship existence comparison
+    # Relationship existence comparison, keyed on (from table, from column, to table, to column)
     tdr_relationship_set = set()
     comp_relationship_set = set()
     for rel_entry in tdr_schema_dict["relationships"]:
-        tdr_relationship_set.add(rel_entry["_from"]["table"] + " - " + rel_entry["_from"]["column"] + " - " + rel_entry["to"]["table"] + " - " + rel_entry["to"]["column"])
+        tdr_relationship_set.add((rel_entry["_from"]["table"], rel_entry["_from"]["column"], rel_entry["to"]["table"], rel_entry["to"]["column"]))
     try:
         for rel_entry in comparison_schema["relationships"]:
-            comp_relationship_set.add(rel_entry["from"]["table"] + " - " + rel_entry["from"]["column"] + " - " + rel_entry["to"]["table"] + " - " + rel_entry["to"]["column"])
+            comp_relationship_set.add((rel_entry["from"]["table"], rel_entry["from"]["column"], rel_entry["to"]["table"], rel_entry["to"]["column"]))
     except KeyError:
         logging.warning("Comparison schema file 'relationships' property is missing or malformed. Will continue schema comparison checks as if the schema has no relationships recorded.")
     in_tdr_not_comp = tdr_relationship_set.difference(comp_relationship_set)
-    for item in in_tdr_not_comp:
-        result_list.append(["Schema Comparison", item.split(" - ")[0], item.split(" - ")[1], "Relationship in TDR schema but not comparison schema (to " + item.split(" - ")[2] + "." + item.split(" - ")[3] + ")", 0, 0, 0, 0])
+    for from_table, from_column, to_table, to_column in in_tdr_not_comp:
+        result_list.append(["Schema Comparison", from_table, from_column, "Relationship in TDR schema but not comparison schema (to " + to_table + "." + to_column + ")", 0, 0, 0, 0])
     in_comp_not_tdr = comp_relationship_set.difference(tdr_relationship_set)
-    for item in in_comp_not_tdr:
-        result_list.append(["Schema Comparison", item.split(" - ")[0], item.split(" - ")[1], "Relationship in comparison schema but not TDR schema (to " + item.split(" - ")[2] + "." + item.split(" - ")[3] + ")", 0, 0, 0, 1])
+    for from_table, from_column, to_table, to_column in in_comp_not_tdr:
+        result_list.append(["Schema Comparison", from_table, from_column, "Relationship in comparison schema but not TDR schema (to " + to_table + "." + to_column + ")", 0, 0, 0, 1])
     logging.info("Relationship comparison results: \n Count relationships present in TDR schema but not comparison schema file: {0} \n Count relationships present in comparison schema file but not TDR schema: {1}".format(len(in_tdr_not_comp), len(in_comp_not_tdr)))
 
-    # Write out and append results to dataframe
-    df_results = pd.DataFrame(result_list, columns = ["metric_type", "source_table", "source_column", "metric", "n", "d", "r", "flag"])
-    df = df.append(df_results)
-    return df
+    # Record results
+    results.add(result_list)
 
 # Main function
 def main():
@@ -574,7 +935,37 @@ def main():
                 logging.warning("Error reading in the file specified in schemaFilePath parameter. Will skip schema comparison checks. Please verify this is a properly formatted JSON file and re-run if these checks are needed.") 
         else:
             logging.warning("File not found for specified schemaFilePath parameter. Will skip schema comparison checks.")
-    logging.info("Input parameters collected: \n uuid: {0} \n storage_type: {1} \n env: {2} \n schema_file_path: {3} \n run_schema_compare: {4} \n output_file_path: {5}".format(uuid, storage_type, env, schema_file_path, run_schema_compare, output_file_path))
+    stream_format = parsedArgs.streamResultsFormat
+    stream_file_path = None
+    if stream_format is not None:
+        if stream_format not in ["tsv", "csv", "parquet"]:
+            logging.warning("Invalid streamResultsFormat parameter passed. Will skip streaming results.")
+            stream_format = None
+        else:
+            stream_file_path = output_file_path[:-len(".tsv")] + "_partial." + stream_format
+    fast_mode = parsedArgs.fast
+    sample_percent = None
+    if fast_mode:
+        sample_percent = parsedArgs.samplePercent
+        if sample_percent is None:
+            sample_percent = DEFAULT_SAMPLE_PERCENT
+        elif sample_percent <= 0 or sample_percent > 100:
+            logging.warning("Invalid samplePercent parameter passed. Will default to using {}.".format(DEFAULT_SAMPLE_PERCENT))
+            sample_percent = DEFAULT_SAMPLE_PERCENT
+    elif parsedArgs.samplePercent is not None:
+        logging.warning("The samplePercent parameter is only used with --fast. Will run exact checks.")
+    cache_file_path = parsedArgs.cacheFilePath
+    max_bytes = parsedArgs.maxBytes
+    if max_bytes is not None and max_bytes < 0:
+        logging.warning("Invalid maxBytes parameter passed. Will run all checks without a bytes budget.")
+        max_bytes = None
+    max_concurrent_queries = parsedArgs.maxConcurrentQueries
+    if max_concurrent_queries is None:
+        max_concurrent_queries = DEFAULT_MAX_CONCURRENT_QUERIES
+    elif max_concurrent_queries < 1:
+        logging.warning("Invalid maxConcurrentQueries parameter passed. Will default to using {}.".format(DEFAULT_MAX_CONCURRENT_QUERIES))
+        max_concurrent_queries = DEFAULT_MAX_CONCURRENT_QUERIES
+    logging.info("Input parameters collected: \n uuid: {0} \n storage_type: {1} \n env: {2} \n schema_file_path: {3} \n run_schema_compare: {4} \n output_file_path: {5} \n stream_file_path: {6} \n fast_mode: {7} \n sample_percent: {8} \n cache_file_path: {9} \n max_bytes: {10} \n max_concurrent_queries: {11}".format(uuid, storage_type, env, schema_file_path, run_schema_compare, output_file_path, stream_file_path, fast_mode, sample_percent, cache_file_path, max_bytes, max_concurrent_queries))
 
     # Setup Google Creds
     creds, project = google.auth.default()
@@ -594,29 +985,48 @@ def main():
     table_set, array_field_set, field_list, relationship_count = process_tdr_schema(tdr_schema_dict)
     logging.info("TDR object identified and schema parsed: \n BQ project id: {0} \n BQ dataset name: {1} \n table count: {2} \n field count: {3} \n array field count: {4} \n relationships count: {5}".format(bq_project, bq_schema, len(table_set), len(field_list), len(array_field_set), relationship_count))
 
-    # Initialize metric collect from BigQuery and create dataframe to store results 
+    # Initialize metric collect from BigQuery and create collector to store results 
     client = bigquery.Client()
-    df = pd.DataFrame(columns = ["metric_type", "source_table", "source_column", "metric", "n", "d", "r", "flag"])
+    try:
+        results = ResultCollector(stream_file_path, stream_format)
+    except Exception as e:
+        logging.warning("Error opening {0} to stream results ({1}). Will skip streaming results.".format(stream_file_path, str(e)))
+        results = ResultCollector()
+
+    # Load the query cache, if requested
+    cache = None
+    if cache_file_path is not None and not skip_bq_queries == True:
+        cache = QueryCache(client, cache_file_path, bq_project, bq_schema)
+
+    # Set up the bytes budget, if requested
+    budget = QueryBudget(max_bytes) if max_bytes is not None else None
 
     # Run validation checks
-    if run_schema_compare == True:
-        df = run_schema_comparison_checks(df, tdr_schema_dict, comparison_schema) 
-    if not skip_bq_queries == True:
-        df, empty_table_list = run_table_profiling_checks(client, df, bq_project, bq_schema, table_set, field_list)
-        df = run_column_profiling_checks(client, df, bq_project, bq_schema, field_list, array_field_set, empty_table_list)
-        if storage_type == "dataset":
-            df = run_orphan_file_checks(client, df, bq_project, bq_schema, field_list, array_field_set)
+    try:
+        if run_schema_compare == True:
+            run_schema_comparison_checks(results, tdr_schema_dict, comparison_schema) 
+        if not skip_bq_queries == True:
+            empty_table_list = run_table_profiling_checks(client, results, bq_project, bq_schema, table_set, field_list, max_concurrent_queries, fast_mode, cache, budget)
+            run_column_profiling_checks(client, results, bq_project, bq_schema, field_list, array_field_set, empty_table_list, max_concurrent_queries, sample_percent, cache, budget)
+            if storage_type == "dataset":
+                run_orphan_file_checks(client, results, bq_project, bq_schema, field_list, array_field_set, max_concurrent_queries, fast_mode, cache, budget)
+            if budget is not None:
+                logging.info(budget.summary())
+            if cache is not None:
+                logging.info("Query cache used: {0} queries served from {1}.".format(cache.hit_count, cache_file_path))
+    finally:
+        results.close()
 
     # Write out results to TSV
     logging.info("Attempting to write results out to {}...".format(output_file_path))
-    df_final = df.fillna(0)
+    df_final = results.to_dataframe().fillna(0)
     df_final.sort_values(by=["metric_type", "source_table", "source_column", "metric"], inplace=True, ignore_index=True)
     try:
         df_final.to_csv(output_file_path, index=False, sep="\t")
         logging.info("Results write-out complete.")
     except:
         new_output_file_path = "results_{0}_{1}.tsv".format(uuid, current_datetime_string)
-        logging.warning("Error writing results to {0}. Attempting to write results to {1}} instead...".format(output_file_path, new_output_file_path)) 
+        logging.warning("Error writing results to {0}. Attempting to write results to {1} instead...".format(output_file_path, new_output_file_path)) 
         output_file_path = new_output_file_path
         try:
             df_final.to_csv(output_file_path, index=False, sep="\t")
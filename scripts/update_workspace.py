@@ -1,13 +1,10 @@
-import os
-import subprocess
 import ast
-import shutil
 import argparse
-from fiss_fns import call_fiss
+from fiss_fns import call_fiss, rewrite_notebooks, upsert_entity_batches
 from firecloud import api as fapi
 
 
-def update_notebooks(workspace_name, workspace_project, replace_this, with_this):
+def update_notebooks(workspace_name, workspace_project, replace_this, with_this, max_workers=8):
     print("Updating NOTEBOOKS for " + workspace_name)
 
     ## update notebooks
@@ -17,62 +14,22 @@ def update_notebooks(workspace_name, workspace_project, replace_this, with_this)
     workspace = r.json()
     bucket = workspace['workspace']['bucketName']
 
-    # check if bucket is empty
-    gsutil_args = ['gsutil', 'ls', 'gs://' + bucket + '/']
-    bucket_files = subprocess.check_output(gsutil_args)
-    # Check output produces a string in Py2, Bytes in Py3, so decode if necessary
-    if type(bucket_files) == bytes:
-        bucket_files = bucket_files.decode().split('\n')
-    # print(bucket_files)
-
-    editingFolder = "../notebookEditingFolder"
-
-    # if the bucket isn't empty, check for notebook files and copy them
-    if 'gs://'+bucket+'/notebooks/' in bucket_files: #len(bucket_files)>0:
-        # bucket_prefix = 'gs://' + bucket
-        # Creating the Notebook Editing Folder
-        if os.path.exists(editingFolder):
-            shutil.rmtree(editingFolder)
-        os.mkdir(editingFolder)
-        # Runing a gsutil ls to list files present in the bucket
-        gsutil_args = ['gsutil', 'ls', 'gs://' + bucket + '/notebooks/**']
-        bucket_files = subprocess.check_output(gsutil_args, stderr=subprocess.PIPE)
-        # Check output produces a string in Py2, Bytes in Py3, so decode if necessary
-        if type(bucket_files) == bytes:
-            bucket_files = bucket_files.decode().split('\n')
-        #Getting all notebook files
-        notebook_files = []
-        print("Copying files to local disk...")
-        for bf in bucket_files:
-            if ".ipynb" in bf:
-                notebook_files.append(bf)
-                # Downloading notebook to Notebook Editing Folder
-                gsutil_args = ['gsutil', 'cp', bf, editingFolder]
-                print('  copying '+bf)
-                copyFiles = subprocess.check_output(gsutil_args, stderr=subprocess.PIPE)
-        #Does URL replacement
-        print("Replacing text in files...")
-        sed_command = "sed -i '' -e 's#{replace_this}#{with_this}#' {editing_folder}/*.ipynb".format(
-                                        replace_this=replace_this,
-                                        with_this=with_this,
-                                        editing_folder=editingFolder)
-        os.system(sed_command)
-        #Upload notebooks back into workspace
-        print("Uploading files to bucket...")
-        for filename in os.listdir(editingFolder):
-            if not filename.startswith('.'):
-                if not filename.endswith(".ipynb"):
-                    print("  WARNING: non notebook file, not replacing "+filename)
-                else:
-                    print('  uploading '+filename)
-                    gsutil_args = ['gsutil', 'cp', editingFolder+'/'+filename,  'gs://' + bucket+"/notebooks/"+filename]
-                    uploadfiles = subprocess.check_output(gsutil_args, stderr=subprocess.PIPE)
-                    #Remove notebook from the Notebook Editing Folder
-                    os.remove(editingFolder+'/'+filename)
-        #Deleting Notebook Editing Folder to delete any old files lingering in the folder
-        shutil.rmtree(editingFolder)
-    else:
-        print("Workspace has no notebooks folder")
+    # rewrite notebooks in place in the bucket; anything changed since it was read is left alone
+    results = rewrite_notebooks(bucket, replace_this, with_this, max_workers=max_workers)
+
+    if not results:
+        print("Workspace has no notebooks")
+        return results
+
+    for blob_name, status, error in results:
+        if status == 'updated':
+            print('  updated gs://' + bucket + '/' + blob_name)
+        elif status != 'unchanged':
+            print('  WARNING: ' + status + ' gs://' + bucket + '/' + blob_name + ' - ' + str(error))
+    n_updated = sum(status == 'updated' for _, status, _ in results)
+    print(str(n_updated) + ' of ' + str(len(results)) + ' notebooks updated')
+
+    return results
 
 
 def find_and_replace(attr, value, replace_this, with_this):
@@ -124,7 +81,7 @@ def update_attributes(workspace_name, workspace_project, replace_this, with_this
                 print(attr)
 
 
-def update_entities(workspace_name, workspace_project, replace_this, with_this):
+def update_entities(workspace_name, workspace_project, replace_this, with_this, max_workers=4):
     ## update workspace entities
     print("Updating DATA ENTITIES for " + workspace_name)
 
@@ -132,6 +89,8 @@ def update_entities(workspace_name, workspace_project, replace_this, with_this):
     response = call_fiss(fapi.get_entities_with_type, 200, workspace_project, workspace_name)
     entities = response
 
+    # collect the updates for every entity, then apply them in batchUpsert requests
+    entity_updates = []
     for ent in entities:
         ent_name = ent['name']
         ent_type = ent['entityType']
@@ -144,10 +103,13 @@ def update_entities(workspace_name, workspace_project, replace_this, with_this):
                 attrs_list.append(updated_attr)
 
         if len(attrs_list) > 0:
-            response = fapi.update_entity(workspace_project, workspace_name, ent_type, ent_name, attrs_list)
-            if response.status_code == 200:
-                print('Updated entities:')
-                for attr in attrs_list:
+            entity_updates.append((ent_type, ent_name, attrs_list))
+
+    for batch, status_code, error in upsert_entity_batches(workspace_project, workspace_name, entity_updates, max_workers=max_workers):
+        if error is None:
+            print('Updated entities:')
+            for entity in batch:
+                for attr in entity['operations']:
                     print('   '+attr['attributeName']+' : '+attr['addUpdateAttribute'])
 
 
@@ -178,7 +140,7 @@ def is_gs_path(attr, value, str_match='gs://'):
 
     return False
 
-def update_entity_data_paths(workspace_name, workspace_project, bucket_list):
+def update_entity_data_paths(workspace_name, workspace_project, bucket_list, max_workers=4):
     print("Listing all gs:// paths in DATA ENTITIES for " + workspace_name)
 
     # get data attributes
@@ -188,6 +150,7 @@ def update_entity_data_paths(workspace_name, workspace_project, bucket_list):
     paths_without_replacements = {} # where we store paths for which we don't have a replacement
 
     replacements_made = 0
+    entity_updates = [] # (entity_type, entity_name, attrs_list) to send in batchUpsert requests
 
     for ent in entities:
         ent_name = ent['name']
@@ -215,10 +178,13 @@ def update_entity_data_paths(workspace_name, workspace_project, bucket_list):
                 print('   '+item+' : '+gs_paths[item])
 
         if len(attrs_list) > 0:
-            response = fapi.update_entity(workspace_project, workspace_name, ent_type, ent_name, attrs_list)
-            if response.status_code == 200:
-                print(f'\nUpdated entities in {ent_name}:')
-                for attr in attrs_list:
+            entity_updates.append((ent_type, ent_name, attrs_list))
+
+    for batch, status_code, error in upsert_entity_batches(workspace_project, workspace_name, entity_updates, max_workers=max_workers):
+        if error is None:
+            for entity in batch:
+                print(f'\nUpdated entities in {entity["name"]}:')
+                for attr in entity['operations']:
                     print('   '+attr['attributeName']+' : '+attr['addUpdateAttribute'])
 
     if replacements_made == 0:
@@ -1,13 +1,15 @@
 import os
 import subprocess
 import ast
-import shutil
 import argparse
 import pandas as pd
-import numpy as np
 from firecloud import api as fapi
+from fiss_fns import rewrite_notebooks, upsert_entity_batches
 from datetime import datetime
 import csv
+import re
+import sqlite3
+from collections import deque
 
 EXTENSIONS_TO_MIGRATE = ['bam', 'bai', 'md5']
 
@@ -82,70 +84,31 @@ def call_fiss(fapifunc, okcode, *args, specialcodes=None, **kwargs):
     return response.json()
 
 
-def update_notebooks(workspace_name, workspace_project, replace_this, with_this):
+def update_notebooks(workspace_name, workspace_project, replace_this, with_this, max_workers=8, workspace=None):
     print("Updating NOTEBOOKS for " + workspace_name)
 
     ## update notebooks
-    # get the workspace bucket
-    workspace = call_fiss(fapi.get_workspace, 200, workspace_project, workspace_name)
+    # get the workspace bucket, unless the caller already has the workspace json
+    if workspace is None:
+        workspace = call_fiss(fapi.get_workspace, 200, workspace_project, workspace_name, fields='workspace.bucketName')
     bucket = workspace['workspace']['bucketName']
 
-    # check if bucket is empty
-    gsutil_args = ['gsutil', 'ls', 'gs://' + bucket + '/']
-    bucket_files = subprocess.check_output(gsutil_args)
-    # Check output produces a string in Py2, Bytes in Py3, so decode if necessary
-    if isinstance(bucket_files, bytes):
-        bucket_files = bucket_files.decode().split('\n')
-    # print(bucket_files)
-
-    editingFolder = "../notebookEditingFolder"
-
-    # if the bucket isn't empty, check for notebook files and copy them
-    if 'gs://'+bucket+'/notebooks/' in bucket_files: #len(bucket_files)>0:
-        # bucket_prefix = 'gs://' + bucket
-        # Creating the Notebook Editing Folder
-        if os.path.exists(editingFolder):
-            shutil.rmtree(editingFolder)
-        os.mkdir(editingFolder)
-        # Runing a gsutil ls to list files present in the bucket
-        gsutil_args = ['gsutil', 'ls', 'gs://' + bucket + '/notebooks/**']
-        bucket_files = subprocess.check_output(gsutil_args, stderr=subprocess.PIPE)
-        # Check output produces a string in Py2, Bytes in Py3, so decode if necessary
-        if type(bucket_files) == bytes:
-            bucket_files = bucket_files.decode().split('\n')
-        #Getting all notebook files
-        notebook_files = []
-        print("Copying files to local disk...")
-        for bf in bucket_files:
-            if ".ipynb" in bf:
-                notebook_files.append(bf)
-                # Downloading notebook to Notebook Editing Folder
-                gsutil_args = ['gsutil', 'cp', bf, editingFolder]
-                print('  copying '+bf)
-                copyFiles = subprocess.check_output(gsutil_args, stderr=subprocess.PIPE)
-        #Does URL replacement
-        print("Replacing text in files...")
-        sed_command = "sed -i '' -e 's#{replace_this}#{with_this}#' {editing_folder}/*.ipynb".format(
-                                        replace_this=replace_this,
-                                        with_this=with_this,
-                                        editing_folder=editingFolder)
-        os.system(sed_command)
-        #Upload notebooks back into workspace
-        print("Uploading files to bucket...")
-        for filename in os.listdir(editingFolder):
-            if not filename.startswith('.'):
-                if not filename.endswith(".ipynb"):
-                    print("  WARNING: non notebook file, not replacing "+filename)
-                else:
-                    print('  uploading '+filename)
-                    gsutil_args = ['gsutil', 'cp', editingFolder+'/'+filename,  'gs://' + bucket+"/notebooks/"+filename]
-                    uploadfiles = subprocess.check_output(gsutil_args, stderr=subprocess.PIPE)
-                    #Remove notebook from the Notebook Editing Folder
-                    os.remove(editingFolder+'/'+filename)
-        #Deleting Notebook Editing Folder to delete any old files lingering in the folder
-        shutil.rmtree(editingFolder)
-    else:
-        print("Workspace has no notebooks folder")
+    # rewrite notebooks in place in the bucket; anything changed since it was read is left alone
+    results = rewrite_notebooks(bucket, replace_this, with_this, max_workers=max_workers)
+
+    if not results:
+        print("Workspace has no notebooks")
+        return results
+
+    for blob_name, status, error in results:
+        if status == 'updated':
+            print('  updated gs://' + bucket + '/' + blob_name)
+        elif status != 'unchanged':
+            print('  WARNING: ' + status + ' gs://' + bucket + '/' + blob_name + ' - ' + str(error))
+    n_updated = sum(status == 'updated' for _, status, _ in results)
+    print(str(n_updated) + ' of ' + str(len(results)) + ' notebooks updated')
+
+    return results
 
 
 def find_and_replace(attr, value, replace_this, with_this):
@@ -173,13 +136,14 @@ def find_and_replace(attr, value, replace_this, with_this):
     return updated_attr
 
 
-def update_attributes(workspace_name, workspace_project, replace_this, with_this):
+def update_attributes(workspace_name, workspace_project, replace_this, with_this, workspace=None):
     ## update workspace data attributes
     print("Updating ATTRIBUTES for " + workspace_name)
 
-    # get data attributes
-    response = call_fiss(fapi.get_workspace, 200, workspace_project, workspace_name)
-    attributes = response['workspace']['attributes']
+    # get data attributes, unless the caller already has the workspace json
+    if workspace is None:
+        workspace = call_fiss(fapi.get_workspace, 200, workspace_project, workspace_name, fields='workspace.attributes')
+    attributes = workspace['workspace']['attributes']
 
     attrs_list = []
     for attr in attributes.keys():
@@ -196,7 +160,7 @@ def update_attributes(workspace_name, workspace_project, replace_this, with_this
                 print(attr)
 
 
-def update_entities(workspace_name, workspace_project, replace_this, with_this):
+def update_entities(workspace_name, workspace_project, replace_this, with_this, max_workers=4):
     ## update workspace entities
     print("Updating DATA ENTITIES for " + workspace_name)
 
@@ -204,6 +168,8 @@ def update_entities(workspace_name, workspace_project, replace_this, with_this):
     response = call_fiss(fapi.get_entities_with_type, 200, workspace_project, workspace_name)
     entities = response
 
+    # collect the updates for every entity, then apply them in batchUpsert requests
+    entity_updates = []
     for ent in entities:
         ent_name = ent['name']
         ent_type = ent['entityType']
@@ -216,60 +182,150 @@ def update_entities(workspace_name, workspace_project, replace_this, with_this):
                 attrs_list.append(updated_attr)
 
         if len(attrs_list) > 0:
-            response = fapi.update_entity(workspace_project, workspace_name, ent_type, ent_name, attrs_list)
-            if response.status_code == 200:
-                print('Updated entities:')
-                for attr in attrs_list:
+            entity_updates.append((ent_type, ent_name, attrs_list))
+
+    for batch, status_code, error in upsert_entity_batches(workspace_project, workspace_name, entity_updates, max_workers=max_workers):
+        if error is None:
+            print('Updated entities:')
+            for entity in batch:
+                for attr in entity['operations']:
                     print('   '+str(attr['attributeName'])+' : '+str(attr['addUpdateAttribute']))
 
 
+# buckets of the original (pre-migration) paths, used when no bucket list is given
+MIGRATED_BUCKET_IDS = [
+    'fc-122c390c-f0b9-4b01-82ae-3e87e858e01a',
+    'fc-12be498d-4812-489b-9b02-023db71a470f',
+    'fc-37557664-acea-408f-a944-027ed65502e5',
+    'fc-38aeaeaf-02c4-493d-a35b-a4f95f2c2fae',
+    'fc-3d22b428-2d11-483e-9d6e-7b13c3546e27',
+    'fc-3e3e2d8c-ff7c-4a5d-a0c4-1b2d8a96cf4b',
+    'fc-4ccb3566-f985-4e68-993c-ec666287c45b',
+    'fc-52fb4dc7-0957-49c6-9851-95951ea5308e',
+    'fc-67ecfd09-da44-465d-8e09-fdf082fc1f8d',
+    'fc-6cff0a0e-16db-47bd-b482-91618628e87d',
+    'fc-75bd7886-4635-4453-83af-76951e9c0f4b',
+    'fc-7e333c4f-dcbf-4c0d-8644-07a1bccde045',
+    'fc-8261513a-5f0c-4be0-ae42-62bcf00dfc52',
+    'fc-9bc3b4e4-f2a1-4ef3-b408-cf74f1916610',
+    'fc-a78c8a3c-890b-4953-a67d-f226685ead99',
+    'fc-a9d8dab3-1c57-4e9e-879a-f9d39441bfb5',
+    'fc-ab3e3ef8-5e90-47c1-8f44-246552248074',
+    'fc-be4e0e22-021e-4edc-a52e-56d9f053119d',
+    'fc-c0f9b627-a631-4f6c-bbfe-5edbe80d7eff',
+    'fc-cd11a278-cda3-4211-9ea4-c964c78e9bb6',
+    'fc-dd9c4e05-3511-4d3e-bc23-92815d14ffa1',
+    'fc-ddea25e3-a077-4f5f-a9d1-9661431186b2',
+    'fc-e02d3247-5469-4a5c-8b66-c4397eeff5d0',
+    'fc-e67c6510-d7f1-4bc3-b55e-2dfad7d56786',
+    'fc-e6c84ae9-9ac9-4b35-ae86-ac9f04824bf8',
+    'fc-e9440d64-3fad-44bc-a2c7-c439a94aff29',
+    'fc-ed48dede-1e5e-41ff-b3a1-0ef4f9797cd4',
+    'fc-effb3f55-962a-4b1f-b41d-63234d7e5735',
+    'fc-fd538f2b-e8bf-478a-8620-2c4c13a3e664',
+    'fc-1fdf285a-be88-4800-8de8-2388b385f2f8',
+    'fc-3861e381-510f-4577-b43e-e0a9609d4a51',
+    'fc-57598c0a-2daf-4996-8422-41c8d2d1a354',
+    'fc-5d15a8c5-a865-44cb-a8db-1d44f78e0134',
+    'fc-66b68450-9d98-490f-934f-a9d824aac4be',
+    'fc-99cfac7d-851a-48cc-b248-427c2b7b2f66',
+    'fc-a9496738-473e-4cb8-86aa-28a7a0f6a91e',
+    'fc-cdb52728-3070-42e0-97c5-b24b37c86e3e',
+    'fc-fc7961ea-9642-4eef-829b-2ad619bc1f01',
+]
+
+# pulls the bucket component out of every gs:// path in a value, including list strings like '["gs://a/x","gs://b/y"]'
+GS_BUCKET_PATTERN = re.compile(r'gs://([^/\s\'",\]]+)')
+
+
+class SubstringMatcher:
+    ''' Aho-Corasick automaton over a set of strings: finds whether any of them occurs in a
+    value in a single pass over the value, regardless of how many strings there are '''
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.is_match = [False]
+
+        for pattern in patterns:
+            if not pattern:
+                continue
+            node = 0
+            for char in pattern:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.is_match.append(False)
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.is_match[node] = True
+
+        # breadth first, so a node's failure link is set before its children's
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.is_match[child] = self.is_match[child] or self.is_match[self.fail[child]]
+
+    def search(self, value):
+        node = 0
+        for char in value:
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            if self.is_match[node]:
+                return True
+        return False
+
+
+class BucketSet:
+    ''' set of bucket ids to test paths against.
+
+    A path's bucket is parsed out and looked up in a hash set, which settles the common case.
+    Otherwise the path is searched for any of the bucket ids as a substring, as is_in_bucket_list
+    always has (e.g. for a bucket id that appears further down a path) - in one pass with an
+    Aho-Corasick matcher rather than one scan per bucket.
+    '''
+
+    def __init__(self, bucket_list):
+        self.buckets = frozenset(bucket for bucket in bucket_list if isinstance(bucket, str) and bucket)
+        self.matcher = SubstringMatcher(self.buckets)
+
+    def __contains__(self, bucket):
+        return bucket in self.buckets
+
+    def __iter__(self):
+        return iter(self.buckets)
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def contains_path(self, path):
+        if not isinstance(path, str):
+            # e.g. array attributes, which come as {"itemsType": ..., "items": [...]}
+            path = str(path)
+        for bucket in GS_BUCKET_PATTERN.findall(path):
+            if bucket in self.buckets:
+                return True
+        return self.matcher.search(path)
+
+
+MIGRATED_BUCKETS = BucketSet(MIGRATED_BUCKET_IDS)
+
+
 def is_in_bucket_list(path, bucket_list=None):
     if bucket_list is None:
-        bucket_list = [
-            'fc-122c390c-f0b9-4b01-82ae-3e87e858e01a',
-            'fc-12be498d-4812-489b-9b02-023db71a470f',
-            'fc-37557664-acea-408f-a944-027ed65502e5',
-            'fc-38aeaeaf-02c4-493d-a35b-a4f95f2c2fae',
-            'fc-3d22b428-2d11-483e-9d6e-7b13c3546e27',
-            'fc-3e3e2d8c-ff7c-4a5d-a0c4-1b2d8a96cf4b',
-            'fc-4ccb3566-f985-4e68-993c-ec666287c45b',
-            'fc-52fb4dc7-0957-49c6-9851-95951ea5308e',
-            'fc-67ecfd09-da44-465d-8e09-fdf082fc1f8d',
-            'fc-6cff0a0e-16db-47bd-b482-91618628e87d',
-            'fc-75bd7886-4635-4453-83af-76951e9c0f4b',
-            'fc-7e333c4f-dcbf-4c0d-8644-07a1bccde045',
-            'fc-8261513a-5f0c-4be0-ae42-62bcf00dfc52',
-            'fc-9bc3b4e4-f2a1-4ef3-b408-cf74f1916610',
-            'fc-a78c8a3c-890b-4953-a67d-f226685ead99',
-            'fc-a9d8dab3-1c57-4e9e-879a-f9d39441bfb5',
-            'fc-ab3e3ef8-5e90-47c1-8f44-246552248074',
-            'fc-be4e0e22-021e-4edc-a52e-56d9f053119d',
-            'fc-c0f9b627-a631-4f6c-bbfe-5edbe80d7eff',
-            'fc-cd11a278-cda3-4211-9ea4-c964c78e9bb6',
-            'fc-dd9c4e05-3511-4d3e-bc23-92815d14ffa1',
-            'fc-ddea25e3-a077-4f5f-a9d1-9661431186b2',
-            'fc-e02d3247-5469-4a5c-8b66-c4397eeff5d0',
-            'fc-e67c6510-d7f1-4bc3-b55e-2dfad7d56786',
-            'fc-e6c84ae9-9ac9-4b35-ae86-ac9f04824bf8',
-            'fc-e9440d64-3fad-44bc-a2c7-c439a94aff29',
-            'fc-ed48dede-1e5e-41ff-b3a1-0ef4f9797cd4',
-            'fc-effb3f55-962a-4b1f-b41d-63234d7e5735',
-            'fc-fd538f2b-e8bf-478a-8620-2c4c13a3e664',
-            'fc-1fdf285a-be88-4800-8de8-2388b385f2f8',
-            'fc-3861e381-510f-4577-b43e-e0a9609d4a51',
-            'fc-57598c0a-2daf-4996-8422-41c8d2d1a354',
-            'fc-5d15a8c5-a865-44cb-a8db-1d44f78e0134',
-            'fc-66b68450-9d98-490f-934f-a9d824aac4be',
-            'fc-99cfac7d-851a-48cc-b248-427c2b7b2f66',
-            'fc-a9496738-473e-4cb8-86aa-28a7a0f6a91e',
-            'fc-cdb52728-3070-42e0-97c5-b24b37c86e3e',
-            'fc-fc7961ea-9642-4eef-829b-2ad619bc1f01',
-        ]
-
-    for bucket in bucket_list:
-        if bucket in path:
-            return True
-    return False
+        bucket_list = MIGRATED_BUCKETS
+    elif not isinstance(bucket_list, BucketSet):
+        # build a BucketSet once and pass that in when checking many paths
+        bucket_list = BucketSet(bucket_list)
+
+    return bucket_list.contains_path(path)
 
 
 def contains_str(attr, value, str_match):
@@ -306,36 +362,112 @@ def is_migratable_extension(attr, value):
     return False
 
 
-def update_entity_data_paths(workspace_name, workspace_project, mapping_tsv, do_replacement=True, show_results=False):
+PATH_COLUMNS = ['entity_name','entity_type','attribute','original_path','new_path',
+                'map_key','fail_reason','file_type','update_status']
+
+NO_UPDATE_NEEDED_REASON = 'new bucket path does not need replacement'
+
+
+class PathOutcomes:
+    ''' collects one record per path found by update_entity_data_paths
+
+    records are kept in per-column lists and only turned into a DataFrame once, by `to_dataframe`.
+    the counts used by `summarize_results` are kept up to date as records are added and updated.
+    if stream_tsv is given, each record is also written to that file once its update status is final
+    (immediately for paths that won't be updated, after the API call for paths that will).
+    '''
+
+    def __init__(self, stream_tsv=None):
+        self.columns = {column: [] for column in PATH_COLUMNS}
+        self.n_paths = 0
+        self.n_not_needing_update = 0
+        self.n_migratable_extension = 0
+        self.n_updated = 0
+        self._stream = None
+        self._writer = None
+        if stream_tsv is not None:
+            self._stream = open(stream_tsv, 'w', newline='')
+            self._writer = csv.writer(self._stream, delimiter='\t')
+            self._writer.writerow([''] + PATH_COLUMNS)
+
+    def __len__(self):
+        return self.n_paths
+
+    def add(self, entity_name, entity_type, attribute, original_path, new_path, map_key, fail_reason, file_type, pending_update=False):
+        ''' record a path; returns its row index, for setting its update status later '''
+        ind = self.n_paths
+        values = [entity_name, entity_type, attribute, original_path, new_path, map_key, fail_reason, file_type, None]
+        for column, value in zip(PATH_COLUMNS, values):
+            self.columns[column].append(value)
+        self.n_paths += 1
+
+        if fail_reason == NO_UPDATE_NEEDED_REASON:
+            self.n_not_needing_update += 1
+        if file_type in EXTENSIONS_TO_MIGRATE:
+            self.n_migratable_extension += 1
+
+        if not pending_update:
+            self._write(ind)
+        return ind
+
+    def set_update_status(self, inds, status_code):
+        update_status = self.columns['update_status']
+        for ind in inds:
+            update_status[ind] = status_code
+            self._write(ind)
+        if status_code in (200, 204): # 204 from batchUpsert
+            self.n_updated += len(inds)
+
+    def _write(self, ind):
+        if self._writer is not None:
+            self._writer.writerow([ind] + ['' if self.columns[column][ind] is None else self.columns[column][ind] for column in PATH_COLUMNS])
+            self._stream.flush()
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+            self._writer = None
+
+    def summary_counts(self):
+        n_valid_extension_paths_to_replace = self.n_migratable_extension - self.n_not_needing_update
+        return n_valid_extension_paths_to_replace, self.n_updated
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.columns, columns=PATH_COLUMNS)
+
+
+def update_entity_data_paths(workspace_name, workspace_project, mapping_tsv, do_replacement=True, show_results=False, max_workers=4, stream_tsv=None, mapping_index_path=None):
     if do_replacement:
         print(f'Updating paths in {workspace_name}\n\nNOTE: THIS STEP MAY TAKE A FEW MINUTES. As long as you see `In [*]:` to the left of this cell, it\'s still working!')
     else:
         print(f'Listing paths to update in {workspace_name}')
 
-    # load path mapping
-    mapping = load_mapping(mapping_tsv)
-    original_path_list = list(mapping.keys())
-    original_bucket_list = list(set([x.split('/')[2] for x in original_path_list]))
+    # load path mapping, from the on-disk index (built on first use)
+    mapping = MappingIndex(mapping_tsv, index_path=mapping_index_path)
+    original_bucket_list = BucketSet(mapping.buckets())
 
-    # set up dataframe to track all paths
-    columns = ['entity_name','entity_type','attribute','original_path','new_path',
-               'map_key','fail_reason','file_type','update_status']
-    df_paths = pd.DataFrame(columns=columns)
+    # set up collector to track all paths
+    path_outcomes = PathOutcomes(stream_tsv)
 
     # get data attributes
     entities = call_fiss(fapi.get_entities_with_type, 200, workspace_project, workspace_name)
 
+    entity_updates = [] # (entity_type, entity_name, attrs_list) to send in batchUpsert requests
+    entity_inds = {} # to keep track of rows to update with API call status, by (entity_type, entity_name)
+
     for ent in entities:
         ent_name = ent['name']
         ent_type = ent['entityType']
         ent_attrs = ent['attributes']
         # gs_paths = {}
+        attrs_list = []
+        inds = []
         for attr in ent_attrs.keys():
-            attrs_list = []
-            inds = [] # to keep track of rows to update with API call status
-
             if is_gs_path(attr, ent_attrs[attr]) and is_migratable_extension(attr,ent_attrs[attr]): # this is a gs:// path
                 original_path = ent_attrs[attr]
+                if not isinstance(original_path, str): # array attributes aren't mapped, as before
+                    continue
                 if is_in_bucket_list(original_path, bucket_list=original_bucket_list): # this is a path we think we want to update
                     new_path, map_key, fail_reason = get_replacement_path(original_path, mapping)
                     # gs_paths[attr] = original_path
@@ -348,36 +480,38 @@ def update_entity_data_paths(workspace_name, workspace_project, mapping_tsv, do_
                         if fail_reason is None:
                             update_this_attr = True
 
+                    # even if we don't update the attribute, add an entry for documentation of why not
+                    ind = path_outcomes.add(ent_name, ent_type, attr, original_path, new_path, map_key, fail_reason,
+                                            original_path.split('.')[-1][:3], pending_update=update_this_attr)
+
                     if update_this_attr:
                         updated_attr = fapi._attr_set(attr, str(new_path)) # format the update
                         attrs_list.append(updated_attr) # what we have replacements for
-                        inds.append(len(df_paths))
+                        inds.append(ind)
 
-                    # even if we don't update the attribute, add an entry for documentation of why not
-                    df_paths = df_paths.append({'entity_name': ent_name,
-                                                'entity_type': ent_type,
-                                                'attribute': attr,
-                                                'original_path': original_path,
-                                                'new_path': new_path,
-                                                'map_key': map_key,
-                                                'fail_reason': fail_reason,
-                                                'file_type': original_path.split('.')[-1][:3]},
-                                                ignore_index=True)
-
-
-            if len(attrs_list) > 0:
-                if do_replacement:
-                    # DO THE REPLACEMENT
-                    response = fapi.update_entity(workspace_project, workspace_name, ent_type, ent_name, attrs_list)
-                    status_code = response.status_code
-                    if status_code != 200:
-                        print(f'ERROR {status_code} updating {ent_name} with {str(attrs_list)} - {response.text}')
-                else:
-                    status_code = 0
+        if len(attrs_list) > 0:
+            entity_updates.append((ent_type, ent_name, attrs_list))
+            entity_inds[(ent_type, ent_name)] = inds
 
-                df_paths.loc[inds, 'update_status'] = status_code
+    try:
+        if do_replacement:
+            # DO THE REPLACEMENT, in batches of entities
+            for batch, status_code, error in upsert_entity_batches(workspace_project, workspace_name, entity_updates, max_workers=max_workers):
+                batch_inds = []
+                for entity in batch:
+                    batch_inds.extend(entity_inds[(entity['entityType'], entity['name'])])
+                    if error is not None:
+                        print(f'ERROR {status_code} updating {entity["name"]} with {str(entity["operations"])} - {error}')
+                path_outcomes.set_update_status(batch_inds, status_code)
+        else:
+            for inds in entity_inds.values():
+                path_outcomes.set_update_status(inds, 0)
+    finally:
+        path_outcomes.close()
+        mapping.close()
 
-    summarize_results(df_paths)
+    summarize_results(path_outcomes, do_replacement)
+    df_paths = path_outcomes.to_dataframe()
 
     if show_results:
         display(df_paths)
@@ -411,6 +545,8 @@ def update_entity_data_paths_deprecated(workspace_name, workspace_project, mappi
         for attr in ent_attrs.keys():
             if is_gs_path(attr, ent_attrs[attr]) and is_migratable_extension(attr,ent_attrs[attr]): # this is a gs:// path
                 original_path = ent_attrs[attr]
+                if not isinstance(original_path, str): # array attributes aren't mapped
+                    continue
                 if is_in_bucket_list(original_path, bucket_list=None): # this is a path we think we want to update
                     new_path, map_key, fail_reason = get_replacement_path(original_path, mapping)
                     gs_paths[attr] = original_path
@@ -460,22 +596,156 @@ def load_mapping(path):
     return mapping
 
 
+def iter_fallback_paths(path):
+    ''' yields (fallback path, notice) for each of the FALLBACK_REPLACEMENTS suffixes the path ends with '''
+    for suffix, replacement_info in FALLBACK_REPLACEMENTS.items():
+        if path.endswith(suffix):
+            yield path.replace(suffix, replacement_info['replacement']), replacement_info['notice']
+
+
+MAPPING_INDEX_VERSION = 2
+MAPPING_INDEX_LOOKUP_CHUNK = 500 # stay well under sqlite's limit on bound parameters per statement
+
+
+class MappingIndex:
+    ''' persistent on-disk index of an old_path -> new_path mapping tsv, stored in sqlite.
+
+    The index is built once next to the tsv (<mapping_tsv>.sqlite by default) and reused on later
+    runs for as long as the tsv's size and modification time are unchanged, so reloading a mapping
+    of tens of millions of paths doesn't mean re-reading the whole tsv into memory.
+
+    Paths that aren't mapped are resolved through the same FALLBACK_REPLACEMENTS as a dict
+    mapping (see iter_fallback_paths), with a second lookup. Exact keys always win over fallbacks.
+    '''
+
+    def __init__(self, mapping_tsv, index_path=None):
+        self.mapping_tsv = mapping_tsv
+        self.index_path = index_path or f'{mapping_tsv}.sqlite'
+
+        if not self._is_current():
+            self._build()
+
+        self.conn = sqlite3.connect(self.index_path)
+
+    def _source_signature(self):
+        stat = os.stat(self.mapping_tsv)
+        return {'version': str(MAPPING_INDEX_VERSION), 'size': str(stat.st_size), 'mtime_ns': str(stat.st_mtime_ns)}
+
+    def _is_current(self):
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            conn = sqlite3.connect(self.index_path)
+            try:
+                meta = dict(conn.execute('SELECT key, value FROM meta').fetchall())
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return False
+        return meta == self._source_signature()
+
+    def _build(self):
+        print(f'Building path mapping index {self.index_path} from {self.mapping_tsv}')
+        signature = self._source_signature()
+
+        # build into a temporary file and move it into place, so an interrupted build is never reused
+        tmp_path = f'{self.index_path}.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute('PRAGMA journal_mode=OFF')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('CREATE TABLE mapping (key TEXT PRIMARY KEY, new_path TEXT) WITHOUT ROWID')
+            conn.execute('CREATE TABLE buckets (bucket TEXT PRIMARY KEY) WITHOUT ROWID')
+
+            buckets = set()
+
+            def exact_rows(reader):
+                for row in reader:
+                    old_path = row['old_path']
+                    path_parts = old_path.split('/')
+                    if len(path_parts) > 2:
+                        buckets.add(path_parts[2])
+                    yield old_path, row['new_path']
+
+            with open(self.mapping_tsv, 'r') as mapping_tsv:
+                reader = csv.DictReader(mapping_tsv, fieldnames=MAPPING_HEADERS, delimiter='\t')
+                # later rows overwrite earlier ones, as they would in a dict
+                conn.executemany('INSERT OR REPLACE INTO mapping (key, new_path) VALUES (?, ?)', exact_rows(reader))
+
+            conn.executemany('INSERT INTO buckets (bucket) VALUES (?)', [(bucket,) for bucket in buckets])
+            conn.executemany('INSERT INTO meta (key, value) VALUES (?, ?)', signature.items())
+            conn.commit()
+        finally:
+            conn.close()
+
+        os.replace(tmp_path, self.index_path)
+
+    def _select_many(self, keys):
+        ''' returns a dict of key: new_path for the keys found in the mapping '''
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), MAPPING_INDEX_LOOKUP_CHUNK):
+            chunk = keys[i:i + MAPPING_INDEX_LOOKUP_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            found.update(self.conn.execute(f'SELECT key, new_path FROM mapping WHERE key IN ({placeholders})', chunk))
+        return found
+
+    def lookup(self, path):
+        ''' returns (new_path, notice) for a path, where notice is None for an exact match;
+        raises KeyError if the path can't be mapped, even through a fallback '''
+        row = self.conn.execute('SELECT new_path FROM mapping WHERE key = ?', (path,)).fetchone()
+        if row is not None:
+            return row[0], None
+        for fallback_path, notice in iter_fallback_paths(path):
+            row = self.conn.execute('SELECT new_path FROM mapping WHERE key = ?', (fallback_path,)).fetchone()
+            if row is not None and row[0]:
+                return row[0], notice
+        raise KeyError(path)
+
+    def lookup_many(self, paths):
+        ''' batch version of lookup; returns a dict of path: (new_path, notice) for the paths that can be mapped '''
+        found = {path: (new_path, None) for path, new_path in self._select_many(set(paths)).items()}
+
+        # resolve the rest through their fallbacks, also in one batch
+        fallbacks = {path: list(iter_fallback_paths(path)) for path in set(paths) if path not in found}
+        found_fallbacks = self._select_many(set(fallback_path for fallback_list in fallbacks.values() for fallback_path, _ in fallback_list))
+        for path, fallback_list in fallbacks.items():
+            for fallback_path, notice in fallback_list:
+                if found_fallbacks.get(fallback_path):
+                    found[path] = (found_fallbacks[fallback_path], notice)
+                    break
+        return found
+
+    def buckets(self):
+        ''' returns the list of buckets of all original paths in the mapping '''
+        return [row[0] for row in self.conn.execute('SELECT bucket FROM buckets')]
+
+    def close(self):
+        self.conn.close()
+
+
 def get_destination_from_mapping(path, mapping):
+    if isinstance(mapping, MappingIndex):
+        new_path, replacement_notice = mapping.lookup(path)
+        if replacement_notice is not None:
+            print(f' - {path}: {replacement_notice}')
+        return new_path
+
     try:
         return mapping[path]
     except KeyError:
-        for suffix, replacement_info in FALLBACK_REPLACEMENTS.items():
-            if path.endswith(suffix):
-                replaced_path = path.replace(suffix, replacement_info['replacement'])
+        for replaced_path, replacement_notice in iter_fallback_paths(path):
+            replaced_mapping = mapping.get(replaced_path)
 
-                replaced_mapping = mapping.get(replaced_path)
+            if not replaced_mapping:
+                continue
 
-                if not replaced_mapping:
-                    continue
-
-                replacement_notice = replacement_info['notice']
-                print(f' - {path}: {replacement_notice}')
-                return replaced_mapping
+            print(f' - {path}: {replacement_notice}')
+            return replaced_mapping
 
         # if the path doesn't match any of our fallback suffixes, then we can't map it, so we
         # re-raise the key error.
@@ -500,11 +770,23 @@ def get_replacement_path(original_path, mapping):
         original_path_list = [original_path]
         is_list = False
 
+    if is_list and isinstance(mapping, MappingIndex):
+        # resolve all paths in the list with one query, instead of one query per path
+        found = mapping.lookup_many(original_path_list)
+    else:
+        found = None
+
     new_path_list = []
     fail_reason_list = []
     for original_path in original_path_list:
         try:
-            new_path_list.append(get_destination_from_mapping(original_path, mapping))
+            if found is not None:
+                new_path, replacement_notice = found[original_path]
+                if replacement_notice is not None:
+                    print(f' - {original_path}: {replacement_notice}')
+            else:
+                new_path = get_destination_from_mapping(original_path, mapping)
+            new_path_list.append(new_path)
             fail_reason_list.append(None)
         except KeyError:
             if is_list:
@@ -529,11 +811,13 @@ def get_replacement_path(original_path, mapping):
 
 
 def summarize_results(df_paths, do_replacement=True):
-    # get some summary stats
-    n_extension_paths_from_new_buckets_not_needing_update = sum(df_paths.fail_reason == 'new bucket path does not need replacement')
-    n_valid_extension_paths_to_replace = len(df_paths[df_paths['file_type'].isin(EXTENSIONS_TO_MIGRATE)]) - n_extension_paths_from_new_buckets_not_needing_update
-    n_paths_updated = len(df_paths[df_paths['update_status'] == 200])
-    n_nonvalid_extension_paths = len(df_paths[np.logical_not(df_paths['file_type'].isin(EXTENSIONS_TO_MIGRATE))])
+    # get some summary stats, either kept up to date by PathOutcomes or counted from a DataFrame of paths
+    if isinstance(df_paths, PathOutcomes):
+        n_valid_extension_paths_to_replace, n_paths_updated = df_paths.summary_counts()
+    else:
+        n_extension_paths_from_new_buckets_not_needing_update = sum(df_paths.fail_reason == NO_UPDATE_NEEDED_REASON)
+        n_valid_extension_paths_to_replace = len(df_paths[df_paths['file_type'].isin(EXTENSIONS_TO_MIGRATE)]) - n_extension_paths_from_new_buckets_not_needing_update
+        n_paths_updated = len(df_paths[df_paths['update_status'].isin([200, 204])]) # 204 from batchUpsert
     n_valid_extension_paths_not_updated = n_valid_extension_paths_to_replace - n_paths_updated
 
     if not do_replacement:
@@ -558,7 +842,13 @@ def get_permissions_information(df_paths, pm_tsv):
     df_pms = pd.read_csv(pm_tsv,header=0,delimiter='\t')
 
     print(list(df_pms.columns))
-    buckets_to_check = df_pms['bucket']
+    buckets_to_check = BucketSet(df_pms['bucket']) # filters out nan buckets
+
+    # first PM row for each bucket
+    pm_row_by_bucket = {}
+    for ind, bucket in df_pms['bucket'].items():
+        if isinstance(bucket, str):
+            pm_row_by_bucket.setdefault(bucket, ind)
 
     # find destination buckets in new paths
     # paths = df_paths.loc[df_paths.index[df_paths.new_path.notnull()].tolist()]['new_path']
@@ -578,10 +868,8 @@ def get_permissions_information(df_paths, pm_tsv):
         for attr in ent_attrs.keys():
             if is_gs_path(attr, ent_attrs[attr]) and is_migratable_extension(attr,ent_attrs[attr]): # this is a gs:// path
                 gs_path = ent_attrs[attr]
-                for bucket in buckets_to_check:
-                    if isinstance(bucket, str): # filter out nan buckets
-                        if contains_str(attr, gs_path, str_match=bucket):
-                            paths.append(gs_path)
+                if buckets_to_check.contains_path(gs_path if isinstance(gs_path, str) else str(gs_path)):
+                    paths.append(gs_path)
 
 
     buckets = set([item.split('/')[2] for item in paths]) # pulls out bucket name, i.e. 'gs://bucket-name/stuff' -> 'bucket-name'
@@ -590,11 +878,7 @@ def get_permissions_information(df_paths, pm_tsv):
     pm_contact_text += 'please email the corresponding PM for appropriate permissions.\n\n'
     pm_contact_text += 'To save this information to your workspace bucket (highly recommended), run the following notebook cell.'
 
-    inds = []
-    for bucket in buckets:
-        indices = df_pms.index[df_pms['bucket']==bucket].tolist()
-        if len(indices) > 0:
-            inds.append(indices[0])
+    inds = [pm_row_by_bucket[bucket] for bucket in buckets if bucket in pm_row_by_bucket]
 
     print(pm_contact_text)
 
@@ -0,0 +1,129 @@
+import os
+
+import pytest
+
+import update_workspace_dd
+
+
+MIGRATED_BUCKET = update_workspace_dd.MIGRATED_BUCKET_IDS[0]
+
+# array attributes come from the API as dicts, not strings
+LIST_ATTRIBUTE = {'itemsType': 'AttributeValue',
+                  'items': [f'gs://{MIGRATED_BUCKET}/sample.bam', f'gs://{MIGRATED_BUCKET}/sample.bai']}
+
+
+# TEST: bucket membership for string and list-valued attributes
+def test_is_in_bucket_list_string_paths():
+    assert update_workspace_dd.is_in_bucket_list(f'gs://{MIGRATED_BUCKET}/sample.bam')
+    assert update_workspace_dd.is_in_bucket_list('gs://fc-new/sample.bam', bucket_list=['fc-new'])
+    assert not update_workspace_dd.is_in_bucket_list('gs://fc-other/sample.bam', bucket_list=['fc-new'])
+    # bucket ids further down a path still count, as with the original substring check
+    assert update_workspace_dd.is_in_bucket_list('gs://fc-other/fc-new/sample.bam', bucket_list=['fc-new'])
+
+
+def test_is_in_bucket_list_list_attribute():
+    assert update_workspace_dd.is_in_bucket_list(LIST_ATTRIBUTE)
+    assert not update_workspace_dd.is_in_bucket_list(LIST_ATTRIBUTE, bucket_list=['fc-new'])
+
+
+# TEST: list-valued attributes are skipped when updating data paths, rather than stopping the update
+def test_update_entity_data_paths_list_attribute(tmp_path, monkeypatch):
+    mapping_tsv = tmp_path / 'mapping.tsv'
+    mapping_tsv.write_text(f'gs://{MIGRATED_BUCKET}/sample.bam\tgs://fc-new/sample.bam\n')
+
+    entities = [{'name': 'sample_1', 'entityType': 'sample',
+                 'attributes': {'bam': f'gs://{MIGRATED_BUCKET}/sample.bam', 'files': LIST_ATTRIBUTE}}]
+    monkeypatch.setattr(update_workspace_dd, 'call_fiss', lambda *args, **kwargs: entities)
+
+    df_paths = update_workspace_dd.update_entity_data_paths('workspace', 'project', str(mapping_tsv), do_replacement=False)
+
+    assert list(df_paths['attribute']) == ['bam']
+    assert list(df_paths['new_path']) == ['gs://fc-new/sample.bam']
+
+
+OLD = f'gs://{MIGRATED_BUCKET}'
+MAPPING_ROWS = [
+    (f'{OLD}/a/sample.bam', 'gs://fc-new/a/sample.bam'),
+    # both the reduced and the unreduced versions were migrated
+    (f'{OLD}/b/sample.reduced.bam', 'gs://fc-new/b/sample.reduced.bam'),
+    (f'{OLD}/b/sample.bam', 'gs://fc-new/b/sample.bam'),
+    # rows with an empty new path map exactly, but aren't used as fallbacks
+    (f'{OLD}/c/sample.bam', ''),
+    # the fallback suffix occurs more than once in the path
+    (f'{OLD}/d.reduced.bam/sample.bam', 'gs://fc-new/d-partial/sample.bam'),
+    (f'{OLD}/d.bam/sample.bam', 'gs://fc-new/d/sample.bam'),
+    (f'{OLD}/e/sample.bam.md5', 'gs://fc-new/e/sample.bam.md5'),
+]
+QUERY_PATHS = [
+    f'{OLD}/a/sample.bam',
+    f'{OLD}/a/sample.reduced.bam',
+    f'{OLD}/a/sample.reduced.bai',
+    f'{OLD}/b/sample.reduced.bam',
+    f'{OLD}/c/sample.bam',
+    f'{OLD}/c/sample.reduced.bam',
+    f'{OLD}/d.reduced.bam/sample.reduced.bam',
+    f'{OLD}/e/sample.reduced.bam.md5',
+    f'{OLD}/missing.bam',
+]
+
+
+def write_mapping(tmp_path, rows=MAPPING_ROWS):
+    mapping_tsv = tmp_path / 'mapping.tsv'
+    mapping_tsv.write_text(''.join(f'{old_path}\t{new_path}\n' for old_path, new_path in rows))
+    return str(mapping_tsv)
+
+
+def resolve(path, mapping):
+    try:
+        return update_workspace_dd.get_destination_from_mapping(path, mapping)
+    except KeyError:
+        return KeyError
+
+
+# TEST: the sqlite mapping index resolves paths, including fallbacks, the same way as the in-memory mapping
+def test_mapping_index_matches_dict_mapping(tmp_path):
+    mapping_tsv = write_mapping(tmp_path)
+    mapping = update_workspace_dd.load_mapping(mapping_tsv)
+    index = update_workspace_dd.MappingIndex(mapping_tsv)
+
+    expected = [resolve(path, mapping) for path in QUERY_PATHS]
+    assert [resolve(path, index) for path in QUERY_PATHS] == expected
+    found = index.lookup_many(QUERY_PATHS)
+    assert [found[path][0] if path in found else KeyError for path in QUERY_PATHS] == expected
+
+    # the suffix is replaced everywhere in the path, not just at the end
+    assert resolve(f'{OLD}/d.reduced.bam/sample.reduced.bam', index) == 'gs://fc-new/d/sample.bam'
+    index.close()
+
+
+# TEST: exact matches win over fallbacks, and fallbacks skip rows with an empty new path
+def test_mapping_index_exact_match_and_empty_new_path(tmp_path):
+    index = update_workspace_dd.MappingIndex(write_mapping(tmp_path))
+
+    assert index.lookup(f'{OLD}/b/sample.reduced.bam') == ('gs://fc-new/b/sample.reduced.bam', None)
+    assert index.lookup(f'{OLD}/a/sample.reduced.bam') == ('gs://fc-new/a/sample.bam', update_workspace_dd.FALLBACK_REPLACEMENTS['.reduced.bam']['notice'])
+    assert index.lookup(f'{OLD}/c/sample.bam') == ('', None)
+    with pytest.raises(KeyError):
+        index.lookup(f'{OLD}/c/sample.reduced.bam')
+    index.close()
+
+
+# TEST: the index is reused while the tsv is unchanged and rebuilt when it changes
+def test_mapping_index_reuse_and_rebuild(tmp_path, monkeypatch):
+    mapping_tsv = write_mapping(tmp_path)
+    builds = []
+    build = update_workspace_dd.MappingIndex._build
+    monkeypatch.setattr(update_workspace_dd.MappingIndex, '_build', lambda self: builds.append(self) or build(self))
+
+    update_workspace_dd.MappingIndex(mapping_tsv).close()
+    update_workspace_dd.MappingIndex(mapping_tsv).close()
+    assert len(builds) == 1
+
+    # same size, new modification time
+    write_mapping(tmp_path, [(f'{OLD}/a/sample.bam', 'gs://fc-new/a/sample.ba_')] + MAPPING_ROWS[1:])
+    stat = os.stat(mapping_tsv)
+    os.utime(mapping_tsv, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    index = update_workspace_dd.MappingIndex(mapping_tsv)
+    assert len(builds) == 2
+    assert index.lookup(f'{OLD}/a/sample.bam') == ('gs://fc-new/a/sample.ba_', None)
+    index.close()
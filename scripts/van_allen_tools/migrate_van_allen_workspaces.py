@@ -4,10 +4,16 @@ Usage:
     > python3 set_up_vanallen_workspaces.py -t TSV_FILE [-p NAMESPACE] """
 
 import argparse
+import hashlib
 import json
 import ast
+import threading
+import time
 import pandas as pd
 import requests
+import tenacity as tn
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from firecloud import api as fapi
 from utils import add_tags_to_workspace, check_workspace_exists, \
     get_access_token, get_workspace_authorization_domain, \
@@ -18,6 +24,59 @@ import query_bucket_object_inventory as get_source_objects_file
 
 NAMESPACE = "vanallen-firecloud-nih"
 BUCKET_REGION = "us-central1"
+ENTITY_PAGE_SIZE = 1000  # entities per entityQuery page
+# limits for a single batchUpsert request, as in fiss_fns
+UPSERT_MAX_OPERATIONS = 1000  # attribute operations per request
+UPSERT_MAX_BYTES = 5 * 1024 * 1024  # approximate request body size
+DEFAULT_MAX_CONCURRENT_WORKSPACES = 4
+DEFAULT_MAX_API_CALLS_PER_SECOND = 10  # across all workspaces being migrated
+
+# phases of a workspace migration, timed separately in the output report
+# setup has to finish first, the other phases run at the same time
+MIGRATION_PHASES = ["setup", "copy_workflows", "copy_data_tables", "source_object_details_file"]
+
+
+class RateLimiter:
+    """Token bucket shared by all threads, to keep the whole migration under a maximum API call rate."""
+
+    def __init__(self, max_calls_per_second):
+        self.set_rate(max_calls_per_second)
+        self.lock = threading.Lock()
+
+    def set_rate(self, max_calls_per_second):
+        self.interval = 1.0 / max_calls_per_second if max_calls_per_second else 0
+        self.next_call = time.monotonic()
+
+    def wait(self):
+        """Block until the next call is allowed."""
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(now, self.next_call)
+            self.next_call = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+API_RATE_LIMITER = RateLimiter(DEFAULT_MAX_API_CALLS_PER_SECOND)
+
+# only one workspace at a time can ask the user whether to modify an existing workspace
+USER_PROMPT_LOCK = threading.Lock()
+
+
+def rate_limited(api_function, *args, **kwargs):
+    """Make an API call once API_RATE_LIMITER allows it."""
+    API_RATE_LIMITER.wait()
+    return api_function(*args, **kwargs)
+
+
+@contextmanager
+def timed_phase(workspace_dict, phase):
+    """Record how long a migration phase takes, in seconds, in the workspace dictionary."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        workspace_dict[f"{phase}_seconds"] = round(time.monotonic() - start, 1)
 
 
 def add_members_to_workspace(workspace_name, acls, namespace=NAMESPACE, ignore=[]):
@@ -32,7 +91,7 @@ def add_members_to_workspace(workspace_name, acls, namespace=NAMESPACE, ignore=[
     # -H  "accept: */*" -H  "Authorization: Bearer [token] -H "Content-Type: application/json"
 
     # capture response from API and parse out status code
-    response = requests.patch(uri, headers=headers, data=json_request)
+    response = rate_limited(requests.patch, uri, headers=headers, data=json_request)
     status_code = response.status_code
 
     emails = [acl['email'] for acl in json.loads(json_request)]
@@ -50,7 +109,7 @@ def add_members_to_workspace(workspace_name, acls, namespace=NAMESPACE, ignore=[
 def create_workspace(workspace_name, auth_domains, attributes, namespace=NAMESPACE):
     """Create the Terra workspace."""
     # check if workspace already exists
-    ws_exists, ws_exists_response = check_workspace_exists(workspace_name, namespace)
+    ws_exists, ws_exists_response = rate_limited(check_workspace_exists, workspace_name, namespace)
 
     if ws_exists is None:
         return False, ws_exists_response
@@ -69,7 +128,7 @@ def create_workspace(workspace_name, auth_domains, attributes, namespace=NAMESPA
         headers = {"Authorization": "Bearer " + get_access_token(), "accept": "application/json", "Content-Type": "application/json"}
 
         # capture response from API and parse out status code
-        response = requests.post(uri, headers=headers, data=json.dumps(create_ws_json))
+        response = rate_limited(requests.post, uri, headers=headers, data=json.dumps(create_ws_json))
         status_code = response.status_code
 
         if status_code != 201:  # ws creation fail
@@ -80,15 +139,16 @@ def create_workspace(workspace_name, auth_domains, attributes, namespace=NAMESPA
         return True, None
 
     # workspace already exists
-    print(f"Workspace already exists with name: {namespace}/{workspace_name}.")
-    print(f"Existing workspace details: {json.dumps(json.loads(ws_exists_response), indent=2)}")
-    # make user decide if they want to update/overwrite existing workspace
-    while True:  # try until user inputs valid response
-        update_existing_ws = input("Would you like to continue modifying the existing workspace? (Y/N)" + "\n")
-        if update_existing_ws.upper() in ["Y", "N"]:
-            break
-        else:
-            print("Not a valid option. Choose: Y/N")
+    with USER_PROMPT_LOCK:  # workspaces are migrated concurrently, so ask about one at a time
+        print(f"Workspace already exists with name: {namespace}/{workspace_name}.")
+        print(f"Existing workspace details: {json.dumps(json.loads(ws_exists_response), indent=2)}")
+        # make user decide if they want to update/overwrite existing workspace
+        while True:  # try until user inputs valid response
+            update_existing_ws = input(f"Would you like to continue modifying the existing workspace {namespace}/{workspace_name}? (Y/N)" + "\n")
+            if update_existing_ws.upper() in ["Y", "N"]:
+                break
+            else:
+                print("Not a valid option. Choose: Y/N")
     if update_existing_ws.upper() == "N":       # don't overwrite existing workspace
         deny_overwrite_message = f"{namespace}/{workspace_name} already exists. User selected not to overwrite. Try again with unique workspace name."
         return None, deny_overwrite_message
@@ -136,7 +196,7 @@ def copy_workspace_workflows(destination_workspace_namespace, destination_worksp
 
     # get the list of all the workflows in source workspaces - allRepos = agora, dockstore
     try:
-        source_workflows = fapi.list_workspace_configs(source_workspace_namespace, source_workspace_name, allRepos=True)
+        source_workflows = rate_limited(fapi.list_workspace_configs, source_workspace_namespace, source_workspace_name, allRepos=True)
 
         # Store all the workflow names
         source_workflow_names = []
@@ -150,10 +210,10 @@ def copy_workspace_workflows(destination_workspace_namespace, destination_worksp
             source_workflow_names.append(source_workflow_name)
 
             # get full source workflow configuration (detailed config with inputs, oututs, etc) for single workflow
-            source_workflow_config = fapi.get_workspace_config(source_workspace_namespace, source_workspace_name, source_workflow_namespace, source_workflow_name)
+            source_workflow_config = rate_limited(fapi.get_workspace_config, source_workspace_namespace, source_workspace_name, source_workflow_namespace, source_workflow_name)
 
             # create a workflow based on source workflow config returned above
-            response = fapi.create_workspace_config(destination_workspace_namespace, destination_workspace_name, source_workflow_config.json())
+            response = rate_limited(fapi.create_workspace_config, destination_workspace_namespace, destination_workspace_name, source_workflow_config.json())
             status_code = response.status_code
 
             # if copy failed (409 = already exists, does not count as failure)
@@ -202,166 +262,238 @@ def find_and_replace(attr, value, replace_this, with_this):
     return updated_attr
 
 
-def update_entities(workspace_name, workspace_project, replace_this, with_this):
-    """Update data model tables with new destination workspace bucket file paths."""
-    # update workspace entities
-    print(f"Starting update of data tables in workspace: {workspace_name}")
-
-    # get data attributes
-    response = fapi.get_entities_with_type(workspace_project, workspace_name)
-    entities = response.json()
-
-    for ent in entities:
-        ent_name = ent['name']
-        ent_type = ent['entityType']
-        ent_attrs = ent['attributes']
-        attrs_list = []
-        for attr in ent_attrs.keys():
-            value = ent_attrs[attr]
-            updated_attr = find_and_replace(attr, value, replace_this, with_this)
-            if updated_attr:
-                attrs_list.append(updated_attr)
-
-        if len(attrs_list) > 0:
-            response = fapi.update_entity(workspace_project, workspace_name, ent_type, ent_name, attrs_list)
-            if response.status_code == 200:
-                print('Updated entities:')
-                for attr in attrs_list:
-                    print('   ' + str(attr['attributeName']) + ' : ' + str(attr['addUpdateAttribute']))
-
-
-def copy_workspace_entities_sushma(destination_workspace_namespace, destination_workspace_name, source_workspace_namespace, source_workspace_name, destination_workspace_bucket):
-    """Copy workspace data tables to destination workspace."""
-
-    source_etypes = fapi.list_entity_types(source_workspace_namespace, source_workspace_name)
-    if source_etypes.status_code != 200:  # getting list of data tables fails
-        message = f"Failed to retrieve list of data tables (entity types) from: {source_workspace_namespace}/{source_workspace_name}. API error: {source_etypes.text}."
-        print(message)
-        return False, message
-    source_set_etypes = [s for s in list(source_etypes.json().keys()) if s.endswith("_set")]
-    source_single_etypes = [s for s in list(source_etypes.json().keys()) if not s.endswith("_set")]
-
-    # for each table that is not a set
-    for etype in source_single_etypes:
-        # get entity names for etype
-        entities = fapi.get_entities(source_workspace_namespace, source_workspace_name, etype)
-        if entities.status_code != 200:  # getting an etype's entities fails
-            message = f"Failed to retrieve entities (row names) for {etype}. API error: {entities.text}"
-            print(message)
-            return False, message
-
-        entity_names = [ent["name"] for ent in entities.json()]
-        # copy single etype (with entities) to destination workspace
-        copy_response = fapi.copy_entities(source_workspace_namespace, source_workspace_name, destination_workspace_namespace, destination_workspace_name, etype, entity_names, link_existing_entities=True)
-        if copy_response.status_code not in [201, 409]:  # if copying table with entities fails
-            message = f"Failed to copy {etype} with entities({entity_names}) to {destination_workspace_namespace}/{destination_workspace_name}. API error: {copy_response.text}."
-            print(message)
-            return False, message
-
-    for set_etype in source_set_etypes:
-        # get entity names for etype
-        set_entities = fapi.get_entities(source_workspace_namespace, source_workspace_name, set_etype)
-        if set_entities.status_code != 200:  # getting a set etype's entities fails
-            message = f"Failed to retrieve entities (row names) for {set_etype}. API error: {set_entities.text}"
-            print(message)
-            return False, message
-
-        set_entity_names = [ent["name"] for ent in set_entities.json()]
-        # copy single etype (with entities) to destination workspace
-        set_copy_response = fapi.copy_entities(source_workspace_namespace, source_workspace_name, destination_workspace_namespace, destination_workspace_name, set_etype, set_entity_names, link_existing_entities=True)
-        if set_copy_response.status_code not in [201, 409]:  # if copying set table with entities fails
-            message = f"Failed to copy {set_etype} with entities({set_entity_names}) to {destination_workspace_namespace}/{destination_workspace_name}. API error: {set_copy_response.text}."
-            print(message)
-            return False, message
-
-    print(f"Successfully copied data tables to {destination_workspace_namespace}/{destination_workspace_name}: {list(source_etypes.json().keys())}")
-    # get original workpace bucket id
-    get_bucket_success, get_bucket_message = get_workspace_bucket(source_workspace_name, source_workspace_namespace)
-    # TODO: handle if getting workspace bucket fails
-    source_bucket = json.loads(get_bucket_message)["workspace"]["bucketName"]
-    destination_bucket = destination_workspace_bucket.replace("gs://", "")
-
-    # update bucket links in the destination workspace so that it matches the path structure of what the WDL generates when it migrates data
-    # gs://new_bucket_id/original_bucket_id/[original data structure]
-    update_entities(destination_workspace_name, destination_workspace_namespace, replace_this=source_bucket, with_this=f"{destination_bucket}/{source_bucket}")
-
-    print(f"Successfully updated data tables with new bucket paths data tables in {destination_workspace_namespace}/{destination_workspace_name}.")
-    return True, list(source_etypes.json().keys())
+def iter_entities(workspace_namespace, workspace_name, entity_type, page_size=ENTITY_PAGE_SIZE):
+    """Yield the entities of one type a page at a time with entityQuery, so only one page is held in memory."""
+    page = 1
+    page_count = 1
+    while page <= page_count:
+        response = rate_limited(fapi.get_entities_query, workspace_namespace, workspace_name, entity_type, page=page, page_size=page_size)
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to retrieve page {page} of {entity_type} from {workspace_namespace}/{workspace_name}. API error: {response.text}")
+        response_json = response.json()
+        page_count = response_json["resultMetadata"]["filteredPageCount"]
+        yield from response_json["results"]
+        page += 1
+
+
+def hash_entity_attributes(attributes):
+    """Hash an entity's attributes, independent of attribute order."""
+    return hashlib.sha256(json.dumps(attributes, sort_keys=True, separators=(",", ":")).encode("utf-8")).digest()
+
+
+def migrate_entity_attributes(attributes, replace_this, with_this):
+    """Return an entity's attributes with replace_this replaced with with_this, as find_and_replace does for each attribute."""
+    migrated_attributes = {}
+    for attr, value in attributes.items():
+        updated_attr = find_and_replace(attr, value, replace_this, with_this)
+        migrated_attributes[attr] = updated_attr["addUpdateAttribute"] if updated_attr else value
+    return migrated_attributes
+
+
+def get_referenced_entity_types(attributes):
+    """Get the entity types an entity's attributes point to, from single and list EntityReference values."""
+    referenced_etypes = set()
+    for value in attributes.values():
+        if isinstance(value, dict) and "entityType" in value:
+            referenced_etypes.add(value["entityType"])
+        elif isinstance(value, dict) and value.get("itemsType") == "EntityReference":
+            referenced_etypes.update(item["entityType"] for item in value.get("items", []))
+    return referenced_etypes
+
+
+def get_batch_referenced_entity_types(entity_updates):
+    """Get the entity types that the attributes set by a batch of entity updates point to."""
+    referenced_etypes = set()
+    for entity_update in entity_updates:
+        referenced_etypes |= get_referenced_entity_types({operation["attributeName"]: operation["addUpdateAttribute"]
+                                                          for operation in entity_update["operations"] if "addUpdateAttribute" in operation})
+    return referenced_etypes
+
+
+def get_entity_hashes(workspace_namespace, workspace_name, entity_type):
+    """Get {entity name: (attributes hash, attribute names)} for every entity of one type in a workspace."""
+    entity_hashes = {}
+    attribute_name_sets = {}  # share one frozenset per distinct set of attribute names
+    for entity in iter_entities(workspace_namespace, workspace_name, entity_type):
+        attribute_names = frozenset(entity["attributes"])
+        attribute_names = attribute_name_sets.setdefault(attribute_names, attribute_names)
+        entity_hashes[entity["name"]] = (hash_entity_attributes(entity["attributes"]), attribute_names)
+    return entity_hashes
+
+
+def batch_entity_updates(entity_updates, max_operations=UPSERT_MAX_OPERATIONS, max_bytes=UPSERT_MAX_BYTES):
+    """Group {"name", "entityType", "operations"} entity updates into batchUpsert request bodies, as fiss_fns does."""
+    batch = []
+    batch_operations = 0
+    batch_bytes = 2  # enclosing []
+    for entity_update in entity_updates:
+        entity_bytes = len(json.dumps(entity_update)) + 2  # ", " separator
+        if batch and (batch_operations + len(entity_update["operations"]) > max_operations or batch_bytes + entity_bytes > max_bytes):
+            yield batch
+            batch = []
+            batch_operations = 0
+            batch_bytes = 2
+        batch.append(entity_update)
+        batch_operations += len(entity_update["operations"])
+        batch_bytes += entity_bytes
+    if batch:
+        yield batch
+
+
+def is_retryable_response(response):
+    """Rate limited (429) and server error (5xx) responses are worth retrying."""
+    return response.status_code == 429 or response.status_code >= 500
+
+
+@tn.retry(retry=tn.retry_if_result(is_retryable_response) | tn.retry_if_exception_type(requests.exceptions.ConnectionError),
+          wait=tn.wait_chain(*[tn.wait_fixed(5)] +
+                             [tn.wait_fixed(10)] +
+                             [tn.wait_fixed(30)] +
+                             [tn.wait_fixed(60)]),
+          stop=tn.stop_after_attempt(5))
+def post_entity_batch(uri, entity_updates):
+    """Post a batchUpsert request, retrying when rate limited, on server errors and on dropped connections."""
+    # Get access token and and add to headers for requests - on every attempt, in case it expired while waiting.
+    headers = {"Authorization": "Bearer " + get_access_token(), "accept": "*/*", "Content-Type": "application/json"}
+    return rate_limited(requests.post, uri, headers=headers, data=json.dumps(entity_updates))
 
 
-def copy_workspace_entities(destination_workspace_namespace, destination_workspace_name, source_workspace_namespace, source_workspace_name, destination_workspace_bucket):
-    """Copy workspace data tables to destination workspace."""
+def upsert_entity_batch(workspace_namespace, workspace_name, entity_updates):
+    """Upsert a batch of entities with a single batchUpsert request."""
+    # request URL for batchUpsert (rawls)
+    uri = f"https://rawls.dsde-prod.broadinstitute.org/api/workspaces/{workspace_namespace}/{workspace_name}/entities/batchUpsert"
 
-    # get data attributes and copy non-set data table to workspace
-    data_table_name_list = []
+    entity_names = [entity["name"] for entity in entity_updates]
+    failure_message = f"Failed to upsert {len(entity_updates)} entities ({entity_names[0]} ... {entity_names[-1]}) to {workspace_namespace}/{workspace_name}."
     try:
-        response = fapi.get_entities_with_type(source_workspace_namespace, source_workspace_name)
-        source_entities = response.json()
-        ent_type_before = None
-        ent_names = []
-        set_list = {}
-        for ent in source_entities:
-            print(ent)
-            ent_name = ent['name']
-            ent_type = ent['entityType']
-            if ent == source_entities[-1] or (ent_type_before and ent_type != ent_type_before):
-                if ent == source_entities[-1]:
-                    ent_names.append(ent_name)
-                    ent_type_before = ent_type
-                if "_set" in ent_type_before:
-                    set_list[ent_type_before] = ent_names
-                else:
-                    fapi.copy_entities(source_workspace_namespace, source_workspace_name, destination_workspace_namespace, destination_workspace_name, ent_type_before, ent_names, link_existing_entities=True)
-                    # print(f"Successfully copied {ent_type_before} data table over to: {destination_workspace_namespace}/{destination_workspace_name}.")
-                    data_table_name_list.append(ent_type_before)
-                ent_names = []
-            ent_names.append(ent_name)
-            ent_type_before = ent_type
-
-        # copy set type data tables to workspace
-        for etype, enames in set_list.items():
-            fapi.copy_entities(source_workspace_namespace, source_workspace_name, destination_workspace_namespace, destination_workspace_name, etype, enames, link_existing_entities=True)
-            # print(f"Successfully copied {etype} data table over to: {destination_workspace_namespace}/{destination_workspace_name}")
-            data_table_name_list.append(etype)
-
-        # Check if data tables match
-        destination_entities = fapi.get_entities_with_type(destination_workspace_namespace, destination_workspace_name).json()
-
-        if source_entities != destination_entities:
-            print(f"Error: Data Tables don't match")
-            return False, f"Error: Not all source data tables were copied over to the destination workspace."
+        response = post_entity_batch(uri, entity_updates)
+    except tn.RetryError as error:
+        last_attempt = error.last_attempt
+        if last_attempt.failed:
+            return False, f"{failure_message} Error after retrying: {last_attempt.exception()}"
+        response = last_attempt.result()
+
+    # capture response from API and parse out status code
+    if response.status_code != 204:
+        return False, f"{failure_message} API error: {response.text}"
+    return True, None
+
+
+def copy_entity_type(destination_workspace_namespace, destination_workspace_name, source_workspace_namespace, source_workspace_name,
+                     etype, replace_this, with_this, destination_hashes, uncopied_etypes):
+    """Upsert the source entities of one type that are missing or different in the destination, in batches.
+
+    destination_hashes is get_entity_hashes for the destination table; entities found in the source are popped
+    from it, so what's left exists only in the destination. A batch that references entity types in
+    uncopied_etypes isn't sent, as those entities may not exist in the destination yet. Returns the entity
+    counts and the uncopied types that stopped the copy (empty if it finished). Raises RuntimeError if an
+    upsert fails.
+    """
+    entity_counts = {"unchanged": 0, "upserted": 0}
+
+    def changed_entity_updates():
+        """Yield updates for source entities that are missing or different in the destination."""
+        for entity in iter_entities(source_workspace_namespace, source_workspace_name, etype):
+            attributes = migrate_entity_attributes(entity["attributes"], replace_this, with_this)
+            existing = destination_hashes.pop(entity["name"], None)
+            if existing is not None and existing[0] == hash_entity_attributes(attributes):
+                entity_counts["unchanged"] += 1
+                continue
+
+            # remove attributes the destination has that the source doesn't, then set all source attributes
+            operations = [fapi._attr_rem(attr) for attr in sorted(existing[1] - set(attributes))] if existing is not None else []
+            operations += [fapi._attr_set(attr, value) for attr, value in attributes.items()]
+            yield {"name": entity["name"], "entityType": etype, "operations": operations}
+
+    for entity_updates in batch_entity_updates(changed_entity_updates()):
+        blocking_etypes = get_batch_referenced_entity_types(entity_updates) & uncopied_etypes
+        if blocking_etypes:
+            return entity_counts, blocking_etypes
+        upsert_success, upsert_message = upsert_entity_batch(destination_workspace_namespace, destination_workspace_name, entity_updates)
+        if not upsert_success:
+            raise RuntimeError(upsert_message)
+        entity_counts["upserted"] += len(entity_updates)
+    return entity_counts, set()
+
 
+def copy_workspace_entities(destination_workspace_namespace, destination_workspace_name, source_workspace_namespace, source_workspace_name, destination_workspace_bucket):
+    """Copy workspace data tables to destination workspace.
+
+    Tables are copied one entity type at a time, reading both workspaces a page at a time. Source entities
+    have their bucket paths updated in memory and are compared with the destination by a hash of their
+    attributes, so only missing or changed entities are upserted, in batches. Rerunning a partially
+    migrated workspace only upserts what is left.
+
+    Set tables go last, so set members exist first. A table whose entities reference another table that
+    hasn't been copied yet (e.g. a pair's samples) is put off until that table is copied, without reading
+    any table more than needed up front. Tables that reference each other can't be copied in any order,
+    which fails the copy before their referencing entities are upserted.
+    """
+    data_table_name_list = []
+    try:
         # Get original workpace bucket
-        get_bucket_success, get_bucket_message = get_workspace_bucket(source_workspace_name, source_workspace_namespace)
-        # TODO: handle if getting workspace bucket fails
+        get_bucket_success, get_bucket_message = rate_limited(get_workspace_bucket, source_workspace_name, source_workspace_namespace)
+        if not get_bucket_success:
+            return False, get_bucket_message
         source_bucket = json.loads(get_bucket_message)["workspace"]["bucketName"]
         destination_bucket = destination_workspace_bucket.replace("gs://", "")
 
-        # update bucket links in the destination workspace so that it matches the path structure of what the WDL generates when it migrates data
+        # update bucket links so that they match the path structure of what the WDL generates when it migrates data
         # gs://new_bucket_id/original_bucket_id/[original data structure]
-        update_entities(destination_workspace_name, destination_workspace_namespace, replace_this=source_bucket, with_this=f"{destination_bucket}/{source_bucket}")
-        print(f"Successfully updated data tables with new bucket paths.")
+        replace_this = source_bucket
+        with_this = f"{destination_bucket}/{source_bucket}"
+
+        source_etypes = rate_limited(fapi.list_entity_types, source_workspace_namespace, source_workspace_name)
+        if source_etypes.status_code != 200:
+            return False, f"Failed to retrieve list of data tables (entity types) from: {source_workspace_namespace}/{source_workspace_name}. API error: {source_etypes.text}."
+        destination_etypes = rate_limited(fapi.list_entity_types, destination_workspace_namespace, destination_workspace_name)
+        if destination_etypes.status_code != 200:
+            return False, f"Failed to retrieve list of data tables (entity types) from: {destination_workspace_namespace}/{destination_workspace_name}. API error: {destination_etypes.text}."
+
+        source_etype_names = list(source_etypes.json().keys())
+        destination_etype_names = set(destination_etypes.json().keys())
+        pending_etypes = [etype for etype in source_etype_names if not etype.endswith("_set")] + \
+                         [etype for etype in source_etype_names if etype.endswith("_set")]
+
+        while pending_etypes:
+            deferred_etypes = {}  # table: tables it's waiting for
+            for etype in pending_etypes:
+                # hashes of what's already in the destination - empty if the table doesn't exist there yet
+                destination_hashes = get_entity_hashes(destination_workspace_namespace, destination_workspace_name, etype) if etype in destination_etype_names else {}
+                uncopied_etypes = set(pending_etypes) - set(data_table_name_list) - {etype}
+                entity_counts, blocking_etypes = copy_entity_type(destination_workspace_namespace, destination_workspace_name, source_workspace_namespace, source_workspace_name,
+                                                                  etype, replace_this, with_this, destination_hashes, uncopied_etypes)
+                if blocking_etypes:
+                    print(f"Putting off copying {etype} to {destination_workspace_namespace}/{destination_workspace_name} until {sorted(blocking_etypes)} are copied ({entity_counts['upserted']} entities upserted so far).")
+                    deferred_etypes[etype] = blocking_etypes
+                    if entity_counts["upserted"]:
+                        destination_etype_names.add(etype)
+                    continue
+
+                print(f"Copied {etype} to {destination_workspace_namespace}/{destination_workspace_name}: {entity_counts['upserted']} entities upserted, {entity_counts['unchanged']} already up to date.")
+                if destination_hashes:
+                    print(f"WARNING: {len(destination_hashes)} {etype} entities exist only in {destination_workspace_namespace}/{destination_workspace_name} and were left as is.")
+                data_table_name_list.append(etype)
+                destination_etype_names.add(etype)
+
+            # if none of the tables put off were waiting for a table that has been copied since, they'd stop at the
+            # same batch again - they wait on each other
+            if deferred_etypes and not any(blocking_etypes & set(data_table_name_list) for blocking_etypes in deferred_etypes.values()):
+                references = "; ".join(f"{etype} references {sorted(blocking_etypes)}" for etype, blocking_etypes in deferred_etypes.items())
+                message = f"Data tables in {source_workspace_namespace}/{source_workspace_name} reference each other ({references}), so they can't be copied in any order. Entities that reference these tables were not upserted."
+                print(message)
+                return False, message
+            pending_etypes = [etype for etype in pending_etypes if etype in deferred_etypes]
+
+        print(f"Successfully copied data tables with new bucket paths to {destination_workspace_namespace}/{destination_workspace_name}: {data_table_name_list}")
     except Exception as error:
         return False, error
 
     return True, data_table_name_list
 
 
-def setup_single_workspace(workspace, ignore=[]):
-    """Create one workspace and set ACLs."""
-    # initialize workspace dictionary with default values assuming failure
-    workspace_dict = {"source_workspace_name": "NA", "source_workspace_namespace": "NA",
-                      "source_workspace_bucket": "Incomplete",
-                      "destination_workspace_name": "NA", "destination_workspace_namespace": "NA",
-                      "workspace_link": "Incomplete", "destination_workspace_bucket": "Incomplete",
-                      "workspace_creation_error": "NA",
-                      "workspace_ACLs": "Incomplete", "workspace_ACLs_error": "NA",
-                      "workspace_tags": "Incomplete", "workspace_tags_error": "NA",
-                      "copy_data_tables": "Incomplete", "copy_data_tables_error": "NA",
-                      "copy_workflows": "Incomplete", "copy_workflows_error": "NA",
-                      "source_object_details_file": "Incomplete", "source_object_details_file_error": "NA",
-                      "final_workspace_status": "Failed"}
-
+def set_up_destination_workspace(workspace_dict, workspace, ignore=[]):
+    """Create the destination workspace and copy ACLs and tags. Returns False if the migration can't continue."""
     # workspace creation
     # capture original workspace details
     source_workspace_name = workspace["source_workspace_name"]
@@ -370,11 +502,11 @@ def setup_single_workspace(workspace, ignore=[]):
     workspace_dict["source_workspace_namespace"] = source_workspace_namespace
 
     # get the source workspace bucket
-    get_source_bucket_success, get_source_bucket_message = get_workspace_bucket(source_workspace_name, source_workspace_namespace)
+    get_source_bucket_success, get_source_bucket_message = rate_limited(get_workspace_bucket, source_workspace_name, source_workspace_namespace)
 
     if not get_source_bucket_success:
         workspace_dict["source_workspace_bucket"] = get_source_bucket_message
-        return workspace_dict
+        return False
 
     # get source bucket path (including gs://)
     source_bucket_path = "gs://" + json.loads(get_source_bucket_message)["workspace"]["bucketName"]
@@ -387,16 +519,16 @@ def setup_single_workspace(workspace, ignore=[]):
     workspace_dict["destination_workspace_namespace"] = destination_workspace_namespace
 
     # get original workspace authorization domain
-    get_ad_success, get_ad_message = get_workspace_authorization_domain(source_workspace_name, source_workspace_namespace)
+    get_ad_success, get_ad_message = rate_limited(get_workspace_authorization_domain, source_workspace_name, source_workspace_namespace)
 
     if not get_ad_success:
-        return workspace_dict
+        return False
 
     # get workspace attributes including workspace data from source workspace to destination workspace
-    get_ws_attributes_success, get_ws_attributes_success = get_workspace_attributes(source_workspace_namespace, source_workspace_name)
+    get_ws_attributes_success, get_ws_attributes_success = rate_limited(get_workspace_attributes, source_workspace_namespace, source_workspace_name)
 
     if not get_ws_attributes_success:
-        return workspace_dict
+        return False
 
     # create workspace (pass in auth domain response.text)
     create_ws_success, create_ws_message = create_workspace(destination_workspace_name, get_ad_message, get_ws_attributes_success, destination_workspace_namespace)
@@ -404,95 +536,176 @@ def setup_single_workspace(workspace, ignore=[]):
     workspace_dict["workspace_creation_error"] = create_ws_message
 
     if not create_ws_success:
-        return workspace_dict
+        return False
 
     # ws creation success
     workspace_dict["workspace_link"] = (f"https://app.terra.bio/#workspaces/{destination_workspace_namespace}/{destination_workspace_name}").replace(" ", "%20")
 
     # get the newly created workspace bucket
-    get_destination_bucket_success, get_destination_bucket_message = get_workspace_bucket(destination_workspace_name, destination_workspace_namespace)
+    get_destination_bucket_success, get_destination_bucket_message = rate_limited(get_workspace_bucket, destination_workspace_name, destination_workspace_namespace)
 
     if not get_destination_bucket_success:
         workspace_dict["destination_workspace_bucket"] = get_destination_bucket_message
-        return workspace_dict
+        return False
 
     destination_bucket_id = "gs://" + json.loads(get_destination_bucket_message)["workspace"]["bucketName"]
     workspace_dict["destination_workspace_bucket"] = destination_bucket_id
 
     # get original workspace ACLs json - not including auth domain
-    get_workspace_members_success, workspace_members_message = get_workspace_members(source_workspace_name, source_workspace_namespace)
+    get_workspace_members_success, workspace_members_message = rate_limited(get_workspace_members, source_workspace_name, source_workspace_namespace)
 
     # if original workspace ACLs could not be retrieved - stop workspace setup
     if not get_workspace_members_success:
         workspace_dict["workspace_ACLs_error"] = workspace_members_message
-        return workspace_dict
+        return False
 
     # add ACLs to workspace if workspace creation success
     add_member_success, add_member_message = add_members_to_workspace(destination_workspace_name, workspace_members_message, destination_workspace_namespace, ignore=ignore)
 
     if not add_member_success:
         workspace_dict["workspace_ACLs_error"] = add_member_message
-        return workspace_dict
+        return False
 
     # adding ACLs to workspace success
     workspace_dict["workspace_ACLs"] = add_member_message  # update dict with ACL emails
 
     # add tags from original workspace to new workspace
-    get_tags_success, get_tags_message = get_workspace_tags(source_workspace_name, source_workspace_namespace)
+    get_tags_success, get_tags_message = rate_limited(get_workspace_tags, source_workspace_name, source_workspace_namespace)
 
     if not get_tags_success:  # if get tags fails
         workspace_dict["workspace_tags_error"] = get_tags_message
-        return workspace_dict
+        return False
 
-    add_tags_success, add_tags_message = add_tags_to_workspace(destination_workspace_name, get_tags_message, destination_workspace_namespace)
+    add_tags_success, add_tags_message = rate_limited(add_tags_to_workspace, destination_workspace_name, get_tags_message, destination_workspace_namespace)
 
     if not add_tags_success:  # if add tags fails
         workspace_dict["workspace_tags_error"] = add_tags_message
-        return workspace_dict
+        return False
 
     print(f"Successfully updated {destination_workspace_namespace}/{destination_workspace_name} with the following tags: {add_tags_message}")
     workspace_dict["workspace_tags"] = add_tags_message
 
-    # copy over workflows from source workspace to destination workspace
-    copy_workflow_success, copy_workflow_message = copy_workspace_workflows(destination_workspace_namespace, destination_workspace_name, source_workspace_namespace, source_workspace_name)
+    return True
+
+
+def copy_workflows_phase(workspace_dict):
+    """Copy over workflows from source workspace to destination workspace."""
+    copy_workflow_success, copy_workflow_message = copy_workspace_workflows(workspace_dict["destination_workspace_namespace"], workspace_dict["destination_workspace_name"],
+                                                                            workspace_dict["source_workspace_namespace"], workspace_dict["source_workspace_name"])
 
     if not copy_workflow_success:  # if copy workflow fails
         workspace_dict["copy_workflows_error"] = copy_workflow_message
-        return workspace_dict
+        return False
     workspace_dict["copy_workflows"] = f"Workflows copied: {copy_workflow_message}"
+    return True
+
 
-    # copy over data tables from source workspace to destination workspace
-    copy_data_table_success, copy_data_table_message = copy_workspace_entities_sushma(destination_workspace_namespace, destination_workspace_name, source_workspace_namespace, source_workspace_name, destination_bucket_id)
+def copy_data_tables_phase(workspace_dict):
+    """Copy over data tables from source workspace to destination workspace."""
+    copy_data_table_success, copy_data_table_message = copy_workspace_entities(workspace_dict["destination_workspace_namespace"], workspace_dict["destination_workspace_name"],
+                                                                               workspace_dict["source_workspace_namespace"], workspace_dict["source_workspace_name"],
+                                                                               workspace_dict["destination_workspace_bucket"])
 
-    if not copy_data_table_success:  # if copy workflow fails
+    if not copy_data_table_success:  # if copy data tables fails
         workspace_dict["copy_data_tables_error"] = copy_data_table_message
-        return workspace_dict
+        return False
     workspace_dict["copy_data_tables"] = f"Data tables copied: {copy_data_table_message}"
+    return True
 
-    # query big query tables to create, export, and get source_details.txt file uri
-    source_bucket_id = source_bucket_path.split("/")[2]  # remove gs:// to get only bucket id
+
+def source_object_details_file_phase(workspace_dict):
+    """Query big query tables to create, export, and get source_details.txt file uri."""
+    source_bucket_id = workspace_dict["source_workspace_bucket"].split("/")[2]  # remove gs:// to get only bucket id
 
     make_table_success, make_table_message = get_source_objects_file.create_bucket_inventory_table(source_bucket_id)
 
     if not make_table_success:  # if the query results could not be put into table - don't proceed to export
         workspace_dict["source_object_details_file_error"] = make_table_message
-        return workspace_dict
+        return False
 
     # export query results table to GCS
     get_source_obj_success, get_source_obj_message = get_source_objects_file.export_bucket_inventory_table(source_bucket_id)
 
     if not get_source_obj_success:  # if source_details.txt could not be created
         workspace_dict["source_object_details_file_error"] = get_source_obj_message
-        return workspace_dict
+        return False
     workspace_dict["source_object_details_file"] = get_source_obj_message
+    return True
+
+
+def run_phase(workspace_dict, phase, phase_function):
+    """Run one migration phase, timing it and recording an unexpected error as that phase's error."""
+    with timed_phase(workspace_dict, phase):
+        try:
+            return phase_function(workspace_dict)
+        except Exception as error:
+            workspace_dict[f"{phase}_error"] = str(error)
+            return False
+
+
+def setup_single_workspace(workspace, ignore=[]):
+    """Create one workspace, set ACLs, and copy workflows and data tables.
+
+    Once the destination workspace is set up, workflows, data tables and the source object details
+    file don't depend on each other, so they are run at the same time. Each phase's duration is
+    recorded in a {phase}_seconds column.
+    """
+    # initialize workspace dictionary with default values assuming failure
+    workspace_dict = {"source_workspace_name": "NA", "source_workspace_namespace": "NA",
+                      "source_workspace_bucket": "Incomplete",
+                      "destination_workspace_name": "NA", "destination_workspace_namespace": "NA",
+                      "workspace_link": "Incomplete", "destination_workspace_bucket": "Incomplete",
+                      "workspace_creation_error": "NA",
+                      "workspace_ACLs": "Incomplete", "workspace_ACLs_error": "NA",
+                      "workspace_tags": "Incomplete", "workspace_tags_error": "NA",
+                      "copy_data_tables": "Incomplete", "copy_data_tables_error": "NA",
+                      "copy_workflows": "Incomplete", "copy_workflows_error": "NA",
+                      "source_object_details_file": "Incomplete", "source_object_details_file_error": "NA",
+                      "final_workspace_status": "Failed"}
 
-    workspace_dict["final_workspace_status"] = "Success"  # final workspace setup step
+    start = time.monotonic()
+    try:
+        with timed_phase(workspace_dict, "setup"):
+            try:
+                setup_success = set_up_destination_workspace(workspace_dict, workspace, ignore=ignore)
+            except Exception as error:  # don't stop the other workspaces being migrated
+                workspace_dict["workspace_creation_error"] = str(error)
+                setup_success = False
+        if not setup_success:
+            return workspace_dict
+
+        # the remaining phases are independent of each other
+        phase_functions = {"copy_workflows": copy_workflows_phase,
+                           "copy_data_tables": copy_data_tables_phase,
+                           "source_object_details_file": source_object_details_file_phase}
+        with ThreadPoolExecutor(max_workers=len(phase_functions)) as executor:
+            phase_futures = [executor.submit(run_phase, workspace_dict, phase, phase_function) for phase, phase_function in phase_functions.items()]
+            phase_successes = [future.result() for future in phase_futures]
+
+        if all(phase_successes):
+            workspace_dict["final_workspace_status"] = "Success"  # final workspace setup step
+    finally:
+        workspace_dict["total_seconds"] = round(time.monotonic() - start, 1)
 
     return workspace_dict
 
 
-def migrate_workspaces(tsv, ignore_list):
-    """Create and set up migrated workspaces."""
+def report_phase_timings(migration_data_df):
+    """Print the mean and maximum duration of each migration phase, and which phase took the most time overall."""
+    phase_columns = [f"{phase}_seconds" for phase in MIGRATION_PHASES if f"{phase}_seconds" in migration_data_df.columns]
+    if not phase_columns:
+        return
+
+    phase_seconds = migration_data_df[phase_columns].apply(pd.to_numeric, errors="coerce")
+    print("Migration phase timings (seconds):")
+    for column in phase_columns:
+        print(f"    {column.replace('_seconds', '')}: mean {phase_seconds[column].mean():.1f}, max {phase_seconds[column].max():.1f}, total {phase_seconds[column].sum():.1f}")
+    slowest_phase = phase_seconds.sum().idxmax().replace("_seconds", "")
+    print(f"Slowest phase overall: {slowest_phase}")
+
+
+def migrate_workspaces(tsv, ignore_list, max_concurrent_workspaces=DEFAULT_MAX_CONCURRENT_WORKSPACES, max_api_calls_per_second=DEFAULT_MAX_API_CALLS_PER_SECOND):
+    """Create and set up migrated workspaces, several at a time, under a global API call rate limit."""
     # read full tsv into dataframe
     setup_info_df = pd.read_csv(tsv, sep="\t")
 
@@ -505,23 +718,24 @@ def migrate_workspaces(tsv, ignore_list):
                  "copy_data_tables", "copy_data_tables_error",
                  "copy_workflows", "copy_workflows_error",
                  "source_object_details_file", "source_object_details_file_error",
-                 "final_workspace_status"]
-
-    migration_data_df = pd.DataFrame(columns=col_names)
+                 "final_workspace_status"] + \
+                [f"{phase}_seconds" for phase in MIGRATION_PHASES] + ["total_seconds"]
 
-    # per row in tsv/df
-    for index, row in setup_info_df.iterrows():
+    API_RATE_LIMITER.set_rate(max_api_calls_per_second)
 
-        # Create Workspace
-        migration_data = setup_single_workspace(row, ignore=ignore_list)
+    # per row in tsv/df - results are kept in the order of the tsv
+    rows = [row for index, row in setup_info_df.iterrows()]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrent_workspaces, len(rows)))) as executor:
+        migration_data = list(executor.map(lambda row: setup_single_workspace(row, ignore=ignore_list), rows))
 
-        # Create output tsv
-        migration_data_df = migration_data_df.append(migration_data, ignore_index=True)
+    # Create output tsv
+    migration_data_df = pd.DataFrame(migration_data, columns=col_names)
 
     # create terra data model load file with subset of columns from full report
     write_terra_load_tsv(migration_data_df)
     # create full report
     write_output_report(migration_data_df)
+    report_phase_timings(migration_data_df)
 
 
 if __name__ == "__main__":
@@ -530,8 +744,10 @@ if __name__ == "__main__":
 
     parser.add_argument('-t', '--tsv', required=True, type=str, help='tsv file with original and new workspace details.')
     parser.add_argument('-i', '--ignore', nargs='+', default=[], help='Email address to not copy ACL from.')
+    parser.add_argument('-w', '--max_concurrent_workspaces', type=int, default=DEFAULT_MAX_CONCURRENT_WORKSPACES, help='Number of workspaces to migrate at the same time.')
+    parser.add_argument('-r', '--max_api_calls_per_second', type=float, default=DEFAULT_MAX_API_CALLS_PER_SECOND, help='Maximum rate of Terra API calls, across all workspaces being migrated.')
     args = parser.parse_args()
     print(args)
 
     # call to create and set up workspaces
-    migrate_workspaces(args.tsv, args.ignore)
+    migrate_workspaces(args.tsv, args.ignore, args.max_concurrent_workspaces, args.max_api_calls_per_second)
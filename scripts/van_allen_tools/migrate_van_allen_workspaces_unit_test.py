@@ -0,0 +1,122 @@
+import json
+
+from firecloud import api as fapi
+
+import migrate_van_allen_workspaces as migrate
+
+
+SOURCE_BUCKET = "fc-source"
+DESTINATION_BUCKET = "fc-destination"
+MIGRATED_PREFIX = f"gs://{DESTINATION_BUCKET}/{SOURCE_BUCKET}"
+
+
+class Response:
+    def __init__(self, status_code, json_body=None):
+        self.status_code = status_code
+        self.text = json.dumps(json_body)
+        self._json_body = json_body
+
+    def json(self):
+        return self._json_body
+
+
+def entity(name, attributes):
+    return {"name": name, "entityType": "sample", "attributes": attributes}
+
+
+def patch_workspaces(monkeypatch, tables):
+    """Serve {workspace name: {entity type: [entities]}} through iter_entities and record batchUpsert bodies."""
+    monkeypatch.setattr(migrate, "iter_entities", lambda namespace, workspace, entity_type: iter(tables[workspace].get(entity_type, [])))
+    monkeypatch.setattr(migrate.fapi, "list_entity_types", lambda namespace, workspace: Response(200, {entity_type: {} for entity_type in tables[workspace]}))
+    monkeypatch.setattr(migrate, "get_workspace_bucket", lambda workspace, namespace: (True, json.dumps({"workspace": {"bucketName": SOURCE_BUCKET}})))
+    posted_batches = []
+    monkeypatch.setattr(migrate, "post_entity_batch", lambda uri, entity_updates: posted_batches.append(entity_updates) or Response(204))
+    return posted_batches
+
+
+# TEST: attribute hashes don't depend on the order of the attributes
+def test_hash_entity_attributes_key_order():
+    attributes = {"bam": "gs://fc-source/sample.bam", "reads": 10, "participant": {"entityType": "participant", "entityName": "p1"}}
+
+    assert migrate.hash_entity_attributes(attributes) == migrate.hash_entity_attributes(dict(reversed(list(attributes.items()))))
+    assert migrate.hash_entity_attributes(attributes) != migrate.hash_entity_attributes(dict(attributes, reads=11))
+
+
+def test_migrate_entity_attributes():
+    attributes = {"bam": f"gs://{SOURCE_BUCKET}/sample.bam", "reads": 10, "note": None,
+                  "files": {"itemsType": "AttributeValue", "items": [f"gs://{SOURCE_BUCKET}/a.txt", "gs://fc-other/b.txt"]}}
+
+    assert migrate.migrate_entity_attributes(attributes, SOURCE_BUCKET, f"{DESTINATION_BUCKET}/{SOURCE_BUCKET}") == {
+        "bam": f"{MIGRATED_PREFIX}/sample.bam", "reads": 10, "note": None,
+        "files": {"itemsType": "AttributeValue", "items": [f"{MIGRATED_PREFIX}/a.txt", "gs://fc-other/b.txt"]}}
+
+
+# TEST: only entities missing or different in the destination are upserted, and attributes only in the destination are removed
+def test_copy_entity_type_upserts_changed_entities(monkeypatch):
+    posted_batches = patch_workspaces(monkeypatch, {
+        "source": {"sample": [entity("unchanged", {"bam": f"gs://{SOURCE_BUCKET}/unchanged.bam", "reads": 1}),
+                              entity("changed", {"bam": f"gs://{SOURCE_BUCKET}/changed.bam", "reads": 2}),
+                              entity("new", {"bam": f"gs://{SOURCE_BUCKET}/new.bam"})]},
+        "destination": {"sample": [entity("unchanged", {"reads": 1, "bam": f"{MIGRATED_PREFIX}/unchanged.bam"}),
+                                   entity("changed", {"bam": f"{MIGRATED_PREFIX}/changed.bam", "reads": 1, "extra": "x"}),
+                                   entity("destination_only", {"reads": 3})]}})
+    destination_hashes = migrate.get_entity_hashes("ns", "destination", "sample")
+
+    entity_counts, blocking_etypes = migrate.copy_entity_type("ns", "destination", "ns", "source", "sample", SOURCE_BUCKET,
+                                                              f"{DESTINATION_BUCKET}/{SOURCE_BUCKET}", destination_hashes, set())
+
+    assert entity_counts == {"unchanged": 1, "upserted": 2}
+    assert blocking_etypes == set()
+    assert list(destination_hashes) == ["destination_only"]
+    assert posted_batches == [[
+        {"name": "changed", "entityType": "sample",
+         "operations": [fapi._attr_rem("extra"), fapi._attr_set("bam", f"{MIGRATED_PREFIX}/changed.bam"), fapi._attr_set("reads", 2)]},
+        {"name": "new", "entityType": "sample", "operations": [fapi._attr_set("bam", f"{MIGRATED_PREFIX}/new.bam")]},
+    ]]
+
+
+# TEST: batches stay within the operation and byte limits of a batchUpsert request
+def test_batch_entity_updates_limits():
+    entity_updates = [{"name": f"sample_{i}", "entityType": "sample", "operations": [fapi._attr_set(f"attr_{j}", "x" * 100) for j in range(3)]}
+                      for i in range(10)]
+
+    operation_batches = list(migrate.batch_entity_updates(entity_updates, max_operations=7))
+    assert [len(batch) for batch in operation_batches] == [2, 2, 2, 2, 2]
+
+    entity_bytes = len(json.dumps(entity_updates[0])) + 2
+    byte_batches = list(migrate.batch_entity_updates(entity_updates, max_bytes=2 + 3 * entity_bytes))
+    assert [len(batch) for batch in byte_batches] == [3, 3, 3, 1]
+    assert all(len(json.dumps(batch)) <= 2 + 3 * entity_bytes for batch in byte_batches)
+
+    # an entity over the limits on its own still gets a batch
+    assert [len(batch) for batch in migrate.batch_entity_updates(entity_updates[:2], max_operations=2)] == [1, 1]
+    assert list(migrate.batch_entity_updates(entity_updates)) == [entity_updates]
+
+
+# TEST: a table referencing one that hasn't been copied yet is copied after it
+def test_copy_workspace_entities_defers_referencing_tables(monkeypatch):
+    posted_batches = patch_workspaces(monkeypatch, {
+        "source": {"sample": [entity("s1", {"participant": {"entityType": "participant", "entityName": "p1"}})],
+                   "participant": [entity("p1", {"age": 30})]},
+        "destination": {}})
+
+    success, data_table_name_list = migrate.copy_workspace_entities("ns", "destination", "ns", "source", f"gs://{DESTINATION_BUCKET}")
+
+    assert success
+    assert data_table_name_list == ["participant", "sample"]
+    assert [batch[0]["name"] for batch in posted_batches] == ["p1", "s1"]
+
+
+# TEST: tables that reference each other fail the copy before their entities are upserted
+def test_copy_workspace_entities_reports_reference_cycle(monkeypatch):
+    posted_batches = patch_workspaces(monkeypatch, {
+        "source": {"a": [entity("a1", {"b": {"entityType": "b", "entityName": "b1"}})],
+                   "b": [entity("b1", {"a": {"entityType": "a", "entityName": "a1"}})],
+                   "c": [entity("c1", {"reads": 1})]},
+        "destination": {}})
+
+    success, message = migrate.copy_workspace_entities("ns", "destination", "ns", "source", f"gs://{DESTINATION_BUCKET}")
+
+    assert not success
+    assert "a references ['b']; b references ['a']" in message
+    assert [batch[0]["name"] for batch in posted_batches] == ["c1"]